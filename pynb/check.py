@@ -0,0 +1,364 @@
+"""
+Static validation of notebooks, without starting kernels
+"""
+
+import argparse
+import ast
+import builtins
+import inspect
+import logging
+import os
+import re
+import symtable
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from pynb.convert import find_sources
+from pynb.notebook import Notebook
+
+# Names always defined in iPython kernels
+BUILTINS = set(dir(builtins)) | {'get_ipython', 'display', 'In', 'Out', 'exit', 'quit'}
+
+# Names of symbol tables of comprehensions, executed immediately in the enclosing scope
+COMPREHENSIONS = {'listcomp', 'setcomp', 'dictcomp', 'genexpr'}
+
+
+def transform_magics(source):
+    """
+    Transform iPython magics and shell commands to Python code
+    :param source: cell source
+    :return: Python source
+    """
+
+    if re.search(r'^\s*[%!]', source, re.MULTILINE):
+        from IPython.core.inputtransformer2 import TransformerManager
+        source = TransformerManager().transform_cell(source)
+
+    return source
+
+
+def get_names(table, top=True, deferred=False):
+    """
+    Get global names of a symbol table and its children
+    :param table: symbol table
+    :param top: True if table is the top-level table of a cell
+    :param deferred: True if table is executed only when called (functions, lambdas and their children)
+    :return: (defined, nested) tuple of sets: names defined by the cell and global names referenced in
+             functions and lambdas
+    """
+
+    defined, nested = set(), set()
+
+    for sym in table.get_symbols():
+        name = sym.get_name()
+        if top:
+            if sym.is_assigned() or sym.is_imported():
+                defined.add(name)
+        elif sym.is_declared_global() and sym.is_assigned():
+            defined.add(name)
+        elif deferred and sym.is_global() and sym.is_referenced():
+            nested.add(name)
+
+    for child in table.get_children():
+        child_deferred = deferred or (child.get_type() == 'function' and child.get_name() not in COMPREHENSIONS)
+        child_defined, child_nested = get_names(child, top=False, deferred=child_deferred)
+        defined |= child_defined
+        nested |= child_nested
+
+    return defined, nested
+
+
+class UndefinedNames(ast.NodeVisitor):
+    """
+    Find names read before being bound, visiting the statements of a cell in execution order. Bodies of
+    functions and lambdas are not visited, since they are executed only when called.
+    """
+
+    def __init__(self, bound):
+        """
+        Initialize visitor
+        :param bound: names bound before the cell
+        """
+
+        self.bound = set(bound)
+        self.undefined = {}
+
+    def load(self, name, lineno):
+        if name not in self.bound:
+            self.undefined.setdefault(name, lineno)
+
+    def visit_all(self, nodes):
+        for node in nodes:
+            if node is not None:
+                self.visit(node)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self.load(node.id, node.lineno)
+        elif isinstance(node.ctx, ast.Store):
+            self.bound.add(node.id)
+
+    def visit_Assign(self, node):
+        self.visit(node.value)
+        self.visit_all(node.targets)
+
+    def visit_AugAssign(self, node):
+        if isinstance(node.target, ast.Name):
+            self.load(node.target.id, node.lineno)
+        self.visit(node.value)
+        self.visit(node.target)
+
+    def visit_AnnAssign(self, node):
+        self.visit(node.annotation)
+        if node.value is not None:
+            self.visit(node.value)
+            self.visit(node.target)
+        elif not isinstance(node.target, ast.Name):
+            self.visit(node.target)
+
+    def visit_NamedExpr(self, node):
+        self.visit(node.value)
+        self.visit(node.target)
+
+    def visit_For(self, node):
+        self.visit(node.iter)
+        self.visit(node.target)
+        self.visit_all(node.body)
+        self.visit_all(node.orelse)
+
+    visit_AsyncFor = visit_For
+
+    def visit_ExceptHandler(self, node):
+        if node.type is not None:
+            self.visit(node.type)
+        if node.name:
+            self.bound.add(node.name)
+        self.visit_all(node.body)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self.bound.add(alias.asname or alias.name.split('.')[0])
+
+    def visit_ImportFrom(self, node):
+        for alias in node.names:
+            if alias.name != '*':
+                self.bound.add(alias.asname or alias.name)
+
+    def visit_arguments(self, node):
+        # defaults and annotations are evaluated when the function is defined
+        self.visit_all(node.defaults + node.kw_defaults)
+        self.visit_all(arg.annotation for arg in node.posonlyargs + node.args + node.kwonlyargs)
+        self.visit_all(arg.annotation for arg in (node.vararg, node.kwarg) if arg is not None)
+
+    def visit_FunctionDef(self, node):
+        self.visit_all(node.decorator_list)
+        self.visit(node.args)
+        self.visit_all([node.returns])
+        self.bound.add(node.name)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_Lambda(self, node):
+        self.visit(node.args)
+
+    def visit_ClassDef(self, node):
+        self.visit_all(node.decorator_list + node.bases + node.keywords)
+        # class bodies are executed immediately, binding names in their own scope
+        bound = self.bound
+        self.bound = set(bound)
+        self.visit_all(node.body)
+        self.bound = bound
+        self.bound.add(node.name)
+
+    def visit_comprehension_scope(self, node, elts):
+        # the first iterable is evaluated in the enclosing scope
+        self.visit(node.generators[0].iter)
+        bound = self.bound
+        self.bound = set(bound)
+        for index, generator in enumerate(node.generators):
+            if index:
+                self.visit(generator.iter)
+            self.visit(generator.target)
+            self.visit_all(generator.ifs)
+        self.visit_all(elts)
+        self.bound = bound
+
+    def visit_ListComp(self, node):
+        self.visit_comprehension_scope(node, [node.elt])
+
+    visit_SetComp = visit_GeneratorExp = visit_ListComp
+
+    def visit_DictComp(self, node):
+        self.visit_comprehension_scope(node, [node.key, node.value])
+
+    def visit_MatchAs(self, node):
+        self.generic_visit(node)
+        if node.name:
+            self.bound.add(node.name)
+
+    def visit_MatchStar(self, node):
+        if node.name:
+            self.bound.add(node.name)
+
+    def visit_MatchMapping(self, node):
+        self.generic_visit(node)
+        if node.rest:
+            self.bound.add(node.rest)
+
+
+def first_use(tree, name):
+    """
+    Get line number of first use of name
+    :param tree: AST of cell
+    :param name: name
+    :return: line number
+    """
+
+    return min([node.lineno for node in ast.walk(tree) if isinstance(node, ast.Name) and node.id == name] or [1])
+
+
+def check_cells(cells):
+    """
+    Compile code cells and find undefined names, tracking the names bound by cells in execution order.
+    A name read before it is bound in the same statement is undefined. Global names referenced in functions
+    are checked against the names defined by earlier cells and by the whole defining cell, since they are
+    resolved only when called. Undefined names are not reported after a star import.
+    :param cells: list of notebook cells
+    :return: list of (cell index, line number, message) tuples
+    """
+
+    problems = []
+    defined = set(BUILTINS)
+    star_import = False
+
+    for cell_index, cell in enumerate(cells):
+        if cell.cell_type != 'code':
+            continue
+
+        source = transform_magics(cell.source)
+
+        try:
+            compile(source, '<cell {}>'.format(cell_index), 'exec', dont_inherit=True)
+        except SyntaxError as e:
+            problems.append((cell_index, e.lineno, 'syntax error: {}'.format(e.msg)))
+            continue
+
+        tree = ast.parse(source)
+        cell_defined, cell_nested = get_names(symtable.symtable(source, '<cell>', 'exec'))
+
+        star_import = star_import or any(isinstance(node, ast.ImportFrom) and node.names[0].name == '*'
+                                         for node in ast.walk(tree))
+
+        if not star_import:
+            visitor = UndefinedNames(defined)
+            visitor.visit(tree)
+            for name, lineno in sorted(visitor.undefined.items()):
+                problems.append((cell_index, lineno, "undefined name '{}'".format(name)))
+            for name in sorted(cell_nested - defined - cell_defined - set(visitor.undefined)):
+                problems.append((cell_index, first_use(tree, name), "undefined name '{}'".format(name)))
+
+        defined |= cell_defined
+
+    return sorted(problems, key=lambda p: (p[0], p[1] or 0))
+
+
+def load_cells(pathname, func_name='cells'):
+    """
+    Parse cells function of Python notebook without executing its module
+    :param pathname: pathname of Python notebook
+    :param func_name: name of cells function
+    :return: (notebook, args, required) tuple: notebook with cells, names of function arguments and
+             names of arguments without default value
+    """
+
+    with open(pathname, encoding='utf-8') as f:
+        source = f.read()
+
+    funcs = [node for node in ast.parse(source, pathname).body
+             if isinstance(node, ast.FunctionDef) and node.name == func_name]
+
+    if not funcs:
+        raise ValueError('function {} not found'.format(func_name))
+
+    node = funcs[-1]
+    lines = inspect.getblock(source.splitlines(True)[node.lineno - 1:])
+
+    nb = Notebook()
+    nb.add_cells_lines(lines[1:])
+
+    args = [arg.arg for arg in node.args.args]
+    required = args[:len(args) - len(node.args.defaults)]
+
+    return nb, args, required
+
+
+def check_file(pathname, func_name='cells', params=None):
+    """
+    Check Python notebook. Executed by worker processes.
+    :param pathname: pathname of Python notebook
+    :param func_name: name of cells function
+    :param params: names of parameters to check against function arguments (optional)
+    :return: list of problems as strings
+    """
+
+    try:
+        nb, args, required = load_cells(pathname, func_name)
+    except SyntaxError as e:
+        return ['{}:{}: syntax error: {}'.format(pathname, e.lineno, e.msg)]
+    except (OSError, ValueError) as e:
+        return ['{}: {}'.format(pathname, e)]
+
+    problems = []
+
+    if params is not None:
+        for name in params:
+            if name not in args:
+                problems.append('{}: unknown parameter {}'.format(pathname, name))
+        for name in required:
+            if name not in params:
+                problems.append('{}: missing parameter {}'.format(pathname, name))
+
+    if args:
+        # parameters are injected as in Notebook.add, so that cell indices match executed notebooks
+        pos = 1 if nb.nb.cells and nb.nb.cells[0].cell_type == 'markdown' else 0
+        nb.add_cell_params({name: None for name in args}, pos)
+
+    for cell_index, lineno, msg in check_cells(nb.nb.cells):
+        problems.append('{}: cell {}, line {}: {}'.format(pathname, cell_index, lineno, msg))
+
+    return problems
+
+
+def check(argv):
+    """
+    Entry point for the pynb check command
+    :param argv: command line arguments
+    :return: exit status, 1 if any problem is found
+    """
+
+    parser = argparse.ArgumentParser(prog='pynb check',
+                                     description='Check Python notebooks for syntax errors and undefined names')
+    parser.add_argument('sources', nargs='+', help='files, directories or glob patterns to check')
+    parser.add_argument('--function', default='cells', help='name of cells function of Python notebooks')
+    parser.add_argument('--param', action='append', help='parameter name to check against function arguments')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='number of worker processes')
+    args = parser.parse_args(argv)
+
+    sources = [src for src, relpath in find_sources(args.sources, 'ipynb', args.function)]
+    params = [param.split('=', 1)[0] for param in args.param] if args.param else None
+
+    begin = time.perf_counter()
+    problems = []
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(check_file, src, args.function, params) for src in sources]
+        for future in futures:
+            problems.extend(future.result())
+
+    for problem in problems:
+        print(problem)
+
+    logging.info('Checked {} files in {:.2f}s, found {} problems'.format(
+        len(sources), time.perf_counter() - begin, len(problems)))
+
+    return 1 if problems else 0
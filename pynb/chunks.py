@@ -0,0 +1,324 @@
+"""
+Deduplicated storage of sessions, split into content-defined chunks
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import zlib
+
+from pynb.utils import temp_pathname
+
+# Chunk boundaries are searched at occurrences of this byte: the MEMOIZE opcode, frequent in pickles
+ANCHOR = b'\x94'
+
+# Length of the window hashed at anchors
+WINDOW = 32
+
+
+def chunk_boundaries(data, min_size=4 * 1024, max_size=256 * 1024, mask=0xfff):
+    """
+    Split data into content-defined chunks: a chunk ends at an anchor byte whose preceding window hashes
+    to zero under mask, so that boundaries depend only on the content around them and are found again
+    after insertions and deletions. Anchors are found with bytes.find and windows hashed with crc32,
+    keeping the scan fast in pure Python. Average chunk size is about min_size + (mask + 1) / f, where f is
+    the frequency of anchor bytes. A min_size much smaller than the average size lets boundaries resync quickly.
+    :param data: bytes
+    :param min_size: minimum chunk size, except for the last chunk
+    :param max_size: maximum chunk size
+    :param mask: mask of window hash
+    :return: list of chunk end offsets
+    """
+
+    boundaries = []
+    start = 0
+
+    while start < len(data):
+        end = min(start + max_size, len(data))
+        pos = data.find(ANCHOR, start + min_size, end)
+
+        while pos != -1:
+            if zlib.crc32(data[pos - WINDOW:pos]) & mask == 0:
+                end = pos + 1
+                break
+            pos = data.find(ANCHOR, pos + 1, end)
+
+        boundaries.append(end)
+        start = end
+
+    return boundaries
+
+
+class ChunkStore:
+    """
+    Store sessions as recipes, i.e. lists of chunk keys, and each distinct chunk once in a content-addressed
+    store shared by notebooks, parameter values and executions. Chunks are reference counted in an SQLite
+    index, and garbage collected once no recipe refers to them.
+
+    Sessions are identified by the pathnames of their dill files: a session is stored either as dill file,
+    or as recipe file with extension .chunks replacing .dill.
+    """
+
+    def __init__(self, path):
+        """
+        Initialize store
+        :param path: directory of chunks
+        """
+
+        self.path = path
+
+    def connect(self):
+        """
+        Open index, creating it if needed
+        :return: SQLite connection
+        """
+
+        os.makedirs(self.path, exist_ok=True)
+
+        conn = sqlite3.connect(os.path.join(self.path, 'index.db'), timeout=60, isolation_level=None)
+        conn.execute('CREATE TABLE IF NOT EXISTS chunks (key TEXT PRIMARY KEY, size INTEGER, refs INTEGER)')
+
+        return conn
+
+    def chunk_pathname(self, key):
+        """
+        Get pathname of chunk
+        :param key: chunk key
+        :return: pathname
+        """
+
+        return os.path.join(self.path, key[:2], key)
+
+    def recipe_pathname(self, fname_session):
+        """
+        Get pathname of recipe of session
+        :param fname_session: pathname of session
+        :return: pathname
+        """
+
+        return '{}.chunks'.format(os.path.splitext(fname_session)[0])
+
+    def exists(self, fname_session):
+        """
+        Check if session is stored, as dill file or as recipe
+        :param fname_session: pathname of session
+        :return: True if the session exists
+        """
+
+        return os.path.isfile(fname_session) or os.path.isfile(self.recipe_pathname(fname_session))
+
+    def read_recipe(self, fname_session):
+        """
+        Read recipe of session
+        :param fname_session: pathname of session
+        :return: list of chunk keys, None if the recipe does not exist
+        """
+
+        try:
+            with open(self.recipe_pathname(fname_session)) as f:
+                return json.load(f)['chunks']
+        except FileNotFoundError:
+            return None
+
+    def put(self, fname_session):
+        """
+        Replace dill file of session with recipe, storing its new chunks
+        :param fname_session: pathname of session
+        :return: bytes written, i.e. size of new chunks and recipe
+        """
+
+        with open(fname_session, 'rb') as f:
+            data = f.read()
+
+        keys = []
+        written = 0
+        start = 0
+
+        conn = self.connect()
+
+        try:
+            # chunk files and references are updated atomically with respect to garbage collection
+            conn.execute('BEGIN IMMEDIATE')
+
+            for end in chunk_boundaries(data):
+                chunk = data[start:end]
+                key = hashlib.sha256(chunk).hexdigest()
+                pathname = self.chunk_pathname(key)
+
+                if not os.path.isfile(pathname):
+                    os.makedirs(os.path.dirname(pathname), exist_ok=True)
+                    tmp_pathname = temp_pathname(pathname)
+                    with open(tmp_pathname, 'wb') as f:
+                        f.write(chunk)
+                    os.replace(tmp_pathname, pathname)
+                    written += len(chunk)
+
+                conn.execute('INSERT OR IGNORE INTO chunks VALUES (?, ?, 0)', (key, len(chunk)))
+                conn.execute('UPDATE chunks SET refs = refs + 1 WHERE key = ?', (key,))
+                keys.append(key)
+                start = end
+
+            # the recipe of a previous execution of the same cell is replaced
+            self.release(conn, self.read_recipe(fname_session) or [])
+
+            recipe_pathname = self.recipe_pathname(fname_session)
+            tmp_pathname = temp_pathname(recipe_pathname)
+            with open(tmp_pathname, 'w') as f:
+                json.dump({'size': len(data), 'chunks': keys}, f)
+            os.replace(tmp_pathname, recipe_pathname)
+            written += os.path.getsize(recipe_pathname)
+
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+        os.remove(fname_session)
+
+        return written
+
+    def release(self, conn, keys):
+        """
+        Release references to chunks, freeing the chunks not referred to any longer. Called inside
+        a transaction.
+        :param conn: SQLite connection
+        :param keys: chunk keys
+        :return:
+        """
+
+        for key in keys:
+            conn.execute('UPDATE chunks SET refs = refs - 1 WHERE key = ?', (key,))
+
+        for key in set(keys):
+            if conn.execute('SELECT refs FROM chunks WHERE key = ?', (key,)).fetchone()[0] <= 0:
+                conn.execute('DELETE FROM chunks WHERE key = ?', (key,))
+                if os.path.isfile(self.chunk_pathname(key)):
+                    os.remove(self.chunk_pathname(key))
+
+    @contextlib.contextmanager
+    def open_session(self, fname_session):
+        """
+        Context manager providing a dill file of session: the stored dill file, or a temporary file
+        rebuilt by streaming its chunks, removed on exit. Dill files take precedence over recipes,
+        since they are removed when replaced by recipes.
+        :param fname_session: pathname of session
+        :return: pathname of dill file
+        """
+
+        keys = None if os.path.isfile(fname_session) else self.read_recipe(fname_session)
+
+        if keys is None:
+            yield fname_session
+            return
+
+        tmp_pathname = temp_pathname(fname_session)
+
+        try:
+            with open(tmp_pathname, 'wb') as f:
+                for key in keys:
+                    with open(self.chunk_pathname(key), 'rb') as chunk:
+                        f.write(chunk.read())
+            yield tmp_pathname
+        finally:
+            if os.path.isfile(tmp_pathname):
+                os.remove(tmp_pathname)
+
+    def size(self, fname_session):
+        """
+        Get size of session
+        :param fname_session: pathname of session
+        :return: size in bytes
+        """
+
+        if os.path.isfile(fname_session):
+            return os.path.getsize(fname_session)
+
+        with open(self.recipe_pathname(fname_session)) as f:
+            return json.load(f)['size']
+
+    def remove(self, fname_session):
+        """
+        Remove session, releasing its chunks
+        :param fname_session: pathname of session
+        :return:
+        """
+
+        if os.path.isfile(fname_session):
+            os.remove(fname_session)
+
+        keys = self.read_recipe(fname_session)
+        if keys is None:
+            return
+
+        conn = self.connect()
+
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            self.release(conn, keys)
+            os.remove(self.recipe_pathname(fname_session))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def gc(self, recipes_dir):
+        """
+        Free chunks not referred to by any recipe. Chunks are freed as soon as their recipes are replaced
+        or removed by pynb: reference counts are recomputed from the recipes in recipes_dir, so that also
+        recipes removed by hand, e.g. by cleaning the cache directory, release their chunks.
+        :param recipes_dir: directory of recipes
+        :return: (number of chunks freed, bytes freed) tuple
+        """
+
+        conn = self.connect()
+        freed, freed_bytes = 0, 0
+
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+
+            refs = {}
+            for name in os.listdir(recipes_dir):
+                if name.endswith('.chunks'):
+                    for key in self.read_recipe(os.path.join(recipes_dir, name)) or []:
+                        refs[key] = refs.get(key, 0) + 1
+
+            for key, size in conn.execute('SELECT key, size FROM chunks').fetchall():
+                if refs.get(key, 0) > 0:
+                    conn.execute('UPDATE chunks SET refs = ? WHERE key = ?', (refs[key], key))
+                    continue
+
+                conn.execute('DELETE FROM chunks WHERE key = ?', (key,))
+                if os.path.isfile(self.chunk_pathname(key)):
+                    os.remove(self.chunk_pathname(key))
+                freed += 1
+                freed_bytes += size
+
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+        return freed, freed_bytes
+
+    def stats(self):
+        """
+        Get statistics of store
+        :return: (number of chunks, stored bytes, referenced bytes) tuple, where referenced bytes are
+                 the bytes of the sessions referring to the chunks
+        """
+
+        conn = self.connect()
+
+        try:
+            return conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(size * refs), 0) '
+                                'FROM chunks').fetchone()
+        finally:
+            conn.close()
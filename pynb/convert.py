@@ -0,0 +1,168 @@
+"""
+Bulk conversion between Jupyter notebooks and Python notebooks
+"""
+
+import argparse
+import glob
+import logging
+import os
+import re
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import nbformat as nbf
+
+from pynb.export import NotebookExporter, dumps_pynb
+from pynb.notebook import Notebook
+from pynb.utils import get_func
+
+# Extensions of source and destination files for each destination format
+EXTENSIONS = {'pynb': ('.ipynb', '.py'), 'ipynb': ('.py', '.ipynb')}
+
+
+def glob_base(pattern):
+    """
+    Get the directory of a glob pattern preceding its first component with wildcards
+    :param pattern: glob pattern, or pathname of file
+    :return: directory, '.' if the first component has wildcards
+    """
+
+    base = []
+    for part in pattern.split(os.sep)[:-1]:
+        if re.search(r'[*?[]', part):
+            break
+        base.append(part)
+
+    return os.sep.join(base) or ('/' if pattern.startswith(os.sep) else '.')
+
+
+def find_sources(locations, to, func_name='cells'):
+    """
+    Find files to convert
+    :param locations: list of files, directories (searched recursively) and glob patterns. Relative pathnames
+                      of matches are relative to the directories, and to the directories of the glob patterns
+                      preceding their first component with wildcards
+    :param to: destination format, 'pynb' or 'ipynb'
+    :param func_name: name of cells function, used to select Python notebooks in directories
+    :return: list of (source pathname, pathname relative to output directory) tuples
+    """
+
+    src_ext = EXTENSIONS[to][0]
+    sources = []
+
+    for location in locations:
+        if os.path.isdir(location):
+            for dirpath, dirnames, filenames in os.walk(location):
+                dirnames[:] = sorted(d for d in dirnames if d != '.ipynb_checkpoints')
+                for filename in sorted(filenames):
+                    pathname = os.path.join(dirpath, filename)
+                    if not filename.endswith(src_ext):
+                        continue
+                    if to == 'ipynb':
+                        # directories contain also regular Python modules: skip them
+                        with open(pathname, encoding='utf-8') as f:
+                            if not re.search(r'^def {}\('.format(re.escape(func_name)), f.read(), re.MULTILINE):
+                                continue
+                    sources.append((pathname, os.path.relpath(pathname, location)))
+        else:
+            base = glob_base(location)
+            for pathname in sorted(glob.glob(location, recursive=True)):
+                sources.append((pathname, os.path.relpath(pathname, base)))
+
+    return sources
+
+
+def convert_file(src, dst, to, func_name='cells', force=False, log_level=logging.WARNING):
+    """
+    Convert file. Executed by worker processes.
+    :param src: source pathname
+    :param dst: destination pathname
+    :param to: destination format, 'pynb' or 'ipynb'
+    :param func_name: name of cells function, if converting from Python notebook
+    :param force: convert even if the destination is newer than the source
+    :param log_level: log level of worker process
+    :return: (source pathname, status, error message) tuple, status is 'converted', 'skipped' or 'failed'
+    """
+
+    logging.getLogger().setLevel(log_level)
+
+    if not force and os.path.isfile(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+        return src, 'skipped', None
+
+    try:
+        nb = Notebook()
+
+        if to == 'pynb':
+            nb.nb = nbf.read(src, as_version=4)
+            s = dumps_pynb(nb.nb)
+        else:
+            nb.add_cells(get_func(func_name, src))
+            s = NotebookExporter().dumps_ipynb(nb.nb)
+
+        if os.path.dirname(dst):
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+        with open(dst, 'w', encoding='utf-8') as f:
+            f.write(s)
+
+    except (Exception, SystemExit):
+        # SystemExit is raised by pynb.utils.fatal
+        return src, 'failed', traceback.format_exc(limit=1).strip().splitlines()[-1]
+
+    return src, 'converted', None
+
+
+def convert(argv):
+    """
+    Entry point for the pynb convert command
+    :param argv: command line arguments
+    :return: exit status, 1 if any conversion failed
+    """
+
+    parser = argparse.ArgumentParser(prog='pynb convert',
+                                     description='Convert Jupyter notebooks to Python notebooks or vice versa')
+    parser.add_argument('sources', nargs='+', help='files, directories or glob patterns to convert')
+    parser.add_argument('--to', choices=['pynb', 'ipynb'], required=True, help='destination format')
+    parser.add_argument('--output-dir', help='output directory (default: next to source files)')
+    parser.add_argument('--function', default='cells', help='name of cells function of Python notebooks')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--force', action="store_true", default=False,
+                        help='convert also files whose output is newer than the source')
+    parser.add_argument('--log-level', default='WARNING', help='set log level of workers')
+    args = parser.parse_args(argv)
+
+    dst_ext = EXTENSIONS[args.to][1]
+    sources = find_sources(args.sources, args.to, args.function)
+
+    jobs = []
+    for src, relpath in sources:
+        if args.output_dir:
+            dst = os.path.join(args.output_dir, os.path.splitext(relpath)[0] + dst_ext)
+        else:
+            dst = os.path.splitext(src)[0] + dst_ext
+        jobs.append((src, dst))
+
+    logging.info('Converting {} files to {} with {} workers'.format(len(jobs), args.to, args.jobs))
+
+    begin = time.perf_counter()
+    counts = {'converted': 0, 'skipped': 0, 'failed': 0}
+
+    log_level = logging.getLevelName(args.log_level)
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(convert_file, src, dst, args.to, args.function, args.force, log_level)
+                   for src, dst in jobs]
+        for future in futures:
+            src, status, error = future.result()
+            counts[status] += 1
+            if error:
+                logging.error("Conversion of '{}' failed: {}".format(src, error))
+
+    elapsed = time.perf_counter() - begin
+
+    logging.info('Converted: {converted}, skipped: {skipped}, failed: {failed}'.format(**counts))
+    logging.info('Elapsed time: {:.2f}s, throughput: {:.1f} files/s'.format(
+        elapsed, counts['converted'] / elapsed if elapsed > 0 else 0))
+
+    return 1 if counts['failed'] else 0
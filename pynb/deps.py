@@ -0,0 +1,188 @@
+"""
+Dependencies of cells on project-local modules
+"""
+
+import ast
+import hashlib
+import os
+import site
+import sys
+import sysconfig
+from importlib.machinery import PathFinder
+
+
+def get_imports(source, package=None):
+    """
+    Get names of modules imported by Python source, including parent packages. Names imported with
+    "from X import Y" are returned both as X and X.Y, since Y might be a submodule.
+    :param source: Python source
+    :param package: name of package containing the source, used to resolve relative imports (optional)
+    :return: set of module names
+    """
+
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        # e.g., cells with iPython magics: imports are not tracked
+        return set()
+
+    names = set()
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            if node.level:
+                if not package:
+                    continue
+                parts = package.split('.')
+                parts = parts[:len(parts) - node.level + 1]
+                base = '.'.join(parts + ([node.module] if node.module else []))
+            else:
+                base = node.module
+            if not base:
+                continue
+            names.add(base)
+            names.update('{}.{}'.format(base, alias.name) for alias in node.names if alias.name != '*')
+
+    # importing a submodule imports also its parent packages
+    for name in list(names):
+        parts = name.split('.')
+        names.update('.'.join(parts[:i]) for i in range(1, len(parts)))
+
+    return names
+
+
+class LocalModules:
+    """
+    Find project-local modules imported by cells, directly or indirectly, and hash their content.
+    Modules are project-local if not installed in the standard library, site-packages or dist-packages
+    directories (e.g., packages of Debian and Ubuntu).
+    Modules are located as the kernel would, without importing them.
+    """
+
+    def __init__(self, path=None, cwd=None):
+        """
+        Initialize finder
+        :param path: module search path (optional, default: working directory followed by sys.path)
+        :param cwd: working directory of the kernel (optional, default: current working directory)
+        """
+
+        self.path = path or [os.path.abspath(cwd or os.getcwd())] + [p for p in sys.path if p]
+
+        paths = sysconfig.get_paths()
+        excluded = [paths[k] for k in ['stdlib', 'platstdlib', 'purelib', 'platlib'] if paths.get(k)]
+        excluded += site.getsitepackages() + [site.getusersitepackages()]
+        self.excluded = [os.path.join(os.path.realpath(path), '') for path in excluded]
+
+        self.specs = {}
+        self.sources = {}
+        self.hashes = {}
+
+    def is_local(self, pathname):
+        """
+        Check if pathname is project-local
+        :param pathname: pathname
+        :return: True if not in the standard library, site-packages or dist-packages directories
+        """
+
+        pathname = os.path.realpath(pathname)
+
+        parts = pathname.split(os.sep)
+        if 'site-packages' in parts or 'dist-packages' in parts:
+            return False
+
+        return not any(pathname.startswith(path) for path in self.excluded)
+
+    def find_module(self, name):
+        """
+        Locate project-local module
+        :param name: module name
+        :return: (pathname, search locations) tuple: pathname of module source, None if not found, not a
+                 Python source or not local, and search locations of submodules, None if not a local package
+        """
+
+        if name not in self.specs:
+            parent = name.rpartition('.')[0]
+            search_path = self.find_module(parent)[1] if parent else self.path
+            spec = PathFinder.find_spec(name, search_path) if search_path else None
+
+            pathname, locations = None, None
+            if spec is not None:
+                if spec.origin and spec.origin.endswith('.py') and self.is_local(spec.origin):
+                    pathname = spec.origin
+                if spec.submodule_search_locations and all(self.is_local(p) for p in spec.submodule_search_locations):
+                    locations = list(spec.submodule_search_locations)
+
+            self.specs[name] = pathname, locations
+
+        return self.specs[name]
+
+    def get_source(self, pathname):
+        """
+        Get source of module, reading it again only if modified
+        :param pathname: pathname of module
+        :return: source as bytes
+        """
+
+        mtime = os.stat(pathname).st_mtime_ns
+        if self.sources.get(pathname, (None,))[0] != mtime:
+            with open(pathname, 'rb') as f:
+                self.sources[pathname] = mtime, f.read()
+
+        return self.sources[pathname][1]
+
+    def dependencies(self, source, package=None, deps=None):
+        """
+        Find project-local modules imported by source, directly or indirectly
+        :param source: Python source
+        :param package: name of package containing the source (optional)
+        :param deps: set of pathnames found so far (optional)
+        :return: set of pathnames
+        """
+
+        deps = set() if deps is None else deps
+
+        for name in sorted(get_imports(source, package)):
+            pathname = self.find_module(name)[0]
+            if pathname and pathname not in deps:
+                deps.add(pathname)
+                is_package = os.path.basename(pathname) == '__init__.py'
+                self.dependencies(self.get_source(pathname), name if is_package else name.rpartition('.')[0],
+                                  deps)
+
+        return deps
+
+    def file_hash(self, pathname):
+        """
+        Hash file content, hashing again only if modified
+        :param pathname: pathname
+        :return: hash string
+        """
+
+        st = os.stat(pathname)
+        key = st.st_mtime_ns, st.st_size
+
+        if self.hashes.get(pathname, (None,))[0] != key:
+            with open(pathname, 'rb') as f:
+                self.hashes[pathname] = key, hashlib.sha1(f.read()).hexdigest()
+
+        return self.hashes[pathname][1]
+
+    def digest(self, source):
+        """
+        Hash content of project-local modules imported by source, directly or indirectly
+        :param source: Python source
+        :return: hash string, None if no project-local modules are imported
+        """
+
+        deps = self.dependencies(source)
+
+        if not deps:
+            return None
+
+        h = hashlib.sha1()
+        for pathname in sorted(deps):
+            h.update('{} {}\n'.format(pathname, self.file_hash(pathname)).encode('utf-8'))
+
+        return h.hexdigest()
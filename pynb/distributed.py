@@ -0,0 +1,451 @@
+"""
+Distributed execution of notebooks with a coordinator and worker processes communicating over ZeroMQ
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import socket
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import zmq
+from nbconvert.preprocessors.execute import CellExecutionError
+
+from pynb.export import NotebookExporter
+from pynb.notebook import Notebook
+from pynb.utils import get_func, fatal
+
+
+def send_message(sock, msg, identity=None):
+    """
+    Send JSON message
+    :param sock: ZeroMQ socket
+    :param msg: message as dict
+    :param identity: identity of receiving worker, required by ROUTER sockets (optional)
+    :return:
+    """
+
+    frames = [json.dumps(msg).encode('utf-8')]
+    if identity is not None:
+        frames.insert(0, identity)
+
+    sock.send_multipart(frames)
+
+
+class Coordinator:
+    """
+    Distribute jobs to workers. Each job executes a notebook function with a set of parameters.
+
+    Protocol: workers connect with a DEALER socket to the coordinator ROUTER socket and send JSON messages:
+    {"type": "ready"} to request a job, {"type": "heartbeat"} every few seconds and {"type": "result", ...}
+    to return the result of a job, which also requests the next job. The coordinator replies with
+    {"type": "job", ...}, acknowledges heartbeats with {"type": "ack"} and, once all jobs are completed,
+    answers any message with {"type": "stop"}.
+
+    Workers not heard of for more than heartbeat_timeout seconds are considered lost and their job
+    is assigned to another worker. Jobs are retried also if their execution fails for reasons other than
+    an error in a cell. Workers not hearing from the coordinator exit, see Worker class.
+    """
+
+    def __init__(self, jobs, address='tcp://*:5555', retries=2, heartbeat_timeout=30, disable_cache=False,
+                 no_workers_timeout=300, linger=5):
+        """
+        Initialize coordinator and bind socket
+        :param jobs: list of jobs as dicts with keys notebook, function (optional), params (optional), name (optional)
+        :param address: ZeroMQ address to bind
+        :param retries: maximum number of retries of a job
+        :param heartbeat_timeout: seconds after which a silent worker is considered lost
+        :param disable_cache: disable execution cache on workers
+        :param no_workers_timeout: seconds without workers after which execution fails, None to wait forever
+        :param linger: seconds during which workers considered lost are still stopped, once all jobs are completed
+        """
+
+        self.jobs = {}
+        for i, job in enumerate(jobs):
+            name = job.get('name', '{}-{}'.format(os.path.splitext(os.path.basename(job['notebook']))[0], i))
+            self.jobs[i] = {'name': name,
+                            'notebook': os.path.abspath(job['notebook']),
+                            'function': job.get('function', 'cells'),
+                            'params': job.get('params', {}),
+                            'attempts': 0}
+
+        self.retries = retries
+        self.heartbeat_timeout = heartbeat_timeout
+        self.disable_cache = disable_cache
+        self.no_workers_timeout = no_workers_timeout
+        self.linger = linger
+
+        self.pending = collections.deque(sorted(self.jobs))
+        self.results = {}
+        self.workers = {}
+        self.lost = set()
+        self.idle = collections.deque()
+
+        self.sock = zmq.Context.instance().socket(zmq.ROUTER)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.sock.bind(address)
+
+    def run(self, result_callback=None):
+        """
+        Distribute jobs until all of them are completed, then stop workers
+        :param result_callback: function called with each job result (optional)
+        :return: dict mapping job ids to results
+        """
+
+        self.result_callback = result_callback
+        workers_seen = time.perf_counter()
+
+        try:
+            while len(self.results) < len(self.jobs):
+                if self.sock.poll(500):
+                    identity, data = self.sock.recv_multipart()
+                    self.handle_message(identity, json.loads(data.decode('utf-8')))
+                self.check_workers()
+                self.dispatch()
+
+                if self.workers:
+                    workers_seen = time.perf_counter()
+                elif self.no_workers_timeout is not None and \
+                        time.perf_counter() - workers_seen > self.no_workers_timeout:
+                    raise RuntimeError('No workers connected for {}s, {} jobs not completed'.format(
+                        self.no_workers_timeout, len(self.jobs) - len(self.results)))
+
+            self.stop_workers()
+        finally:
+            self.sock.close()
+
+        return self.results
+
+    def stop_workers(self):
+        """
+        Stop connected workers and, for up to linger seconds, workers considered lost that are sending
+        messages again. Workers connecting later exit when not hearing from the coordinator.
+        :return:
+        """
+
+        for identity in self.workers:
+            send_message(self.sock, {'type': 'stop'}, identity)
+
+        end = time.perf_counter() + self.linger
+
+        while self.lost and time.perf_counter() < end:
+            if self.sock.poll(100):
+                identity, _ = self.sock.recv_multipart()
+                send_message(self.sock, {'type': 'stop'}, identity)
+                self.lost.discard(identity)
+
+    def handle_message(self, identity, msg):
+        """
+        Handle message received from worker
+        :param identity: worker identity
+        :param msg: message as dict
+        :return:
+        """
+
+        worker = self.workers.get(identity)
+
+        if worker is None:
+            # new worker, or worker previously considered lost
+            logging.info('Worker {}: connected'.format(identity.decode('utf-8')))
+            worker = self.workers[identity] = {'job': None}
+            self.lost.discard(identity)
+
+        worker['last_seen'] = time.perf_counter()
+
+        if msg['type'] == 'heartbeat':
+            send_message(self.sock, {'type': 'ack'}, identity)
+
+        elif msg['type'] == 'ready':
+            if identity not in self.idle:
+                self.idle.append(identity)
+
+        elif msg['type'] == 'result':
+            worker['job'] = None
+            self.idle.append(identity)
+            self.handle_result(identity, msg)
+
+    def handle_result(self, identity, msg):
+        """
+        Handle job result received from worker
+        :param identity: worker identity
+        :param msg: result message
+        :return:
+        """
+
+        job_id = msg['id']
+        job = self.jobs[job_id]
+
+        if job_id in self.results:
+            # job completed also by another worker, after this one was considered lost
+            return
+
+        if msg['status'] == 'ok':
+            logging.info('Job {}: completed by worker {} in {:.2f}s'.format(
+                job['name'], identity.decode('utf-8'), msg['exec_time']))
+            if job_id in self.pending:
+                self.pending.remove(job_id)
+            self.add_result(job_id, dict(msg, worker=identity.decode('utf-8')))
+        elif msg['retry']:
+            self.retry(job_id, msg['error'])
+        else:
+            logging.error('Job {}: failed on worker {}\n{}'.format(job['name'], identity.decode('utf-8'), msg['error']))
+            self.add_result(job_id, dict(msg, worker=identity.decode('utf-8')))
+
+    def add_result(self, job_id, result):
+        """
+        Record job result
+        :param job_id: job id
+        :param result: result as dict
+        :return:
+        """
+
+        job = self.jobs[job_id]
+        result = dict(result, id=job_id, name=job['name'], notebook=job['notebook'], function=job['function'],
+                      params=job['params'], attempts=job['attempts'])
+        result.pop('type', None)
+        result.pop('retry', None)
+        self.results[job_id] = result
+
+        if self.result_callback:
+            self.result_callback(result)
+
+    def retry(self, job_id, error):
+        """
+        Assign job again, if the maximum number of retries is not exceeded
+        :param job_id: job id
+        :param error: error message
+        :return:
+        """
+
+        job = self.jobs[job_id]
+
+        if job['attempts'] > self.retries:
+            logging.error('Job {}: failed after {} attempts: {}'.format(job['name'], job['attempts'], error))
+            self.add_result(job_id, {'status': 'error', 'error': error})
+        elif job_id not in self.pending:
+            logging.warning('Job {}: retrying, {}'.format(job['name'], error))
+            self.pending.appendleft(job_id)
+
+    def check_workers(self):
+        """
+        Detect lost workers and assign their jobs again
+        :return:
+        """
+
+        now = time.perf_counter()
+
+        for identity, worker in list(self.workers.items()):
+            if now - worker['last_seen'] > self.heartbeat_timeout:
+                logging.warning('Worker {}: lost'.format(identity.decode('utf-8')))
+                del self.workers[identity]
+                self.lost.add(identity)
+                if identity in self.idle:
+                    self.idle.remove(identity)
+                if worker['job'] is not None and worker['job'] not in self.results:
+                    self.retry(worker['job'], 'worker {} lost'.format(identity.decode('utf-8')))
+
+    def dispatch(self):
+        """
+        Assign pending jobs to idle workers
+        :return:
+        """
+
+        while self.pending and self.idle:
+            identity = self.idle.popleft()
+            job_id = self.pending.popleft()
+            job = self.jobs[job_id]
+            job['attempts'] += 1
+            self.workers[identity]['job'] = job_id
+
+            logging.info('Job {}: assigned to worker {}'.format(job['name'], identity.decode('utf-8')))
+            send_message(self.sock, {'type': 'job', 'id': job_id, 'notebook': job['notebook'],
+                                     'function': job['function'], 'params': job['params'],
+                                     'disable_cache': self.disable_cache}, identity)
+
+
+class Worker:
+    """
+    Execute jobs received from a coordinator, see Coordinator class. Workers exit if the coordinator
+    is silent for more than coordinator_timeout seconds, e.g. if it terminated or it is not reachable.
+    """
+
+    def __init__(self, address, heartbeat_interval=5, cache_dir='/tmp', coordinator_timeout=60):
+        """
+        Initialize worker and connect to coordinator
+        :param address: ZeroMQ address of coordinator
+        :param heartbeat_interval: seconds between heartbeats
+        :param cache_dir: directory of execution cache, possibly shared by all workers
+        :param coordinator_timeout: seconds after which a silent coordinator is considered lost
+        """
+
+        self.identity = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.heartbeat_interval = heartbeat_interval
+        self.coordinator_timeout = coordinator_timeout
+        self.cache_dir = cache_dir
+
+        self.sock = zmq.Context.instance().socket(zmq.DEALER)
+        self.sock.setsockopt(zmq.IDENTITY, self.identity.encode('utf-8'))
+        self.sock.setsockopt(zmq.LINGER, 1000)
+        self.sock.connect(address)
+
+    def run(self):
+        """
+        Execute jobs until the coordinator sends a stop message. Jobs are executed in a separate thread,
+        so that heartbeats are sent also during long executions.
+        :return:
+        """
+
+        logging.info('Worker {}: ready'.format(self.identity))
+
+        send_message(self.sock, {'type': 'ready'})
+        last_sent = last_received = time.perf_counter()
+        future = None
+        stopping = False
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            try:
+                while not (stopping and future is None):
+                    if self.sock.poll(100):
+                        msg = json.loads(self.sock.recv().decode('utf-8'))
+                        last_received = time.perf_counter()
+                        if msg['type'] == 'stop':
+                            stopping = True
+                        elif msg['type'] == 'job':
+                            future = executor.submit(self.run_job, msg)
+                    elif time.perf_counter() - last_received > self.coordinator_timeout:
+                        # running job, if any, is completed but its result is lost
+                        raise RuntimeError('Coordinator not heard of for {}s'.format(self.coordinator_timeout))
+
+                    if future is not None and future.done():
+                        send_message(self.sock, future.result())
+                        last_sent = time.perf_counter()
+                        future = None
+
+                    if time.perf_counter() - last_sent > self.heartbeat_interval:
+                        send_message(self.sock, {'type': 'heartbeat'})
+                        last_sent = time.perf_counter()
+            finally:
+                self.sock.close()
+
+        logging.info('Worker {}: stopped'.format(self.identity))
+
+    def run_job(self, msg):
+        """
+        Execute job
+        :param msg: job message
+        :return: result message
+        """
+
+        logging.info('Worker {}: executing {}:{} with parameters {}'.format(
+            self.identity, msg['notebook'], msg['function'], msg['params']))
+
+        begin = time.perf_counter()
+        result = {'type': 'result', 'id': msg['id']}
+
+        try:
+            nb = Notebook()
+            uid = nb.add_func(get_func(msg['function'], msg['notebook']), msg['params'])
+            nb.process(uid=uid, add_footer=True, disable_cache=msg['disable_cache'], cache_dir=self.cache_dir)
+        except CellExecutionError as e:
+            # errors in cells are reproducible: do not retry
+            result.update(status='error', retry=False, error=str(e))
+        except SystemExit:
+            # raised by pynb.utils.fatal, e.g. if parameters are not matching: do not retry
+            result.update(status='error', retry=False, error=traceback.format_exc(limit=1))
+        except Exception:
+            result.update(status='error', retry=True, error=traceback.format_exc(limit=1))
+        else:
+            result.update(status='ok',
+                          ipynb=NotebookExporter().dumps_ipynb(nb.nb),
+                          cells=[{k: v for k, v in r.items() if k != 'outputs'} for r in nb.cell_results])
+
+        result['exec_time'] = time.perf_counter() - begin
+
+        return result
+
+
+def coordinator(argv):
+    """
+    Entry point for the pynb coordinator command
+    :param argv: command line arguments
+    :return: exit status, 1 if any job failed
+    """
+
+    parser = argparse.ArgumentParser(prog='pynb coordinator', description='Distribute notebook executions to workers')
+    parser.add_argument('jobs', help='JSON file with list of jobs. Format: [{"notebook": PATHNAME, '
+                                     '"function": NAME, "params": {NAME: VALUE, ...}, "name": NAME}, ...]')
+    parser.add_argument('--bind', default='tcp://*:5555', help='ZeroMQ address to bind')
+    parser.add_argument('--output-dir', default='pynb-results', help='directory of executed notebooks and results')
+    parser.add_argument('--retries', default=2, type=int, help='maximum number of retries of a job')
+    parser.add_argument('--heartbeat-timeout', default=30, type=float,
+                        help='seconds after which a silent worker is considered lost')
+    parser.add_argument('--no-workers-timeout', default=300, type=float,
+                        help='seconds without workers after which the execution fails')
+    parser.add_argument('--disable-cache', action="store_true", default=False, help='disable execution cache')
+    parser.add_argument('--log-level', help='set log level')
+    args = parser.parse_args(argv)
+
+    if args.log_level:
+        logging.getLogger().setLevel(logging.getLevelName(args.log_level))
+
+    try:
+        with open(args.jobs, encoding='utf-8') as f:
+            jobs = json.load(f)
+    except (OSError, ValueError) as e:
+        fatal('Cannot load jobs from {}: {}'.format(args.jobs, e))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    def write_notebook(result):
+        if 'ipynb' in result:
+            with open(os.path.join(args.output_dir, '{}.ipynb'.format(result['name'])), 'w', encoding='utf-8') as f:
+                f.write(result['ipynb'])
+
+    logging.info('Distributing {} jobs on {}'.format(len(jobs), args.bind))
+
+    begin = time.perf_counter()
+    try:
+        results = Coordinator(jobs, address=args.bind, retries=args.retries, heartbeat_timeout=args.heartbeat_timeout,
+                              disable_cache=args.disable_cache,
+                              no_workers_timeout=args.no_workers_timeout).run(result_callback=write_notebook)
+    except RuntimeError as e:
+        fatal(e)
+    elapsed = time.perf_counter() - begin
+
+    with open(os.path.join(args.output_dir, 'results.json'), 'w', encoding='utf-8') as f:
+        json.dump([{k: v for k, v in results[i].items() if k != 'ipynb'} for i in sorted(results)], f, indent=1)
+
+    failed = sum(1 for r in results.values() if r['status'] != 'ok')
+    logging.info('Completed: {}, failed: {}, elapsed time: {:.2f}s'.format(len(results) - failed, failed, elapsed))
+
+    return 1 if failed else 0
+
+
+def worker(argv):
+    """
+    Entry point for the pynb worker command
+    :param argv: command line arguments
+    :return:
+    """
+
+    parser = argparse.ArgumentParser(prog='pynb worker', description='Execute notebooks received from a coordinator')
+    parser.add_argument('address', help='ZeroMQ address of coordinator, e.g. tcp://HOST:5555')
+    parser.add_argument('--cache-dir', default='/tmp', help='directory of execution cache, possibly shared')
+    parser.add_argument('--heartbeat-interval', default=5, type=float, help='seconds between heartbeats')
+    parser.add_argument('--coordinator-timeout', default=60, type=float,
+                        help='seconds after which a silent coordinator is considered lost')
+    parser.add_argument('--log-level', help='set log level')
+    args = parser.parse_args(argv)
+
+    if args.log_level:
+        logging.getLogger().setLevel(logging.getLevelName(args.log_level))
+
+    try:
+        Worker(args.address, heartbeat_interval=args.heartbeat_interval, cache_dir=args.cache_dir,
+               coordinator_timeout=args.coordinator_timeout).run()
+    except RuntimeError as e:
+        fatal(e)
@@ -0,0 +1,629 @@
+"""
+Notebook exporters
+"""
+
+import base64
+import copy
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+
+import nbconvert
+import nbformat as nbf
+from nbconvert import HTMLExporter
+
+from pynb.store import SPILLED_KEY
+from pynb.utils import temp_pathname
+
+# Images that can be referenced by the HTML templates as external files, and their extensions
+ASSET_EXTENSIONS = {'image/png': 'png', 'image/jpeg': 'jpg'}
+
+# Non-text MIME types whose payloads are split into lines in .ipynb files, as in nbformat
+SPLIT_MIMES = {'application/javascript', 'image/svg+xml'}
+
+
+def split_mimebundle(data):
+    """
+    Split multi-line payloads of MIME bundle into lines, as nbformat.v4.rwbase.split_lines
+    :param data: MIME bundle
+    :return: copy of MIME bundle
+    """
+
+    data = dict(data)
+
+    for mime, payload in data.items():
+        if isinstance(payload, str) and (mime.startswith('text/') or mime in SPLIT_MIMES):
+            data[mime] = payload.splitlines(True)
+
+    return data
+
+
+def split_cell_lines(cell):
+    """
+    Split multi-line strings of cell into lines, as nbformat.v4.rwbase.split_lines. Only the source and
+    the containers of split strings are copied, the cell is not modified.
+    :param cell: notebook cell
+    :return: cell as dict
+    """
+
+    cell = dict(cell)
+
+    if isinstance(cell.get('source'), str):
+        cell['source'] = cell['source'].splitlines(True)
+
+    if 'attachments' in cell:
+        cell['attachments'] = {name: split_mimebundle(data) for name, data in cell['attachments'].items()}
+
+    if cell.get('cell_type') == 'code':
+        outputs = []
+        for out in cell['outputs']:
+            if out.get('output_type') in {'execute_result', 'display_data'} and 'data' in out:
+                out = dict(out, data=split_mimebundle(out['data']))
+            elif out.get('output_type') == 'stream' and isinstance(out.get('text'), str):
+                out = dict(out, text=out['text'].splitlines(True))
+            outputs.append(out)
+        cell['outputs'] = outputs
+
+    return cell
+
+
+def dumps_cell(cell, compact=False):
+    """
+    Serialize cell as in .ipynb files
+    :param cell: notebook cell
+    :param compact: serialize without indentation and without splitting multi-line strings (optional)
+    :return: JSON string
+    """
+
+    if compact:
+        if 'trusted' in cell.metadata:
+            cell = copy.copy(cell)
+            cell.metadata = {k: v for k, v in cell.metadata.items() if k != 'trusted'}
+        return json.dumps(cell, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+    cell = split_cell_lines(cell)
+    if 'trusted' in cell['metadata']:
+        cell['metadata'] = {k: v for k, v in cell['metadata'].items() if k != 'trusted'}
+    return json.dumps(cell, sort_keys=True, indent=1, separators=(',', ': '), ensure_ascii=False)
+
+
+def dumps_footer(nb, compact=False):
+    """
+    Serialize the end of the list of cells and the notebook fields following it
+    :param nb: notebook
+    :param compact: serialize without indentation (optional)
+    :return: JSON string
+    """
+
+    metadata = {k: v for k, v in nb.metadata.items() if k not in ['orig_nbformat', 'orig_nbformat_minor', 'signature']}
+
+    if compact:
+        return '],"metadata":{},"nbformat":{},"nbformat_minor":{}}}\n'.format(
+            json.dumps(metadata, sort_keys=True, separators=(',', ':'), ensure_ascii=False),
+            nb.nbformat, nb.nbformat_minor)
+
+    return '\n ],\n "metadata": {},\n "nbformat": {},\n "nbformat_minor": {}\n}}\n'.format(
+        json.dumps(metadata, sort_keys=True, indent=1, separators=(',', ': '), ensure_ascii=False).replace('\n', '\n '),
+        nb.nbformat, nb.nbformat_minor)
+
+
+def join_cells(nb, cells, compact=False):
+    """
+    Join serialized cells into serialized notebook
+    :param nb: notebook
+    :param cells: list of cells serialized with dumps_cell
+    :param compact: cells serialized without indentation (optional)
+    :return: JSON string
+    """
+
+    if compact:
+        return '{"cells":[' + ','.join(cells) + dumps_footer(nb, compact=True)
+
+    return '{\n "cells": [\n' + ',\n'.join('  ' + cell.replace('\n', '\n  ') for cell in cells) + dumps_footer(nb)
+
+
+def dumps_notebook(nb, compact=False):
+    """
+    Serialize notebook. If not compact, the result is identical to nbformat.write, without validation
+    and without copying the notebook.
+    :param nb: notebook
+    :param compact: serialize without indentation and without splitting multi-line strings (optional)
+    :return: JSON string
+    """
+
+    return join_cells(nb, [dumps_cell(cell, compact) for cell in nb.cells], compact)
+
+
+def dumps_pynb_cell(cell):
+    """
+    Serialize cell as part of a Python notebook
+    :param cell: notebook cell
+    :return: Python source
+    """
+
+    s = ''
+
+    if cell.cell_type == 'markdown':
+        s += "    '''\n"
+        for line in cell.source.splitlines():
+            s += '    {}\n'.format(line)
+        s += "    '''\n"
+    elif cell.cell_type == 'code':
+        for line in cell.source.splitlines():
+            s += '    {}\n'.format(line)
+    else:
+        raise Exception('Unknown cell type: {}'.format(cell.cell_type))
+
+    s += "\n    '''\n    '''\n\n"
+
+    return s
+
+
+def dumps_pynb(nb):
+    """
+    Serialize notebook as Python notebook
+    :param nb: notebook
+    :return: Python source
+    """
+
+    return 'def cells():\n' + ''.join(dumps_pynb_cell(cell) for cell in nb.cells)
+
+
+class IncrementalNotebookWriter:
+    """
+    Write .ipynb file, updating it in place as cells are executed.
+
+    Cells are serialized once when the writer is created. When a cell is updated,
+    only that cell is serialized again and the file is rewritten starting from the
+    position of that cell. Since cells are executed in order, the already executed
+    cells at the beginning of the file are never serialized or written again.
+    """
+
+    def __init__(self, nb, pathname):
+        """
+        Initialize writer and write notebook
+        :param nb: notebook
+        :param pathname: output filename
+        """
+
+        self.pathname = pathname
+        self.path = os.path.dirname(os.path.abspath(pathname))
+        self.header = b'{\n "cells": [\n'
+        self.parts = [self.dumps_part(cell, i, len(nb.cells)) for i, cell in enumerate(nb.cells)]
+        self.footer = dumps_footer(nb).encode('utf-8')
+
+        # self.parts[:self.index] have been written and start at offset self.offset
+        self.index = 0
+        self.offset = len(self.header)
+
+        with open(self.pathname, 'wb') as f:
+            f.write(self.header)
+            self.write_tail(f)
+
+    def dumps_part(self, cell, cell_index, cells_count):
+        """
+        Serialize cell as part of the list of cells
+        :param cell: notebook cell
+        :param cell_index: cell index
+        :param cells_count: number of cells in notebook
+        :return: bytes
+        """
+
+        s = '  ' + dumps_cell(relink_spilled_cell(cell, self.path)).replace('\n', '\n  ')
+        if cell_index < cells_count - 1:
+            s += ',\n'
+        return s.encode('utf-8')
+
+    def write_tail(self, f):
+        """
+        Write cells starting from self.index and footer
+        :param f: file opened for writing, positioned at self.offset
+        :return:
+        """
+
+        for part in self.parts[self.index:]:
+            f.write(part)
+        f.write(self.footer)
+        f.truncate()
+
+    def update(self, cell_index, cell):
+        """
+        Update cell in file. Cells must be updated in increasing cell index order.
+        :param cell_index: cell index
+        :param cell: cell with updated outputs
+        :return:
+        """
+
+        # cells between self.index and cell_index are unchanged: skip them
+        self.offset += sum(len(part) for part in self.parts[self.index:cell_index])
+        self.index = cell_index
+        self.parts[cell_index] = self.dumps_part(cell, cell_index, len(self.parts))
+
+        with open(self.pathname, 'r+b') as f:
+            f.seek(self.offset)
+            self.write_tail(f)
+
+
+def extract_assets(nb, pathname):
+    """
+    Write images to the assets directory of an HTML file, named after their content hash,
+    and reference them from the outputs.
+    :param nb: notebook
+    :param pathname: pathname of HTML file, images are written to directory PATHNAME_files
+    :return: copy of notebook referencing the extracted images, sharing the cells and outputs without images
+    """
+
+    dirname = '{}_files'.format(os.path.splitext(os.path.basename(pathname))[0])
+    path = os.path.join(os.path.dirname(pathname), dirname)
+
+    cells = []
+
+    for cell in nb.cells:
+        if any(mime in out.get('data', {}) for out in cell.get('outputs', []) for mime in ASSET_EXTENSIONS):
+            cell = copy.copy(cell)
+            cell.outputs = [extract_output_assets(out, path, dirname) for out in cell.outputs]
+        cells.append(cell)
+
+    nb = copy.copy(nb)
+    nb.cells = cells
+
+    return nb
+
+
+def extract_output_assets(out, path, dirname):
+    """
+    Write images of output to the assets directory, see extract_assets
+    :param out: cell output
+    :param path: assets directory
+    :param dirname: name of assets directory
+    :return: copy of output referencing the extracted images, the output itself if without images
+    """
+
+    if not any(mime in out.get('data', {}) for mime in ASSET_EXTENSIONS):
+        return out
+
+    out = copy.copy(out)
+    out.data = copy.copy(out.data)
+    out.metadata = copy.copy(out.get('metadata', {}))
+    out.metadata['filenames'] = copy.copy(out.metadata.get('filenames', {}))
+
+    for mime, ext in ASSET_EXTENSIONS.items():
+        if mime not in out.data:
+            continue
+
+        data = base64.b64decode(out.data[mime])
+        fname = '{}.{}'.format(hashlib.sha256(data).hexdigest()[:16], ext)
+
+        if not os.path.isfile(os.path.join(path, fname)):
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, fname), 'wb') as f:
+                f.write(data)
+
+        out.metadata['filenames'][mime] = '{}/{}'.format(dirname, fname)
+        # the template references the file and ignores the payload
+        out.data[mime] = ''
+
+    return out
+
+
+def html_cache_supported():
+    """
+    Check if CachedHTMLExporter supports the installed nbconvert, whose templates it relies on
+    :return: True if supported
+    """
+
+    return int(nbconvert.__version__.split('.')[0]) < 6
+
+
+def relink_spilled(nb, pathname):
+    """
+    Link spilled outputs relatively to the directory of an exported notebook, see pynb.store.spill_outputs
+    :param nb: notebook
+    :param pathname: pathname of exported notebook, '-' for standard output (links are kept absolute)
+    :return: copy of notebook with relative links, sharing the cells without spilled outputs
+    """
+
+    if pathname == '-':
+        return nb
+
+    path = os.path.dirname(os.path.abspath(pathname))
+
+    nb = copy.copy(nb)
+    nb.cells = [relink_spilled_cell(cell, path) for cell in nb.cells]
+
+    return nb
+
+
+def relink_spilled_cell(cell, path):
+    """
+    Link spilled outputs of cell relatively to directory path, see relink_spilled
+    :param cell: notebook cell
+    :param path: directory of exported notebook
+    :return: copy of cell with relative links, the cell itself if without spilled outputs
+    """
+
+    if not any(SPILLED_KEY in out.get('metadata', {}) for out in cell.get('outputs', [])):
+        return cell
+
+    cell = copy.copy(cell)
+    cell.outputs = [relink_spilled_output(out, path) for out in cell.outputs]
+
+    return cell
+
+
+def relink_spilled_output(out, path):
+    """
+    Link spilled output relatively to directory path, see relink_spilled
+    :param out: cell output
+    :param path: directory of exported notebook
+    :return: copy of output with relative link, the output itself if not a link to a spilled output
+    """
+
+    pathname = out.get('metadata', {}).get(SPILLED_KEY)
+    if pathname is None:
+        return out
+
+    link = os.path.relpath(pathname, path)
+
+    out = copy.copy(out)
+    out.data = {mime: payload.replace(pathname, link) for mime, payload in out.data.items()}
+
+    return out
+
+
+class CachedHTMLExporter:
+    """
+    Export notebooks to HTML rendering each cell separately, caching the rendered HTML of each cell.
+
+    The page is obtained by rendering the notebook without cells with the full template, and inserting
+    the cells rendered with the basic template. Rendered cells are cached on disk, keyed on the cell
+    (source, outputs, metadata) and on the notebook metadata: exporting again a notebook renders only
+    new or modified cells. The least recently used renderings are evicted when their total size exceeds
+    max_size. The insertion point of the cells is specific to the templates of nbconvert 5.
+    """
+
+    container = '<div class="container" id="notebook-container">\n'
+
+    def __init__(self, path='/tmp/pynb-cache-html', max_size=256 << 20):
+        """
+        Initialize exporter
+        :param path: directory of rendered HTML cache
+        :param max_size: maximum total size of rendered HTML in bytes
+        """
+
+        if not html_cache_supported():
+            raise RuntimeError('Cached HTML export requires nbconvert < 6, found {}'.format(nbconvert.__version__))
+
+        self.path = path
+        self.max_size = max_size
+        self.full_exporter = HTMLExporter()
+        self.basic_exporter = HTMLExporter(template_file='basic')
+
+    def cached(self, key, render):
+        """
+        Get rendered HTML from cache, rendering and caching it if missing
+        :param key: cache key
+        :param render: function returning rendered HTML
+        :return: rendered HTML
+        """
+
+        pathname = os.path.join(self.path, '{}.html'.format(hashlib.sha256(key.encode('utf-8')).hexdigest()))
+
+        try:
+            with open(pathname, encoding='utf-8') as f:
+                body = f.read()
+            os.utime(pathname)
+            return body
+        except FileNotFoundError:
+            pass
+
+        body = render()
+
+        os.makedirs(self.path, exist_ok=True)
+        tmp_pathname = temp_pathname(pathname)
+        with open(tmp_pathname, 'w', encoding='utf-8') as f:
+            f.write(body)
+        os.replace(tmp_pathname, pathname)
+
+        return body
+
+    def evict(self):
+        """
+        Remove least recently used renderings until their total size is at most max_size
+        :return: number of renderings removed
+        """
+
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.html'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+
+        for _, size, pathname in sorted(entries):
+            if total <= self.max_size:
+                break
+
+            try:
+                os.remove(pathname)
+            except FileNotFoundError:
+                # removed by another process
+                pass
+
+            total -= size
+            removed += 1
+
+        return removed
+
+    def render_cell(self, nb, cell):
+        """
+        Render cell with the basic template
+        :param nb: notebook without cells
+        :param cell: cell
+        :return: rendered HTML
+        """
+
+        # HTMLExporter copies the notebook before rendering it
+        nb = copy.copy(nb)
+        nb.cells = [cell]
+        return self.basic_exporter.from_notebook_node(nb)[0].strip()
+
+    def from_notebook_node(self, nb):
+        """
+        Export notebook to HTML
+        :param nb: notebook
+        :return: (rendered HTML, resources) tuple, as HTMLExporter.from_notebook_node
+        """
+
+        shell = copy.copy(nb)
+        shell.cells = []
+        metadata = json.dumps(nb.metadata, sort_keys=True)
+
+        page = self.cached('page {}'.format(metadata), lambda: self.full_exporter.from_notebook_node(shell)[0])
+        cells = [self.cached('cell {} {}'.format(metadata, dumps_cell(cell)), lambda: self.render_cell(shell, cell))
+                 for cell in nb.cells]
+
+        if os.path.isdir(self.path):
+            self.evict()
+
+        pos = page.index(self.container) + len(self.container)
+        return page[:pos] + '\n'.join(cells) + page[pos:], {}
+
+
+# HTML exporters are created once per thread and reused, so that templates are loaded and compiled once
+_html_exporters = threading.local()
+
+
+def get_html_exporter(cache=False, cache_dir='/tmp'):
+    """
+    Get HTML exporter
+    :param cache: get CachedHTMLExporter instead of HTMLExporter (optional)
+    :param cache_dir: cache directory, rendered cells are cached in its directory pynb-cache-html (optional)
+    :return: exporter
+    """
+
+    if not hasattr(_html_exporters, 'exporters'):
+        _html_exporters.exporters = {}
+
+    path = os.path.join(cache_dir, 'pynb-cache-html') if cache else None
+
+    if path not in _html_exporters.exporters:
+        _html_exporters.exporters[path] = CachedHTMLExporter(path) if cache else HTMLExporter()
+
+    return _html_exporters.exporters[path]
+
+
+def write_output(pathname, s):
+    """
+    Write string to file
+    :param pathname: output filename, '-' for standard output
+    :param s: string
+    :return:
+    """
+
+    if pathname == '-':
+        sys.__stdout__.write(s)
+    else:
+        with open(pathname, 'w', encoding='utf-8') as f:
+            f.write(s)
+
+
+class NotebookExporter:
+    """
+    Export notebooks to .ipynb, .html and Python notebook formats
+    """
+
+    def __init__(self, validate=True, compact=False, cache_dir='/tmp'):
+        """
+        Initialize exporter
+        :param validate: validate notebooks before exporting them to .ipynb format (optional)
+        :param compact: export to .ipynb format without indentation (optional)
+        :param cache_dir: cache directory of rendered HTML cells (optional)
+        """
+
+        self.validate = validate
+        self.compact = compact
+        self.cache_dir = cache_dir
+
+    def validate_notebook(self, nb):
+        """
+        Validate notebook, logging validation errors as nbformat.write
+        :param nb: notebook
+        :return:
+        """
+
+        if self.validate:
+            try:
+                nbf.validate(nb)
+            except nbf.ValidationError as e:
+                logging.error('Notebook JSON is invalid: {}'.format(e))
+
+    def dumps_ipynb(self, nb):
+        """
+        Export notebook to .ipynb format
+        :param nb: notebook
+        :return: JSON string
+        """
+
+        self.validate_notebook(nb)
+        return dumps_notebook(nb, self.compact)
+
+    def dumps_html(self, nb, assets_pathname=None, cache=False):
+        """
+        Export notebook to .html format
+        :param nb: notebook
+        :param assets_pathname: write images to directory of HTML file assets_pathname, instead of inlining them (optional)
+        :param cache: render each cell separately, reusing cached renderings of unchanged cells (optional)
+        :return: HTML string
+        """
+
+        if assets_pathname:
+            nb = extract_assets(nb, assets_pathname)
+
+        (body, resources) = get_html_exporter(cache, self.cache_dir).from_notebook_node(nb)
+
+        return body
+
+    def export(self, nb, html=None, ipynb=None, pynb=None, html_assets=False, html_cache=False):
+        """
+        Export notebook to several formats, serializing the cells for the .ipynb and Python notebook
+        formats in a single pass
+        :param nb: notebook
+        :param html: .html output filename (optional)
+        :param ipynb: .ipynb output filename (optional)
+        :param pynb: Python notebook output filename (optional)
+        :param html_assets: write images to directory HTML_files, instead of inlining them (optional)
+        :param html_cache: render each cell separately, reusing cached renderings of unchanged cells (optional)
+        :return:
+        """
+
+        ipynb_cells = []
+        pynb_cells = []
+
+        # spilled outputs are linked relatively to the exported notebooks
+        ipynb_nb = relink_spilled(nb, ipynb) if ipynb else nb
+
+        for cell, ipynb_cell in zip(nb.cells, ipynb_nb.cells):
+            if ipynb:
+                ipynb_cells.append(dumps_cell(ipynb_cell, self.compact))
+            if pynb:
+                pynb_cells.append(dumps_pynb_cell(cell))
+
+        if html:
+            write_output(html, self.dumps_html(relink_spilled(nb, html), assets_pathname=html if html_assets else None,
+                                               cache=html_cache))
+            logging.info("HTML notebook exported to '{}'".format(html))
+
+        if ipynb:
+            self.validate_notebook(nb)
+            write_output(ipynb, join_cells(nb, ipynb_cells, self.compact))
+            logging.info("Jupyter notebook exported to '{}'".format(ipynb))
+
+        if pynb:
+            write_output(pynb, 'def cells():\n' + ''.join(pynb_cells))
+            logging.info("Python notebook exported to '{}'".format(pynb))
@@ -0,0 +1,71 @@
+"""
+Transfer of variables from the shell executing a notebook to pynb, pickled with dill and pickle protocol 5
+"""
+
+import dill
+
+# Target name of the comm messages carrying variables from kernels
+TARGET_NAME = 'pynb.fetch'
+
+
+def dumps(values):
+    """
+    Serialize values with dill and pickle protocol 5, keeping large buffers such as the data of numpy
+    arrays out of band, so that they are transferred as binary buffers without copies or encoding.
+    Objects defined by cells are serialized by value.
+    :param values: values to serialize
+    :return: (pickle bytes, list of buffers) tuple
+    """
+
+    buffers = []
+    data = dill.dumps(values, protocol=5, buffer_callback=buffers.append)
+
+    return data, [buffer.raw() for buffer in buffers]
+
+
+def loads(data, buffers):
+    """
+    Deserialize values serialized by dumps
+    :param data: pickle bytes
+    :param buffers: list of buffers, used without copies: objects rebuilt on read-only buffers, such as
+                    numpy arrays, are read-only
+    :return: values
+    """
+
+    return dill.loads(data, buffers=buffers)
+
+
+def collect(namespace, names):
+    """
+    Collect variables from namespace
+    :param namespace: dict
+    :param names: names of variables
+    :return: dict of variables
+    """
+
+    for name in names:
+        if name not in namespace:
+            raise NameError("name '{}' is not defined".format(name))
+
+    return {name: namespace[name] for name in names}
+
+
+def send(names):
+    """
+    Send variables of the iPython kernel to pynb, as buffers of a comm message. Called by code injected
+    in the kernel.
+    :param names: names of variables
+    :return:
+    """
+
+    import IPython
+
+    try:
+        from comm import create_comm
+    except ImportError:
+        from ipykernel.comm import Comm as create_comm
+
+    data, buffers = dumps(collect(IPython.get_ipython().user_ns, names))
+
+    comm = create_comm(target_name=TARGET_NAME, data={'names': names}, buffers=[data] + buffers)
+    comm.close()
@@ -0,0 +1,491 @@
+"""
+In-memory checkpoints of execution state, as parked copies of a shell process created with os.fork (Linux)
+"""
+
+import atexit
+import collections
+import ctypes
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import traceback
+
+import nbformat as nbf
+
+# prctl option making orphaned descendants children of the calling process
+PR_SET_CHILD_SUBREAPER = 36
+
+
+def send_message(f, msg):
+    """
+    Send JSON message
+    :param f: file object of socket
+    :param msg: message as dict
+    :return:
+    """
+
+    f.write(json.dumps(msg, default=str).encode('utf-8') + b'\n')
+    f.flush()
+
+
+def recv_message(f):
+    """
+    Receive JSON message
+    :param f: file object of socket
+    :return: message as dict
+    """
+
+    line = f.readline()
+    if not line:
+        raise EOFError('Connection closed')
+
+    return json.loads(line.decode('utf-8'))
+
+
+def fork_detached():
+    """
+    Fork a process with a double fork: the intermediate process exits immediately, and the new process
+    is reparented to the nearest subreaper (the helper process started by ForkCheckpoints), which reaps it
+    when killed.
+    :return: pid of new process in the calling process, 0 in the new process
+    """
+
+    r, w = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        os.close(r)
+        pid = os.fork()
+        if pid == 0:
+            os.close(w)
+            return 0
+        os.write(w, str(pid).encode('ascii'))
+        os._exit(0)
+
+    os.close(w)
+    os.waitpid(pid, 0)
+
+    with os.fdopen(r, 'rb') as f:
+        return int(f.read())
+
+
+class ForkWorker:
+    """
+    Shell process executing cells for a ForkCheckpoints controller. On checkpoint requests, the worker forks
+    a parked copy of itself. When activated by SIGUSR1, a parked copy forks a new worker resuming from its state
+    and stays parked, so that the same checkpoint can be activated again. On snapshot requests, the worker forks
+    a copy of itself dumping the session with dill, while the worker executes the next cells.
+    """
+
+    def __init__(self, address, controller_pid):
+        """
+        Initialize worker
+        :param address: pathname of Unix socket of controller
+        :param controller_pid: pid of controller
+        """
+
+        from pynb.shell import ShellExecutor
+
+        self.address = address
+        self.controller_pid = controller_pid
+        self.executor = ShellExecutor()
+
+    def serve(self):
+        """
+        Connect to controller and serve its requests, exiting when the connection is closed
+        :return:
+        """
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.address)
+        f = sock.makefile('rwb')
+        send_message(f, {'pid': os.getpid()})
+
+        while True:
+            try:
+                msg = recv_message(f)
+            except (EOFError, OSError):
+                os._exit(0)
+
+            if msg['op'] == 'execute':
+                reply, outputs = self.executor.execute(msg['source'], msg.get('store_history', True))
+                send_message(f, {'reply': reply, 'outputs': outputs})
+
+            elif msg['op'] == 'fetch':
+                self.fetch(f, msg['names'])
+
+            elif msg['op'] == 'snapshot':
+                send_message(f, {'pid': self.snapshot(msg['pathname'], msg['tmp_pathname'])})
+
+            elif msg['op'] == 'wait':
+                send_message(f, {'statuses': [os.waitpid(pid, 0)[1] for pid in msg['pids']]})
+
+            elif msg['op'] == 'load_session':
+                send_message(f, self.load_session(msg['pathname']))
+
+            elif msg['op'] == 'reset':
+                self.executor.reset(new_session=False)
+                self.executor.shell.execution_count += 1
+                send_message(f, {})
+
+            elif msg['op'] == 'checkpoint':
+                # block activation signals before forking, so that none is lost by the parked copy
+                signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGUSR1])
+                pid = fork_detached()
+                if pid == 0:
+                    f.close()
+                    sock.close()
+                    self.park()
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGUSR1])
+                send_message(f, {'pid': pid})
+
+    def fetch(self, f, names):
+        """
+        Send variables to controller: a message with the sizes of the pickle and of its out-of-band buffers,
+        followed by their bytes
+        :param f: file object of socket
+        :param names: names of variables
+        :return:
+        """
+
+        from pynb.fetch import collect, dumps
+
+        try:
+            with self.executor.user_main():
+                data, buffers = dumps(collect(self.executor.shell.user_ns, names))
+        except Exception as e:
+            send_message(f, {'error': '{}: {}'.format(type(e).__name__, e)})
+            return
+
+        send_message(f, {'sizes': [len(data)] + [buffer.nbytes for buffer in buffers]})
+
+        for buffer in [data] + buffers:
+            f.write(buffer)
+        f.flush()
+
+    def snapshot(self, pathname, tmp_pathname):
+        """
+        Dump session in a forked copy of the worker, which writes it to tmp_pathname, renames it to pathname
+        when complete and exits. The serialization error, if any, is written to pathname + '.err'.
+        The copy is a child of the worker, reaped by wait requests.
+        :param pathname: pathname of session
+        :param tmp_pathname: pathname of temporary file
+        :return: pid of forked copy
+        """
+
+        # as the cells injected in kernels to dump sessions, snapshots increment the execution count
+        self.executor.shell.execution_count += 1
+
+        pid = os.fork()
+
+        if pid == 0:
+            status = 0
+            try:
+                self.executor.dump_session(tmp_pathname)
+                os.replace(tmp_pathname, pathname)
+            except BaseException:
+                status = 1
+                with open('{}.err'.format(pathname), 'w') as f:
+                    f.write(traceback.format_exc())
+            finally:
+                os._exit(status)
+
+        return pid
+
+    def load_session(self, pathname):
+        """
+        Load session dumped with dill
+        :param pathname: pathname of session
+        :return: response as dict, with the error if any
+        """
+
+        response = {}
+
+        try:
+            self.executor.load_session(pathname)
+        except Exception:
+            response['error'] = traceback.format_exc()
+
+        self.executor.shell.execution_count += 1
+
+        return response
+
+    def park(self):
+        """
+        Wait for activation signals, exiting if the controller terminates
+        :return:
+        """
+
+        while True:
+            sig = signal.sigtimedwait([signal.SIGUSR1], 1.0)
+
+            try:
+                os.kill(self.controller_pid, 0)
+            except ProcessLookupError:
+                os._exit(0)
+
+            if sig is not None and fork_detached() == 0:
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGUSR1])
+                self.serve()
+
+
+def run_helper(address, controller_pid):
+    """
+    Run helper process of a ForkCheckpoints controller: the helper becomes the subreaper of its descendants,
+    starts the first shell process and reaps the shell processes and parked copies when they exit. The helper
+    exits when all of them have exited, e.g. after the controller terminates.
+    :param address: pathname of Unix socket of controller
+    :param controller_pid: pid of controller
+    :return:
+    """
+
+    # parked copies and shell processes are reparented to the helper when their parents exit
+    try:
+        ctypes.CDLL(None).prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0)
+    except (OSError, AttributeError):
+        pass
+
+    if os.fork() == 0:
+        ForkWorker(address, controller_pid).serve()
+
+    while True:
+        try:
+            os.wait()
+        except ChildProcessError:
+            os._exit(0)
+
+
+class ForkCheckpoints:
+    """
+    Execute cells in a shell process and checkpoint its state in memory by forking parked copies of it.
+    Thanks to copy-on-write, checkpoints are nearly free and work with any object, including objects that
+    cannot be serialized. Restoring a checkpoint replaces the shell process with a new copy of the parked one.
+    At most max_forks checkpoints are kept, evicting the least recently used.
+    """
+
+    def __init__(self, max_forks=8, cwd=None, env=None):
+        """
+        Start shell process
+        :param max_forks: maximum number of checkpoints
+        :param cwd: working directory of shell process (optional)
+        :param env: environment of shell process, by default the one of the current process (optional)
+        """
+
+        self.max_forks = max_forks
+        self.forks = collections.OrderedDict()
+        self.closed = False
+
+        self.path = tempfile.mkdtemp(prefix='pynb-forks-')
+        self.address = os.path.join(self.path, 'socket')
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.address)
+        self.listener.listen(1)
+        self.listener.settimeout(60)
+
+        # helper process reaping the shell processes and the parked copies, see run_helper
+        self.process = subprocess.Popen([sys.executable, '-m', 'pynb.forks', self.address, str(os.getpid())],
+                                        cwd=cwd, env=env)
+        atexit.register(self.shutdown)
+
+        self.accept()
+
+        # checkpoint of the clean shell, used to reset the state
+        self.start_pid = self.request({'op': 'checkpoint'})['pid']
+
+    def accept(self):
+        """
+        Accept connection of new shell process
+        :return:
+        """
+
+        try:
+            self.conn, _ = self.listener.accept()
+        except socket.timeout:
+            raise RuntimeError('Shell process not started')
+
+        self.file = self.conn.makefile('rwb')
+        self.pid = recv_message(self.file)['pid']
+
+    def request(self, msg):
+        """
+        Send request to shell process and wait for the response
+        :param msg: request as dict
+        :return: response as dict
+        """
+
+        send_message(self.file, msg)
+        return recv_message(self.file)
+
+    def execute(self, source, store_history=True):
+        """
+        Execute cell
+        :param source: cell source
+        :param store_history: store the cell in history and increment the execution count (optional)
+        :return: (reply, outputs) tuple, as returned by ExecutePreprocessor.run_cell
+        """
+
+        response = self.request({'op': 'execute', 'source': source, 'store_history': store_history})
+        return response['reply'], nbf.from_dict(response['outputs'])
+
+    def fetch(self, names):
+        """
+        Fetch variables from shell process
+        :param names: names of variables
+        :return: dict of variables
+        """
+
+        from pynb.fetch import loads
+
+        response = self.request({'op': 'fetch', 'names': names})
+        if 'error' in response:
+            raise RuntimeError('Cannot fetch variables: {}'.format(response['error']))
+
+        # buffers are read in place, and used as they are by the unpickled objects
+        buffers = []
+        for size in response['sizes']:
+            buffer = bytearray(size)
+            if self.file.readinto(buffer) != size:
+                raise EOFError('Connection closed')
+            buffers.append(buffer)
+
+        return loads(buffers[0], buffers[1:])
+
+    def dump_session_async(self, pathname, tmp_pathname):
+        """
+        Dump session of shell process in the background, from a forked copy of it. Thanks to copy-on-write,
+        forking is nearly free and the shell process executes the next cells while the session is dumped.
+        :param pathname: pathname of session
+        :param tmp_pathname: pathname of temporary file, renamed to pathname when complete
+        :return: pid of dumping process, to be waited for with wait
+        """
+
+        return self.request({'op': 'snapshot', 'pathname': pathname, 'tmp_pathname': tmp_pathname})['pid']
+
+    def wait(self, pids):
+        """
+        Wait for dumping processes to exit
+        :param pids: pids of dumping processes
+        :return: list of exit statuses, as returned by os.waitpid
+        """
+
+        return self.request({'op': 'wait', 'pids': pids})['statuses']
+
+    def load_session(self, pathname):
+        """
+        Load session dumped with dill in shell process
+        :param pathname: pathname of session
+        :return:
+        """
+
+        response = self.request({'op': 'load_session', 'pathname': pathname})
+        if 'error' in response:
+            raise RuntimeError('Cannot load session {}: {}'.format(pathname, response['error']))
+
+    def reset_session(self):
+        """
+        Remove all variables of shell process, keeping its execution count
+        :return:
+        """
+
+        self.request({'op': 'reset'})
+
+    def checkpoint(self, key):
+        """
+        Checkpoint current state
+        :param key: checkpoint key
+        :return:
+        """
+
+        if key in self.forks:
+            self.kill(self.forks.pop(key))
+
+        self.forks[key] = self.request({'op': 'checkpoint'})['pid']
+
+        while len(self.forks) > self.max_forks:
+            evicted_key, pid = self.forks.popitem(last=False)
+            logging.debug('Evicting checkpoint {}'.format(evicted_key))
+            self.kill(pid)
+
+    def has_checkpoint(self, key):
+        """
+        Check if checkpoint exists
+        :param key: checkpoint key
+        :return: True if the checkpoint exists
+        """
+
+        return key in self.forks
+
+    def restore(self, key):
+        """
+        Restore checkpoint
+        :param key: checkpoint key
+        :return:
+        """
+
+        self.forks.move_to_end(key)
+        self.activate(self.forks[key])
+
+    def reset(self):
+        """
+        Restore the state of a clean shell
+        :return:
+        """
+
+        self.activate(self.start_pid)
+
+    def activate(self, pid):
+        """
+        Replace shell process with a new copy of a parked process
+        :param pid: pid of parked process
+        :return:
+        """
+
+        self.file.close()
+        self.conn.close()
+        self.kill(self.pid)
+
+        os.kill(pid, signal.SIGUSR1)
+        self.accept()
+
+    def kill(self, pid):
+        """
+        Kill process, reaped by the helper process
+        :param pid: pid
+        :return:
+        """
+
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def shutdown(self):
+        """
+        Kill shell process and parked processes
+        :return:
+        """
+
+        if self.closed:
+            return
+
+        self.closed = True
+
+        for pid in [self.pid, self.start_pid] + list(self.forks.values()):
+            self.kill(pid)
+
+        self.process.kill()
+        self.process.wait()
+
+        self.forks.clear()
+        self.listener.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    run_helper(sys.argv[1], int(sys.argv[2]))
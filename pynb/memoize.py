@@ -0,0 +1,247 @@
+"""
+Persistent memoization of functions called inside cells, across executions, cells and parameter values
+"""
+
+import ast
+import functools
+import hashlib
+import inspect
+import logging
+import marshal
+import os
+import pickle
+import struct
+import textwrap
+
+from pynb.utils import temp_pathname
+
+# Environment variable set by pynb to the cache directory in the environment of kernels
+CACHE_DIR_ENV = 'PYNB_CACHE_DIR'
+
+# Cache directory of the notebook executed by the in-process shell, which shares the environment of pynb
+shell_cache_dir = None
+
+# Header of result files: magic, size of pickle, number of out-of-band buffers
+HEADER = struct.Struct('<8sQI')
+MAGIC = b'PYNBMEMO'
+
+
+def kernel_env(cache_dir):
+    """
+    Get environment of a process executing cells, e.g. a kernel, whose memoized functions use cache_dir
+    :param cache_dir: cache directory
+    :return: copy of the environment of the current process, with the cache directory
+    """
+
+    return dict(os.environ, **{CACHE_DIR_ENV: cache_dir})
+
+
+def pickle_value(value):
+    """
+    Serialize value with pickle protocol 5, keeping large buffers such as the data of numpy arrays
+    out of band, so that they are hashed and written without copies
+    :param value: value to serialize
+    :return: (pickle bytes, list of buffers) tuple
+    """
+
+    buffers = []
+    data = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+
+    return data, [buffer.raw() for buffer in buffers]
+
+
+def func_digest(func):
+    """
+    Get digest of the definition of function: its source if available, ignoring decorators, comments and
+    formatting, its bytecode otherwise
+    :param func: function
+    :return: bytes
+    """
+
+    try:
+        source = textwrap.dedent(inspect.getsource(func))
+    except (OSError, TypeError):
+        source = None
+
+    if source is None:
+        code = marshal.dumps(func.__code__)
+    else:
+        try:
+            tree = ast.parse(source)
+            for node in tree.body:
+                if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    node.decorator_list = []
+            code = ast.dump(tree).encode('utf-8')
+        except SyntaxError:
+            code = source.encode('utf-8')
+
+    return hashlib.sha256('{}.{}'.format(func.__module__, func.__qualname__).encode('utf-8') + code).digest()
+
+
+class MemoStore:
+    """
+    Directory of memoized results, one file per result, evicting the least recently used results when
+    their total size exceeds max_size. Results are written atomically and can be shared by processes.
+    """
+
+    def __init__(self, path, max_size=1 << 30):
+        """
+        Initialize store
+        :param path: directory of results
+        :param max_size: maximum total size of results in bytes
+        """
+
+        self.path = path
+        self.max_size = max_size
+
+    def pathname(self, key):
+        """
+        Get pathname of result
+        :param key: result key
+        :return: pathname
+        """
+
+        return os.path.join(self.path, '{}.memo'.format(key))
+
+    def load(self, key):
+        """
+        Load result, marking it as recently used
+        :param key: result key
+        :return: (True, value) tuple if found, (False, None) otherwise
+        """
+
+        pathname = self.pathname(key)
+
+        try:
+            with open(pathname, 'rb') as f:
+                content = bytearray(os.fstat(f.fileno()).st_size)
+                f.readinto(content)
+        except FileNotFoundError:
+            return False, None
+
+        magic, size, count = HEADER.unpack_from(content)
+        if magic != MAGIC:
+            raise ValueError('Not a memoized result: {}'.format(pathname))
+
+        # out-of-band buffers are views of the file content: numpy arrays are rebuilt without copies
+        view = memoryview(content)
+        offset = HEADER.size + 8 * count
+        lengths = struct.unpack_from('<{}Q'.format(count), content, HEADER.size)
+
+        data = view[offset:offset + size]
+        offset += size
+
+        buffers = []
+        for length in lengths:
+            buffers.append(view[offset:offset + length])
+            offset += length
+
+        os.utime(pathname)
+
+        return True, pickle.loads(data, buffers=buffers)
+
+    def dump(self, key, value):
+        """
+        Store result, evicting least recently used results if needed
+        :param key: result key
+        :param value: result
+        :return: bytes written
+        """
+
+        data, buffers = pickle_value(value)
+
+        os.makedirs(self.path, exist_ok=True)
+        pathname = self.pathname(key)
+        tmp_pathname = temp_pathname(pathname)
+
+        with open(tmp_pathname, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(data), len(buffers)))
+            f.write(struct.pack('<{}Q'.format(len(buffers)), *[buffer.nbytes for buffer in buffers]))
+            f.write(data)
+            for buffer in buffers:
+                f.write(buffer)
+
+        os.replace(tmp_pathname, pathname)
+        self.evict()
+
+        return os.path.getsize(pathname)
+
+    def evict(self):
+        """
+        Remove least recently used results until their total size is at most max_size
+        :return: number of results removed
+        """
+
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.memo'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+
+        for _, size, pathname in sorted(entries):
+            if total <= self.max_size:
+                break
+
+            try:
+                os.remove(pathname)
+            except FileNotFoundError:
+                # removed by another process
+                pass
+
+            total -= size
+            removed += 1
+
+        return removed
+
+
+def memoize(func=None, max_size=1 << 30, cache_dir=None):
+    """
+    Decorator memoizing the results of a function in the pynb cache directory, across executions, cells
+    and parameter values. Results are keyed on the source of the function and on its arguments: changes
+    to globals or to other functions called by the function are not detected. Usable as @memoize or
+    @memoize(max_size=...).
+    :param func: function to memoize
+    :param max_size: maximum total size of the memoized results in the cache directory, in bytes (optional)
+    :param cache_dir: cache directory, by default the one of the execution or /tmp (optional)
+    :return: memoized function
+    """
+
+    if func is None:
+        return functools.partial(memoize, max_size=max_size, cache_dir=cache_dir)
+
+    digest = func_digest(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        path = os.path.join(cache_dir or shell_cache_dir or os.environ.get(CACHE_DIR_ENV, '/tmp'), 'pynb-cache-memo')
+        store = MemoStore(path, max_size)
+
+        try:
+            data, buffers = pickle_value((args, sorted(kwargs.items())))
+        except Exception as e:
+            logging.warning('Cannot memoize {}, arguments not serializable: {}'.format(func.__qualname__, e))
+            return func(*args, **kwargs)
+
+        h = hashlib.sha256(digest)
+        h.update(data)
+        for buffer in buffers:
+            h.update(buffer)
+        key = h.hexdigest()
+
+        found, value = store.load(key)
+        if found:
+            return value
+
+        value = func(*args, **kwargs)
+
+        try:
+            store.dump(key, value)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            logging.warning('Cannot memoize {}, result not serializable: {}'.format(func.__qualname__, e))
+
+        return value
+
+    return wrapper
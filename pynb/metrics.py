@@ -0,0 +1,239 @@
+"""
+Cache effectiveness metrics of notebook executions, and database of metrics across executions
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from pynb.chunks import ChunkStore
+from pynb.utils import temp_pathname
+
+# Metrics of an execution: (name, Prometheus help text)
+FIELDS = [('hits', 'Cells loaded from cache'),
+          ('misses', 'Cells executed and cached'),
+          ('bytes_read', 'Bytes read from cache'),
+          ('bytes_written', 'Bytes written to cache'),
+          ('seconds_saved', 'Execution time saved by cache hits in seconds'),
+          ('exec_time', 'Execution time of notebook in seconds')]
+
+
+class CacheMetrics:
+    """
+    Cache effectiveness metrics of a notebook execution. Seconds saved are computed as the original
+    execution time of cells loaded from cache, minus the time spent loading them.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.seconds_saved = 0.0
+        self.exec_time = 0.0
+
+    def hit(self, metadata, load_time, size):
+        """
+        Record cache hit
+        :param metadata: metadata of cache entry
+        :param load_time: seconds spent loading the cell value
+        :param size: bytes read
+        :return:
+        """
+
+        self.hits += 1
+        self.bytes_read += size
+
+        if 'exec_time' in metadata:
+            self.seconds_saved += max(metadata['exec_time'] - load_time, 0)
+
+    def to_dict(self):
+        """
+        Get metrics as dict
+        :return: dict
+        """
+
+        return {name: getattr(self, name) for name, _ in FIELDS}
+
+    def dumps_prometheus(self, notebook):
+        """
+        Format metrics in Prometheus text exposition format
+        :param notebook: notebook name, used as label
+        :return: string
+        """
+
+        lines = []
+        label = json.dumps(notebook)
+
+        for name, text in FIELDS:
+            lines.append('# HELP pynb_cache_{} {}'.format(name, text))
+            lines.append('# TYPE pynb_cache_{} gauge'.format(name))
+            lines.append('pynb_cache_{}{{notebook={}}} {}'.format(name, label, getattr(self, name)))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, pathname, notebook):
+        """
+        Write metrics to file, in Prometheus textfile format if pathname ends with .prom, in JSON otherwise.
+        The file is replaced atomically, as expected by the textfile collector of the Prometheus node exporter.
+        :param pathname: pathname of metrics file
+        :param notebook: notebook name
+        :return:
+        """
+
+        if pathname.endswith('.prom'):
+            content = self.dumps_prometheus(notebook)
+        else:
+            content = json.dumps(dict(self.to_dict(), notebook=notebook, timestamp=time.time()), indent=2)
+
+        tmp_pathname = temp_pathname(pathname)
+        with open(tmp_pathname, 'w') as f:
+            f.write(content)
+        os.replace(tmp_pathname, pathname)
+
+
+class StatsDB:
+    """
+    SQLite database of the cache metrics of notebook executions, one row per execution
+    """
+
+    def __init__(self, pathname):
+        """
+        Open database, creating it if needed
+        :param pathname: pathname of database
+        """
+
+        self.conn = sqlite3.connect(pathname, timeout=30)
+
+        # counters are integers, times are floats
+        metrics = CacheMetrics()
+        columns = ['{} {}'.format(name, 'REAL' if isinstance(getattr(metrics, name), float) else 'INTEGER')
+                   for name, _ in FIELDS]
+
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS runs (timestamp REAL, notebook TEXT, {})'.format(
+                ', '.join(columns)))
+
+    def record(self, notebook, metrics):
+        """
+        Record metrics of an execution
+        :param notebook: notebook name
+        :param metrics: CacheMetrics instance
+        :return:
+        """
+
+        values = metrics.to_dict()
+
+        with self.conn:
+            self.conn.execute('INSERT INTO runs VALUES (?, ?, {})'.format(', '.join('?' * len(FIELDS))),
+                              [time.time(), notebook] + [values[name] for name, _ in FIELDS])
+
+    def query(self, notebook=None):
+        """
+        Get totals of metrics by notebook
+        :param notebook: only notebooks whose name contains this string (optional)
+        :return: list of dicts with keys notebook, runs and metric names, sorted by notebook
+        """
+
+        sql = 'SELECT notebook, COUNT(*), {} FROM runs WHERE notebook LIKE ? GROUP BY notebook ORDER BY notebook'
+        rows = self.conn.execute(sql.format(', '.join('SUM({})'.format(name) for name, _ in FIELDS)),
+                                 ['%{}%'.format(notebook or '')])
+
+        return [dict(zip(['notebook', 'runs'] + [name for name, _ in FIELDS], row)) for row in rows]
+
+    def close(self):
+        self.conn.close()
+
+
+def stats_pathname(cache_dir):
+    """
+    Get pathname of the stats database of a cache directory
+    :param cache_dir: cache directory
+    :return: pathname
+    """
+
+    return os.path.join(cache_dir, 'pynb-cache-stats.db')
+
+
+def record_run(cache_dir, notebook, metrics):
+    """
+    Record metrics of an execution in the stats database of the cache directory, logging failures
+    :param cache_dir: cache directory
+    :param notebook: notebook name
+    :param metrics: CacheMetrics instance
+    :return:
+    """
+
+    try:
+        db = StatsDB(stats_pathname(cache_dir))
+        db.record(notebook, metrics)
+        db.close()
+    except sqlite3.Error as e:
+        logging.warning('Cannot record cache metrics: {}'.format(e))
+
+
+def cache(argv):
+    """
+    Entry point for the pynb cache command
+    :param argv: command line arguments
+    :return: exit status
+    """
+
+    parser = argparse.ArgumentParser(prog='pynb cache', description='Inspect the execution cache')
+    parser.add_argument('command', choices=['stats', 'gc'],
+                        help='stats: print cache metrics by notebook, gc: free session chunks not referred to')
+    parser.add_argument('--cache-dir', default='/tmp', help='directory of execution cache')
+    parser.add_argument('--notebook', help='only notebooks whose name contains this string')
+    parser.add_argument('--json', action='store_true', default=False, help='print metrics as JSON')
+    args = parser.parse_args(argv)
+
+    chunks = ChunkStore(os.path.join(args.cache_dir, 'pynb-cache-chunks'))
+
+    if args.command == 'gc':
+        freed, freed_bytes = chunks.gc(args.cache_dir)
+        print('Freed {} chunks, {:.2f} MB'.format(freed, freed_bytes / 1e6))
+        return 0
+
+    pathname = stats_pathname(args.cache_dir)
+    rows = []
+
+    if os.path.isfile(pathname):
+        db = StatsDB(pathname)
+        rows = db.query(args.notebook)
+        db.close()
+
+    files = [f for f in glob.glob(os.path.join(args.cache_dir, 'pynb-cache-*')) if os.path.isfile(f)]
+    files += glob.glob(os.path.join(args.cache_dir, 'pynb-cache-blobs', '*', '*'))
+    files += glob.glob(os.path.join(args.cache_dir, 'pynb-cache-chunks', '*', '*'))
+    files += glob.glob(os.path.join(args.cache_dir, 'pynb-cache-memo', '*.memo'))
+    disk_usage = sum(os.path.getsize(f) for f in files)
+
+    num_chunks, stored, referenced = chunks.stats() if os.path.isdir(chunks.path) else (0, 0, 0)
+
+    if args.json:
+        print(json.dumps({'notebooks': rows, 'disk_usage': disk_usage,
+                          'chunks': {'count': num_chunks, 'stored_bytes': stored, 'referenced_bytes': referenced}},
+                         indent=2))
+        return 0
+
+    print('{:<50} {:>6} {:>8} {:>8} {:>9} {:>11} {:>10} {:>10}'.format(
+        'notebook', 'runs', 'hits', 'misses', 'hit rate', 'saved (s)', 'read MB', 'written MB'))
+
+    for row in rows:
+        cells = row['hits'] + row['misses']
+        print('{:<50} {:>6} {:>8} {:>8} {:>9} {:>11.2f} {:>10.2f} {:>10.2f}'.format(
+            row['notebook'][-50:], row['runs'], row['hits'], row['misses'],
+            '{:.1%}'.format(row['hits'] / cells) if cells else '-', row['seconds_saved'],
+            row['bytes_read'] / 1e6, row['bytes_written'] / 1e6))
+
+    print('Cache disk usage: {:.2f} MB in {} files'.format(disk_usage / 1e6, len(files)))
+
+    if num_chunks:
+        print('Session chunks: {} chunks, {:.2f} MB stored for {:.2f} MB of sessions'.format(
+            num_chunks, stored / 1e6, referenced / 1e6))
+
+    return 0
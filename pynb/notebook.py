@@ -1,27 +1,50 @@
 import argparse
-import codecs
+import asyncio
+import collections
+import copy
 import datetime
 import hashlib
 import inspect
+import json
 import logging
 import os
+import re
 import sys
 import time
 import traceback
+import uuid
 import warnings
 
-import dill
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 import nbformat as nbf
+from jupyter_client import KernelManager
 from jupyter_client.kernelspec import KernelSpecManager
-from nbconvert import HTMLExporter
 from nbconvert.preprocessors import ExecutePreprocessor
 from nbconvert.preprocessors.execute import CellExecutionError
 
-from pynb.utils import get_func, fatal, check_isfile
+from pynb.chunks import ChunkStore
+from pynb.deps import LocalModules
+from pynb.fetch import TARGET_NAME as FETCH_TARGET_NAME, collect, loads as fetch_loads
+from pynb.export import IncrementalNotebookWriter, NotebookExporter, dumps_pynb, html_cache_supported
+from pynb.forks import ForkCheckpoints
+import pynb.memoize
+from pynb.memoize import CACHE_DIR_ENV, kernel_env
+from pynb.metrics import CacheMetrics, record_run
+from pynb.store import OutputStore, spill_outputs
+from pynb.utils import get_func, fatal, check_isfile, print_output, read_ahead
 from pynb.version import __version__
 
 logging.basicConfig(level=logging.INFO)
 
+# On MacOS, annoying warning "RuntimeWarning: Failed to set sticky bit on" while starting kernels.
+# Let's suppress it, once for the process: notebooks can be executed concurrently by threads.
+warnings.filterwarnings('ignore', message='Failed to set sticky bit', category=RuntimeWarning)
+
+# Options of Notebook.process selecting how cells are executed instead of a Jupyter kernel, mutually exclusive
+EXECUTORS = ('fork_checkpoints', 'in_process', 'async_snapshots')
+
 
 class CachedExecutePreprocessor(ExecutePreprocessor):
     """
@@ -37,21 +60,156 @@ class CachedExecutePreprocessor(ExecutePreprocessor):
         self.disable_cache = False
         self.ignore_cache = False
         self.uid = None
+        self.cell_results = []
+        self.cell_callback = None
+        self.kernel_used = False
+        self.cell_range = (None, None)
+        self.stream_outputs = False
+        self.streaming = False
+        self.cache_dir = '/tmp'
+        self.local_modules = LocalModules()
+        self.store = OutputStore()
+        self.sessions = ChunkStore('/tmp/pynb-cache-chunks')
+        self.dedup_sessions = False
+        self.max_output_size = None
+        self.spill_dir = 'pynb-outputs'
+        self.async_snapshots = False
+        self.writer = None
+        self.value_writes = []
+        self.prefetched = {}
+        self.metrics = CacheMetrics()
+        self.profile_cells = None
+        self.profile_top = 10
+        self.profile_prefix = 'pynb-profile'
+        self.fetch = None
+        self.fetched = {}
+        self.fetch_buffers = None
+        self.cache_dir_pending = False
+        self.prev_hash = ''
+        # temporary files of session dumps are unique to this executor, also across hosts sharing the cache
+        self.tmp_id = uuid.uuid4().hex
+
+    def reset(self):
+        """
+        Reset execution state, keeping track of the state of the kernel.
+        Used to execute again the notebook on the same kernel.
+        :return:
+        """
+
+        self.cache_valid = True
+        self.prev_fname_session = None
+        self.prev_hash = ''
+        self.cell_results = []
+        self.metrics = CacheMetrics()
+
+    def start_new_kernel(self, **kwargs):
+        """
+        Start kernel, see ExecutePreprocessor.start_new_kernel. Memoized functions of the kernel use the
+        cache directory of the execution.
+        """
 
-    def cell_hash(self, cell, cell_index):
+        return super().start_new_kernel(env=kernel_env(self.cache_dir), **kwargs)
+
+    def preprocess(self, nb, resources=None, km=None):
+        """
+        Execute notebook, see ExecutePreprocessor.preprocess. Kernels started by km have their own environment:
+        the cache directory of memoized functions is set before the first executed cell.
+        """
+
+        self.cache_dir_pending = km is not None
+
+        return super().preprocess(nb, resources, km)
+
+    def cell_hash(self, cell, cell_index, prev_hash=''):
         """
-        Compute cell hash based on cell index and cell content
+        Compute cell hash based on cell index, cell content, content of project-local modules imported by the cell
+        and hash of the previous code cell, so that cells depend on all previous cells, e.g. on injected parameters
         :param cell: cell to be hashed
         :param cell_index: cell index
+        :param prev_hash: hash of the previous code cell (optional)
         :return: hash string
         """
-        s = '{uid} {cell} {index}'.format(uid=self.uid,
-                                          cell=str(cell.source),
-                                          index=cell_index).encode('utf-8')
+        s = '{uid} {cell} {index} {prev}'.format(uid=self.uid,
+                                                 cell=str(cell.source),
+                                                 index=cell_index,
+                                                 prev=prev_hash)
 
-        hash = hashlib.sha1(s).hexdigest()[:8]
+        modules = self.local_modules.digest(cell.source)
+        if modules:
+            # cells importing project-local modules are invalidated if the modules change
+            s += ' {}'.format(modules)
+
+        hash = hashlib.sha1(s.encode('utf-8')).hexdigest()[:8]
         return hash
 
+    def cache_pathnames(self, hash):
+        """
+        Get pathnames of cached session and cached value of cell
+        :param hash: cell hash
+        :return: (fname_session, fname_value) tuple
+        """
+
+        return (os.path.join(self.cache_dir, 'pynb-cache-{}-session.dill'.format(hash)),
+                os.path.join(self.cache_dir, 'pynb-cache-{}-value.json'.format(hash)))
+
+    def prefetch(self, nb, executor):
+        """
+        Read ahead with executor the cached values of the cells expected to be loaded from cache, and the
+        session loaded before executing the first cell not cached, e.g. while the kernel is starting.
+        Values are kept in memory until loaded by run_cell, sessions are read to warm up the page cache.
+        :param nb: notebook to execute
+        :param executor: concurrent.futures executor
+        :return:
+        """
+
+        self.prefetched = {}
+
+        if self.disable_cache or self.ignore_cache:
+            return
+
+        fname_frontier = None
+        hash = ''
+
+        for cell_index, cell in enumerate(nb.cells):
+            if cell.cell_type != 'code':
+                continue
+
+            hash = self.cell_hash(cell, cell_index, hash)
+            fname_session, fname_value = self.cache_pathnames(hash)
+
+            if not self.session_exists(fname_session) or not os.path.isfile(fname_value):
+                if fname_frontier and os.path.isfile(fname_frontier):
+                    executor.submit(read_ahead, fname_frontier)
+                break
+
+            self.prefetched[fname_value] = executor.submit(self.store.load_entry, fname_value)
+            fname_frontier = fname_session
+
+        logging.debug('Prefetching {} cached values'.format(len(self.prefetched)))
+
+    def value_load(self, fname_value):
+        """
+        Load cell value from file, or from memory if prefetched, recording a cache hit
+        :param fname_value: pathname of cached value
+        :return: (reply, outputs) tuple
+        """
+
+        begin = time.perf_counter()
+        future = self.prefetched.pop(fname_value, None)
+        entry = None
+
+        if future is not None:
+            try:
+                entry = future.result()
+            except (OSError, ValueError):
+                # e.g., cache removed meanwhile: read it again to report the error
+                pass
+
+        value, metadata = entry or self.store.load_entry(fname_value)
+        self.metrics.hit(metadata, time.perf_counter() - begin, os.path.getsize(fname_value))
+
+        return value
+
     def run_cell(self, cell, cell_index=0, store_history=True):
         """
         Run cell with caching
@@ -61,120 +219,839 @@ class CachedExecutePreprocessor(ExecutePreprocessor):
         :return:
         """
 
-        hash = self.cell_hash(cell, cell_index)
-        fname_session = '/tmp/pynb-cache-{}-session.dill'.format(hash)
-        fname_value = '/tmp/pynb-cache-{}-value.dill'.format(hash)
-        cell_snippet = str(" ".join(cell.source.split())).strip()[:40]
+        hash = self.cell_hash(cell, cell_index, self.prev_hash)
+        self.prev_hash = hash
+        fname_session, fname_value = self.cache_pathnames(hash)
+        cell_snippet = str(" ".join(cell.source.split())).strip()[:40]
+        begin = time.perf_counter()
+
+        if not self.in_cell_range(cell_index):
+            return self.skip_cell(cell_index, hash, cell_snippet, fname_session, fname_value)
+
+        if self.disable_cache:
+            logging.info('Cell {}: Running: "{}.."'.format(hash, cell_snippet))
+            value = self.limit_outputs(cell, self.run_cell_profiled(cell, cell_index))
+            self.add_cell_result(cell_index, hash, False, begin, value)
+            return value
+
+        if not self.ignore_cache:
+            if self.cache_valid and self.session_exists(fname_session) and os.path.isfile(fname_value):
+                logging.info('Cell {}: Loading: "{}.."'.format(hash, cell_snippet))
+                self.prev_fname_session = fname_session
+                value = self.value_load(fname_value)
+                if self.stream_outputs:
+                    for out in value[1]:
+                        print_output(out)
+                self.add_cell_result(cell_index, hash, True, begin, value)
+                return value
+
+        # If cache does not exist or not valid:
+        #
+        # 1) Invalidate subsequent cell caches
+        # 2) Load session from previous cached cell (if existing)
+        # 3) Run cell
+        # 4) Cache cell session
+        # 5) Cache cell value
+
+        logging.info('Cell {}: Running: "{}.."'.format(hash, cell_snippet))
+
+        # 1) Invalidate subsequent cell caches
+        self.cache_valid = False
+        self.metrics.misses += 1
+
+        # 2) Load session from previous cached cell (if existing and required).
+        self.restore_session(hash)
+
+        # 2) Run cell
+        exec_begin = time.perf_counter()
+        value = self.limit_outputs(cell, self.run_cell_profiled(cell, cell_index))
+        exec_time = time.perf_counter() - exec_begin
+        self.kernel_used = True
+        self.prev_fname_session_loaded = None
+
+        # We make sure that injected cells do not interfere with the cell index...
+        # value[0]['content']['execution_count'] = cell_index
+
+        # 3) Cache cell session
+        cached = self.session_dump(cell, hash, fname_session)
+
+        # 4) Cache cell value, if no errors while dumping the cell session in 3).
+
+        if cached:
+            self.prev_fname_session_loaded = fname_session
+            self.prev_fname_session = fname_session
+
+            logging.debug('Cell {}: dumping value to {}'.format(hash, fname_value))
+
+            self.cache_value(value, fname_session, fname_value, exec_time)
+
+            logging.debug('Cell {}: cached'.format(hash))
+
+        self.add_cell_result(cell_index, hash, False, begin, value)
+
+        return value
+
+    def restore_session(self, hash):
+        """
+        Restore the session of the previous cached cell, if existing and not loaded yet. If the kernel has been
+        used by a previous execution (e.g., in watch mode), reset its state first.
+        :param hash: hash of the cell requiring the session
+        :return:
+        """
+
+        if self.prev_fname_session:
+            if self.prev_fname_session_loaded != self.prev_fname_session:
+                if self.kernel_used:
+                    self.session_reset(hash)
+                self.session_load(hash, self.prev_fname_session)
+        elif self.kernel_used:
+            self.session_reset(hash)
+
+    def run_cell_profiled(self, cell, cell_index):
+        """
+        Run cell, profiling it with cProfile inside the kernel if self.profile_cells is set. Cells running for
+        at least self.profile_cells seconds record their top functions by cumulative time in cell metadata
+        {"pynb": {"profile": ...}}, and their full statistics in file PROFILE_PREFIX-cellN.pstats.
+        :param cell: cell to run
+        :param cell_index: cell index
+        :return: (reply, outputs) tuple
+        """
+
+        if self.cache_dir_pending:
+            self.run_injected('__import__("os").environ[{!r}] = {!r}'.format(CACHE_DIR_ENV, self.cache_dir))
+            self.cache_dir_pending = False
+
+        if self.profile_cells is None:
+            return self.run_cell_streaming(cell, cell_index)
+
+        self.run_injected('__import__("pynb.profiling").profiling.start()')
+
+        begin = time.perf_counter()
+        value = self.run_cell_streaming(cell, cell_index)
+        exec_time = time.perf_counter() - begin
+
+        fname_stats = None
+        if exec_time >= self.profile_cells:
+            fname_stats = os.path.abspath('{}-cell{}.pstats'.format(self.profile_prefix, cell_index))
+
+        # the profiler is stopped anyway, statistics are collected only for slow cells
+        inject_code = 'print(__import__("json").dumps(__import__("pynb.profiling").profiling.stop({!r}, {})))'
+        reply, outputs = self.run_injected(inject_code.format(fname_stats, self.profile_top))
+
+        if reply['content']['status'] != 'ok':
+            logging.warning('Cell {}: profiling failed: {}'.format(cell_index, reply['content'].get('evalue')))
+        elif fname_stats:
+            profile = json.loads(''.join(out.text for out in outputs if out.output_type == 'stream'))
+            profile['pstats'] = fname_stats
+            cell.metadata.setdefault('pynb', {})['profile'] = profile
+            logging.info('Cell {}: profile saved to {}'.format(cell_index, fname_stats))
+
+        return value
+
+    def run_injected(self, source):
+        """
+        Run code injected in the kernel, without storing it in history nor incrementing the execution count
+        :param source: code to run
+        :return: (reply, outputs) tuple
+        """
+
+        return super().run_cell(nbf.v4.new_code_cell(source), store_history=False)
+
+    def fetch_variables(self, names):
+        """
+        Fetch variables from the kernel after the last cell, restoring first the session of the last cell if
+        it has been loaded from cache. Variables are pickled by the kernel with dill and pickle protocol 5, and sent as
+        binary buffers of a comm message: large buffers, such as the data of numpy arrays, are transferred
+        without copies or encoding.
+        :param names: names of variables
+        :return: dict of variables
+        """
+
+        if self.cell_results and self.cell_results[-1]['cached']:
+            self.restore_session(self.cell_results[-1]['hash'])
+            self.prev_fname_session_loaded = self.prev_fname_session
+
+        logging.debug('Fetching variables {}'.format(names))
+        return self.fetch_from_kernel(names)
+
+    def fetch_from_kernel(self, names):
+        """
+        Fetch variables from the kernel in its current state
+        :param names: names of variables
+        :return: dict of variables
+        """
+
+        self.fetch_buffers = None
+        reply, _ = self.run_injected('__import__("pynb.fetch").fetch.send({!r})'.format(list(names)))
+
+        if reply['content']['status'] != 'ok' or self.fetch_buffers is None:
+            raise RuntimeError('Cannot fetch variables: {}: {}'.format(reply['content'].get('ename'),
+                                                                       reply['content'].get('evalue')))
+
+        # received buffers are read-only and used without copies: e.g. fetched numpy arrays are read-only
+        data, buffers = self.fetch_buffers[0], self.fetch_buffers[1:]
+        self.fetch_buffers = None
+
+        return fetch_loads(data, buffers)
+
+    def handle_comm_msg(self, outs, msg, cell_index):
+        """
+        Process comm message, see ExecutePreprocessor.handle_comm_msg. Keeps the buffers of the messages
+        carrying fetched variables.
+        """
+
+        if msg['msg_type'] == 'comm_open' and msg['content'].get('target_name') == FETCH_TARGET_NAME:
+            self.fetch_buffers = msg['buffers']
+            return
+
+        super().handle_comm_msg(outs, msg, cell_index)
+
+    def run_cell_streaming(self, cell, cell_index):
+        """
+        Run cell, printing its outputs to stderr as soon as they are produced if self.stream_outputs is set
+        :param cell: cell to run
+        :param cell_index: cell index
+        :return: (reply, outputs) tuple
+        """
+
+        self.streaming = self.stream_outputs
+        try:
+            return self.execute_cell(cell, cell_index)
+        finally:
+            self.streaming = False
+
+    def execute_cell(self, cell, cell_index):
+        """
+        Execute cell, without caching
+        :param cell: cell to run
+        :param cell_index: cell index
+        :return: (reply, outputs) tuple
+        """
+
+        return super().run_cell(cell, cell_index)
+
+    def limit_outputs(self, cell, value):
+        """
+        Limit size of stream outputs, spilling oversized outputs to files in self.spill_dir.
+        The limit self.max_output_size can be overridden by cell metadata {"pynb": {"max_output_size": N}}
+        or by a comment line "# pynb: max_output_size=N" in the cell.
+        :param cell: executed cell
+        :param value: (reply, outputs) tuple
+        :return: (reply, outputs) tuple
+        """
+
+        max_output_size = cell.metadata.get('pynb', {}).get('max_output_size', self.max_output_size)
+
+        match = re.search(r'^\s*#\s*pynb:\s*max_output_size\s*=\s*(\d+)\s*$', cell.source, re.MULTILINE)
+        if match:
+            max_output_size = int(match.group(1))
+
+        if not max_output_size:
+            return value
+
+        reply, outputs = value
+        return reply, spill_outputs(outputs, max_output_size, self.spill_dir)
+
+    def output(self, outs, msg, display_id, cell_index):
+        """
+        Process output message, see ExecutePreprocessor.output
+        """
+
+        out = super().output(outs, msg, display_id, cell_index)
+
+        if out is not None and self.streaming:
+            print_output(out)
+
+        return out
+
+    def in_cell_range(self, cell_index):
+        """
+        Check if cell is inside the range of cells to execute
+        :param cell_index: cell index
+        :return: True if the cell must be executed
+        """
+
+        first, last = self.cell_range
+        return (first is None or cell_index >= first) and (last is None or cell_index <= last)
+
+    def skip_cell(self, cell_index, hash, cell_snippet, fname_session, fname_value):
+        """
+        Skip cell outside the range of cells to execute, filling its outputs from cache if available.
+        If cached, its session becomes the nearest snapshot restored before executing the next cells.
+        :param cell_index: cell index
+        :param hash: cell hash
+        :param cell_snippet: cell snippet for logging
+        :param fname_session: pathname of cached session
+        :param fname_value: pathname of cached value
+        :return: cached value if available, otherwise no reply and no outputs
+        """
+
+        if not self.disable_cache and self.cache_valid and self.session_exists(fname_session) and \
+                os.path.isfile(fname_value):
+            logging.info('Cell {}: Skipping, loading from cache: "{}.."'.format(hash, cell_snippet))
+            if self.cell_range[0] is not None and cell_index < self.cell_range[0]:
+                self.prev_fname_session = fname_session
+            return self.value_load(fname_value)
+
+        logging.info('Cell {}: Skipping: "{}.."'.format(hash, cell_snippet))
+
+        if self.cell_range[0] is not None and cell_index < self.cell_range[0]:
+            logging.warning('Cell {}: not cached, state of subsequent cells might be incomplete'.format(hash))
+
+        # Caches of subsequent cells might depend on a different version of this cell
+        self.cache_valid = False
+
+        return None, []
+
+    def add_cell_result(self, cell_index, hash, cached, begin, value):
+        """
+        Record the result of a cell execution
+        :param cell_index: cell index
+        :param hash: cell hash
+        :param cached: True if the cell value has been loaded from cache
+        :param begin: time.perf_counter() value taken before running the cell
+        :param value: (reply, outputs) tuple returned by run_cell
+        :return:
+        """
+
+        reply, outputs = value
+
+        result = {'cell_index': cell_index,
+                  'hash': hash,
+                  'cached': cached,
+                  'exec_time': time.perf_counter() - begin,
+                  'status': reply['content']['status'] if reply else None,
+                  'outputs': outputs}
+
+        self.cell_results.append(result)
+
+        if self.cell_callback:
+            self.cell_callback(result)
+
+    def session_exists(self, fname_session):
+        """
+        Check if session has been cached
+        :param fname_session: pathname to dumped session
+        :return: True if the session can be loaded
+        """
+
+        return self.sessions.exists(fname_session)
+
+    def session_load(self, hash, fname_session):
+        """
+        Load ipython session from file
+        :param hash: cell hash
+        :param fname_session: pathname to dumped session
+        :return:
+        """
+
+        logging.debug('Cell {}: loading session from {}'.format(hash, fname_session))
+
+        self.metrics.bytes_read += self.sessions.size(fname_session)
+
+        # 'dill.settings["recurse"] = True',
+        # 'dill.settings["byref"] = True',
+
+        with self.sessions.open_session(fname_session) as pathname:
+            inject_code = ['import dill',
+                           'dill.load_session(filename="{}")'.format(pathname),
+                           ]
+
+            inject_cell = nbf.v4.new_code_cell('\n'.join(inject_code))
+            super().run_cell(inject_cell)
+
+        self.kernel_used = True
+
+    def session_reset(self, hash):
+        """
+        Reset ipython session, removing all variables
+        :param hash: cell hash
+        :return:
+        """
+
+        logging.debug('Cell {}: resetting session'.format(hash))
+
+        inject_cell = nbf.v4.new_code_cell("get_ipython().magic('reset -f')")
+        super().run_cell(inject_cell)
+        self.prev_fname_session_loaded = None
+        self.kernel_used = False
+
+    def session_dump(self, cell, hash, fname_session):
+        """
+        Dump ipython session to file
+        :param hash: cell hash
+        :param fname_session: output filename
+        :return:
+        """
+
+        logging.debug('Cell {}: Dumping session to {}'.format(hash, fname_session))
+
+        # the session is written to a temporary file renamed when complete, so that executions sharing
+        # the cache directory never load a partial session
+        fname_tmp = self.session_tmp_pathname(fname_session)
+
+        inject_code = ['import dill',
+                       'dill.dump_session(filename="{}")'.format(fname_tmp),
+                       '__import__("os").replace("{}", "{}")'.format(fname_tmp, fname_session),
+                       ]
+
+        inject_cell = nbf.v4.new_code_cell('\n'.join(inject_code))
+        reply, outputs = super().run_cell(inject_cell)
+
+        errors = list(filter(lambda out: out.output_type == 'error', outputs))
+        if len(errors):
+            self.serialization_failed(hash, fname_session, CellExecutionError.from_cell_and_msg(cell, errors[0]))
+            return False
+
+        self.metrics.bytes_written += self.session_store(fname_session)
+
+        return True
+
+        # fname_session has been created in the filesystem of the system running the kernel,
+        # which is the same of the system that is managing the execution of the notebook.
+
+    def session_tmp_pathname(self, fname_session):
+        """
+        Get pathname of the temporary file of a session dump, renamed to fname_session when complete
+        :param fname_session: pathname of session
+        :return: temporary pathname
+        """
+
+        return '{}.{}.tmp'.format(fname_session, self.tmp_id)
+
+    def session_store(self, fname_session):
+        """
+        Store dumped session, splitting it into deduplicated chunks if self.dedup_sessions is set
+        :param fname_session: pathname of dumped session
+        :return: bytes written to cache
+        """
+
+        if self.dedup_sessions:
+            return self.sessions.put(fname_session)
+
+        return os.path.getsize(fname_session)
+
+    def serialization_failed(self, hash, fname_session, error):
+        """
+        Disable the cache for subsequent cells after a failed session dump, removing the partial session
+        :param hash: cell hash
+        :param fname_session: pathname of session
+        :param error: serialization error
+        :return:
+        """
+
+        logging.info('Cell {}: Warning: serialization failed, cache disabled'.format(hash))
+        logging.debug('Cell {}: Serialization error: {}'.format(hash, error))
+
+        # disable attempts to retrieve cache for subsequent cells
+        self.disable_cache = True
+
+        # remove partial cache for current cell, and cache of previous executions
+        self.sessions.remove(fname_session)
+        fname_tmp = self.session_tmp_pathname(fname_session)
+        if os.path.isfile(fname_tmp):
+            os.remove(fname_tmp)
+
+    def wait_snapshots(self, fnames=None):
+        """
+        Wait for background cell value writes to complete
+        :param fnames: pathnames of sessions to wait for, dumped in the background by subclasses (optional)
+        :return:
+        """
+
+        for future in self.value_writes:
+            self.metrics.bytes_written += future.result()
+        self.value_writes = []
+
+    def cache_value(self, value, fname_session, fname_value, exec_time):
+        """
+        Cache cell value, recording the execution time of the cell and the size of its session in the metadata
+        of the cache entry
+        :param value: (reply, outputs) tuple
+        :param fname_session: pathname of the session dumped after the cell
+        :param fname_value: output filename
+        :param exec_time: execution time of the cell in seconds
+        :return:
+        """
+
+        self.value_dump(value, fname_value, {'exec_time': exec_time, 'session_size': self.sessions.size(fname_session)})
+
+    def value_dump(self, value, fname_value, metadata):
+        """
+        Dump cell value to file, in the background if self.async_snapshots is set
+        :param value: (reply, outputs) tuple
+        :param fname_value: output filename
+        :param metadata: metadata of cache entry
+        :return:
+        """
+
+        if not self.async_snapshots:
+            self.metrics.bytes_written += self.store.dump(value, fname_value, metadata)
+            return
+
+        if self.writer is None:
+            self.writer = ThreadPoolExecutor(max_workers=1)
+
+        self.value_writes.append(self.writer.submit(self.store.dump, value, fname_value, metadata))
+
+    def preprocess_cell(self, cell, resources, cell_index, **kwargs):
+        """
+        Execute cell, see ExecutePreprocessor.preprocess_cell. Background writes are completed after
+        the last cell or a failed cell, before the kernel is shut down.
+        """
+
+        try:
+            cell, resources = super().preprocess_cell(cell, resources, cell_index, **kwargs)
+        except CellExecutionError:
+            self.wait_snapshots()
+            raise
+
+        if cell_index == len(self.nb.cells) - 1:
+            self.wait_snapshots()
+
+        # variables are fetched before the kernel is shut down
+        if self.fetch and cell_index == len(self.nb.cells) - 1:
+            self.fetched = self.fetch_variables(self.fetch)
+
+        return cell, resources
+
+    def shutdown(self):
+        """
+        Release resources kept across executions
+        :return:
+        """
+
+        if self.writer is not None:
+            self.writer.shutdown()
+            self.writer = None
+
+
+class ForkExecutePreprocessor(CachedExecutePreprocessor):
+    """
+    Execute cells in a process running an iPython shell instead of a Jupyter kernel, checkpointing its
+    state in memory with os.fork instead of dumping sessions with dill (Linux only). Checkpoints are
+    identified by the pathnames of the sessions they replace, and live as long as the preprocessor:
+    they speed up executions on the same preprocessor, e.g. in watch mode.
+    """
+
+    def __init__(self, max_forks=8, **kwargs):
+        super().__init__(**kwargs)
+
+        self.max_forks = max_forks
+        self.forks = None
+        self.reset_pending = False
+
+    def preprocess(self, nb, resources=None, km=None):
+        """
+        Execute notebook, see ExecutePreprocessor.preprocess. The kernel manager km is ignored.
+        """
+
+        # imported here, not to import iPython when executing notebooks with kernels
+        from pynb.shell import LANGUAGE_INFO
+
+        if self.forks is None:
+            self.forks = ForkCheckpoints(self.max_forks, cwd=resources['metadata']['path'],
+                                         env=kernel_env(self.cache_dir))
+
+        self.log.info('Executing notebook with iPython shell and fork checkpoints')
+        self.nb = nb
+        nb, resources = super(ExecutePreprocessor, self).preprocess(nb, resources)
+        nb.metadata['language_info'] = LANGUAGE_INFO
+
+        return nb, resources
+
+    def execute_cell(self, cell, cell_index):
+        """
+        Execute cell in shell process
+        :param cell: cell to run
+        :param cell_index: cell index
+        :return: (reply, outputs) tuple
+        """
+
+        self.apply_reset()
+        reply, outputs = self.forks.execute(cell.source)
+        cell.execution_count = reply['content']['execution_count']
+
+        if self.streaming:
+            for out in outputs:
+                print_output(out)
+
+        return reply, outputs
+
+    def apply_reset(self):
+        """
+        Reset the state of the shell process, if a reset is pending
+        :return:
+        """
+
+        if self.reset_pending:
+            self.forks.reset()
+            self.reset_pending = False
+
+    def run_injected(self, source):
+        self.apply_reset()
+        return self.forks.execute(source, store_history=False)
+
+    def fetch_from_kernel(self, names):
+        self.apply_reset()
+        return self.forks.fetch(names)
+
+    def session_exists(self, fname_session):
+        return self.forks is not None and self.forks.has_checkpoint(fname_session)
+
+    def session_load(self, hash, fname_session):
+        logging.debug('Cell {}: restoring checkpoint of {}'.format(hash, fname_session))
+        self.forks.restore(fname_session)
+        self.reset_pending = False
+        self.kernel_used = True
+
+    def session_reset(self, hash):
+        # restoring a checkpoint replaces the shell process: reset only if no checkpoint is restored
+        logging.debug('Cell {}: resetting session'.format(hash))
+        self.reset_pending = True
+        self.prev_fname_session_loaded = None
+        self.kernel_used = False
+
+    def session_dump(self, cell, hash, fname_session):
+        logging.debug('Cell {}: checkpointing session as {}'.format(hash, fname_session))
+        self.forks.checkpoint(fname_session)
+        return True
+
+    def cache_value(self, value, fname_session, fname_value, exec_time):
+        # checkpoints are kept in memory, their size is unknown
+        self.value_dump(value, fname_value, {'exec_time': exec_time})
+
+    def shutdown(self):
+        super().shutdown()
+
+        if self.forks is not None:
+            self.forks.shutdown()
+            self.forks = None
+
+
+class SnapshotExecutePreprocessor(ForkExecutePreprocessor):
+    """
+    Execute cells in a process running an iPython shell instead of a Jupyter kernel, dumping sessions with dill
+    in the background (Linux only): after each cell, the shell process forks a copy of itself that dumps the
+    session and exits, while the shell process executes the next cell. The shell process is single-threaded,
+    and can be forked safely. Cell values are written to the cache by a background thread.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        self.async_snapshots = True
+        self.snapshots = collections.OrderedDict()
+        self.pending_values = {}
+
+    def preprocess(self, nb, resources=None, km=None):
+        """
+        Execute notebook, see ExecutePreprocessor.preprocess. The kernel manager km is ignored.
+        """
+
+        # imported here, not to import iPython when executing notebooks with kernels
+        from pynb.shell import LANGUAGE_INFO
+
+        if self.forks is None:
+            self.forks = ForkCheckpoints(0, cwd=resources['metadata']['path'], env=kernel_env(self.cache_dir))
+
+        self.log.info('Executing notebook with iPython shell and background snapshots')
+        self.nb = nb
+        nb, resources = super(ExecutePreprocessor, self).preprocess(nb, resources)
+        nb.metadata['language_info'] = LANGUAGE_INFO
+
+        return nb, resources
+
+    def session_exists(self, fname_session):
+        if fname_session in self.snapshots:
+            self.wait_snapshots([fname_session])
+
+        return self.sessions.exists(fname_session)
+
+    def session_load(self, hash, fname_session):
+        logging.debug('Cell {}: loading session from {}'.format(hash, fname_session))
+
+        if fname_session in self.snapshots:
+            self.wait_snapshots([fname_session])
+
+        with self.sessions.open_session(fname_session) as pathname:
+            self.forks.load_session(pathname)
+
+        self.metrics.bytes_read += self.sessions.size(fname_session)
+        self.kernel_used = True
+
+    def session_reset(self, hash):
+        logging.debug('Cell {}: resetting session'.format(hash))
+        self.forks.reset_session()
+        self.prev_fname_session_loaded = None
+        self.kernel_used = False
+
+    def session_dump(self, cell, hash, fname_session):
+        # collect failed dumps, so that the cache is disabled as soon as possible
+        failed = [fname for fname in self.snapshots if os.path.isfile(fname + '.err')]
+        if failed:
+            self.wait_snapshots(failed)
+        if self.disable_cache:
+            return False
+
+        logging.debug('Cell {}: Dumping session to {} in the background'.format(hash, fname_session))
+
+        fname_tmp = self.session_tmp_pathname(fname_session)
+        self.snapshots[fname_session] = hash, self.forks.dump_session_async(fname_session, fname_tmp)
+
+        return True
+
+    def cache_value(self, value, fname_session, fname_value, exec_time):
+        # written when the background dump of the session completes and its size is known
+        self.pending_values[fname_session] = value, fname_value, exec_time
+
+    def wait_snapshots(self, fnames=None):
+        """
+        Wait for background session dumps and cell value writes to complete. Failed dumps disable the cache
+        for subsequent cells, as synchronous dumps do, and the values of their cells are not cached.
+        :param fnames: pathnames of sessions to wait for (optional, default: all)
+        :return:
+        """
+
+        fnames = [fname for fname in (fnames or list(self.snapshots)) if fname in self.snapshots]
 
-        if self.disable_cache:
-            logging.info('Cell {}: Running: "{}.."'.format(hash, cell_snippet))
-            return super().run_cell(cell, cell_index)
+        if fnames:
+            pids = [self.snapshots[fname][1] for fname in fnames]
+            logging.debug('Waiting for background dumps of processes {}'.format(pids))
 
-        if not self.ignore_cache:
-            if self.cache_valid and os.path.isfile(fname_session) and os.path.isfile(fname_value):
-                logging.info('Cell {}: Loading: "{}.."'.format(hash, cell_snippet))
-                self.prev_fname_session = fname_session
-                with open(fname_value, 'rb') as f:
-                    value = dill.load(f)
-                    return value
+            for fname, status in zip(fnames, self.forks.wait(pids)):
+                hash, pid = self.snapshots.pop(fname)
+                pending_value = self.pending_values.pop(fname, None)
+                fname_err = '{}.err'.format(fname)
 
-        # If cache does not exist or not valid:
-        #
-        # 1) Invalidate subsequent cell caches
-        # 2) Load session from previous cached cell (if existing)
-        # 3) Run cell
-        # 4) Cache cell session
-        # 5) Cache cell value
+                if status == 0:
+                    self.metrics.bytes_written += self.session_store(fname)
+                    if pending_value is not None:
+                        value, fname_value, exec_time = pending_value
+                        CachedExecutePreprocessor.cache_value(self, value, fname, fname_value, exec_time)
+                    continue
 
-        logging.info('Cell {}: Running: "{}.."'.format(hash, cell_snippet))
+                error = 'dumping process exited with status {}'.format(status)
+                if os.path.isfile(fname_err):
+                    with open(fname_err) as f:
+                        error = f.read()
+                    os.remove(fname_err)
 
-        # 1) Invalidate subsequent cell caches
-        self.cache_valid = False
+                self.serialization_failed(hash, fname, error)
 
-        # 2) Load session from previous cached cell (if existing and required)
-        if self.prev_fname_session:
-            if self.prev_fname_session_loaded != self.prev_fname_session:
-                self.session_load(hash, self.prev_fname_session)
+        super().wait_snapshots()
 
-        # 2) Run cell
-        value = super().run_cell(cell, cell_index)
 
-        # We make sure that injected cells do not interfere with the cell index...
-        # value[0]['content']['execution_count'] = cell_index
+class ShellExecutePreprocessor(CachedExecutePreprocessor):
+    """
+    Execute cells with an iPython shell running in the current process instead of a Jupyter kernel,
+    avoiding the startup of a kernel process and the ZeroMQ round trips of each cell. Meant for trusted,
+    non-interactive executions: cells run in the process of pynb. Since the shell is shared by the process,
+    notebooks using it are executed one at a time.
+    """
 
-        # 3) Cache cell session
-        cached = self.session_dump(cell, hash, fname_session)
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
 
-        # 4) Cache cell value, if no errors while dumping the cell session in 3).
+        self.executor = None
 
-        if cached:
-            self.prev_fname_session_loaded = fname_session
-            self.prev_fname_session = fname_session
+    def preprocess(self, nb, resources=None, km=None):
+        """
+        Execute notebook, see ExecutePreprocessor.preprocess. The kernel manager km is ignored.
+        """
 
-            logging.debug('Cell {}: dumping value to {}'.format(hash, fname_value))
+        # imported here, not to import iPython when executing notebooks with kernels
+        from pynb.shell import LANGUAGE_INFO, ShellExecutor
 
-            with open(fname_value, 'wb') as f:
-                dill.dump(value, f)
+        if self.executor is None:
+            self.executor = ShellExecutor()
 
-            logging.debug('Cell {}: cached'.format(hash))
+        with ShellExecutor.lock:
+            if ShellExecutor.owner is not self:
+                # the shell has been used by another preprocessor: start from a clean state
+                self.executor.reset()
+                ShellExecutor.owner = self
+                self.prev_fname_session_loaded = None
+                self.kernel_used = False
 
-        return value
+            self.log.info('Executing notebook with in-process iPython shell')
+            self.nb = nb
+            pynb.memoize.shell_cache_dir = self.cache_dir
+            try:
+                nb, resources = super(ExecutePreprocessor, self).preprocess(nb, resources)
+            finally:
+                pynb.memoize.shell_cache_dir = None
+            nb.metadata['language_info'] = LANGUAGE_INFO
 
-    def session_load(self, hash, fname_session):
+        return nb, resources
+
+    def execute_cell(self, cell, cell_index):
         """
-        Load ipython session from file
-        :param hash: cell hash
-        :param fname_session: pathname to dumped session
-        :return:
+        Execute cell in the in-process shell
+        :param cell: cell to run
+        :param cell_index: cell index
+        :return: (reply, outputs) tuple
         """
 
-        logging.debug('Cell {}: loading session from {}'.format(hash, fname_session))
-
-        # 'dill.settings["recurse"] = True',
-        # 'dill.settings["byref"] = True',
+        reply, outputs = self.executor.execute(cell.source)
+        cell.execution_count = reply['content']['execution_count']
 
-        inject_code = ['import dill',
-                       'dill.load_session(filename="{}")'.format(fname_session),
-                       ]
+        if self.streaming:
+            for out in outputs:
+                print_output(out)
 
-        inject_cell = nbf.v4.new_code_cell('\n'.join(inject_code))
-        super().run_cell(inject_cell)
+        return reply, outputs
 
-    def session_dump(self, cell, hash, fname_session):
+    def count_injected_cell(self):
         """
-        Dump ipython session to file
-        :param hash: cell hash
-        :param fname_session: output filename
+        Increment the execution count as the cells injected in kernels to load, reset and dump sessions do,
+        so that executed notebooks are identical to those executed by kernels
         :return:
         """
 
-        logging.debug('Cell {}: Dumping session to {}'.format(hash, fname_session))
+        self.executor.shell.execution_count += 1
 
-        inject_code = ['import dill',
-                       'dill.dump_session(filename="{}")'.format(fname_session),
-                       ]
+    def run_injected(self, source):
+        return self.executor.execute(source, store_history=False)
 
-        inject_cell = nbf.v4.new_code_cell('\n'.join(inject_code))
-        reply, outputs = super().run_cell(inject_cell)
+    def fetch_from_kernel(self, names):
+        # no serialization: variables are shared with the shell
+        try:
+            return collect(self.executor.shell.user_ns, names)
+        except NameError as e:
+            raise RuntimeError('Cannot fetch variables: NameError: {}'.format(e))
 
-        errors = list(filter(lambda out: out.output_type == 'error', outputs))
-        if len(errors):
-            logging.info('Cell {}: Warning: serialization failed, cache disabled'.format(hash))
-            logging.debug(
-                'Cell {}: Serialization error: {}'.format(hash, CellExecutionError.from_cell_and_msg(cell, errors[0])))
+    def session_load(self, hash, fname_session):
+        logging.debug('Cell {}: loading session from {}'.format(hash, fname_session))
+        with self.sessions.open_session(fname_session) as pathname:
+            self.executor.load_session(pathname)
+        self.count_injected_cell()
+        self.metrics.bytes_read += self.sessions.size(fname_session)
+        self.kernel_used = True
+
+    def session_reset(self, hash):
+        logging.debug('Cell {}: resetting session'.format(hash))
+        self.executor.reset(new_session=False)
+        self.count_injected_cell()
+        self.prev_fname_session_loaded = None
+        self.kernel_used = False
 
-            # disable attempts to retrieve cache for subsequent cells
-            self.disable_cache = True
+    def session_dump(self, cell, hash, fname_session):
+        logging.debug('Cell {}: Dumping session to {}'.format(hash, fname_session))
+        self.count_injected_cell()
 
-            # remove partial cache for current cell
-            os.remove(fname_session)
+        fname_tmp = self.session_tmp_pathname(fname_session)
 
+        try:
+            self.executor.dump_session(fname_tmp)
+            os.replace(fname_tmp, fname_session)
+        except Exception:
+            self.serialization_failed(hash, fname_session, traceback.format_exc())
             return False
 
-        return True
+        self.metrics.bytes_written += self.session_store(fname_session)
 
-        # fname_session has been created in the filesystem of the system running the kernel,
-        # which is the same of the system that is managing the execution of the notebook.
+        return True
 
 
 class Notebook:
@@ -195,6 +1072,9 @@ class Notebook:
         self.nb['cells'] = []
         self.cells_name = None
         self.args = None
+        self.cell_results = []
+        self.fetched = {}
+        self.ep = None
 
     def add(self, func, **kwargs):
         """
@@ -204,6 +1084,18 @@ class Notebook:
         :return:
         """
 
+        self.check_params(func, kwargs)
+        self.add_cells(func)
+        self.inject_params(kwargs)
+
+    def check_params(self, func, kwargs):
+        """
+        Check that parameters match the parameters of func, exiting otherwise
+        :param func: Python function defining the cells
+        :param kwargs: parameters
+        :return:
+        """
+
         params = set(kwargs.keys())
         func_params = set(inspect.getargspec(func).args)
 
@@ -214,7 +1106,37 @@ class Notebook:
         if params != func_params:
             fatal('Params {} not matching cells function params {}'.format(list(params), list(func_params)))
 
-        lines = inspect.getsourcelines(func)[0][1:]
+    def inject_params(self, kwargs):
+        """
+        Inject parameters as Python cell, if any
+        :param kwargs: parameters
+        :return:
+        """
+
+        if len(kwargs) > 0:
+            # We have parameters to inject into the notebook.
+            # If the first cell is Markdown, assume that is the title and
+            # insert parameters as 2nd cell. Otherwise, as 1st cell.
+            if len(self.nb['cells']) > 0 and self.nb['cells'][0].cell_type == 'markdown':
+                self.add_cell_params(kwargs, 1)
+            else:
+                self.add_cell_params(kwargs, 0)
+
+    def add_cells(self, func):
+        """
+        Parse func's function source code as Python and Markdown cells, without injecting parameters.
+        :param func: Python function to parse
+        :return:
+        """
+
+        self.add_cells_lines(inspect.getsourcelines(func)[0][1:])
+
+    def add_cells_lines(self, lines):
+        """
+        Parse body of cells function as Python and Markdown cells
+        :param lines: source lines of function body
+        :return:
+        """
 
         buffer = ""
         indent_count = None
@@ -255,15 +1177,6 @@ class Notebook:
             else:
                 self.add_cell_markdown(buffer)
 
-        if len(kwargs) > 0:
-            # We have parameters to inject into the notebook.
-            # If the first cell is Markdown, assume that is the title and
-            # insert parameters as 2nd cell. Otherwise, as 1st cell.
-            if len(self.nb['cells']) > 0 and self.nb['cells'][0].cell_type == 'markdown':
-                self.add_cell_params(kwargs, 1)
-            else:
-                self.add_cell_params(kwargs, 0)
-
     def add_cell_params(self, params, pos=None):
         """
         Add cell of Python parameters
@@ -339,29 +1252,96 @@ class Notebook:
         else:
             self.nb['cells'].insert(pos, cell)
 
-    def process(self, uid, add_footer=False, no_exec=False, disable_cache=False, ignore_cache=False):
+    def process(self, uid, add_footer=False, no_exec=False, disable_cache=False, ignore_cache=False, km=None,
+                cell_callback=None, ep=None, cell_range=(None, None), stream_outputs=False, max_output_size=None,
+                spill_dir='pynb-outputs', cache_dir='/tmp', fork_checkpoints=False, max_forks=8,
+                async_snapshots=False, metrics_file=None, in_process=False, dedup_sessions=False,
+                profile_cells=None, profile_top=10, profile_prefix='pynb-profile', fetch=None, cwd='.'):
         """
         Execute notebook
+        :param km: kernel manager of an already started kernel, left running after execution (optional)
+        :param cell_callback: function called with the result of each executed cell (optional)
+        :param ep: preprocessor of a previous execution on the same kernel km, to be reused (optional)
+        :param cell_range: (first, last) indices of cells to execute, inclusive, None if unbounded (optional)
+        :param stream_outputs: print cell outputs to stderr as soon as they are produced (optional)
+        :param max_output_size: maximum size of stream outputs in characters, larger outputs are spilled to files (optional)
+        :param spill_dir: directory of spilled outputs (optional)
+        :param cache_dir: directory of execution cache, possibly shared by several hosts (optional)
+        :param fork_checkpoints: execute cells in an iPython shell with in-memory fork checkpoints, if ep is None (optional)
+        :param max_forks: maximum number of fork checkpoints (optional)
+        :param async_snapshots: execute cells in an iPython shell dumping sessions in the background while
+                                the next cells run, if ep is None (Linux only, optional)
+        :param metrics_file: write cache metrics to this file, in Prometheus textfile format if ending with .prom,
+                             in JSON otherwise (optional)
+        :param in_process: execute cells in an iPython shell running in the current process, if ep is None (optional)
+        :param dedup_sessions: store sessions split into chunks, storing once the chunks shared by sessions (optional)
+        :param profile_cells: profile executed cells with cProfile, saving the profiles of cells running for
+                              at least this number of seconds, None to disable profiling (optional)
+        :param profile_top: number of functions recorded in cell metadata by profiling (optional)
+        :param profile_prefix: prefix of pathnames of .pstats files, followed by -cellN.pstats (optional)
+        :param fetch: names of variables fetched from the kernel after the last cell, available as dict
+                      in self.fetched (optional)
+        :param cwd: working directory of the kernel started by the execution, also searched for project-local
+                    modules; ignored by in-process executions, which share the working directory of the
+                    process (optional)
         :return: self
         """
 
+        selected = [name for name, value in zip(EXECUTORS, [fork_checkpoints, in_process, async_snapshots]) if value]
+        if len(selected) > 1:
+            raise ValueError('Options {} are mutually exclusive'.format(', '.join(selected)))
+
         self.exec_begin = time.perf_counter()
         self.exec_begin_dt = datetime.datetime.now()
 
-        ep = CachedExecutePreprocessor(timeout=None, kernel_name='python3')
+        if ep is None and fork_checkpoints:
+            ep = ForkExecutePreprocessor(max_forks=max_forks, timeout=None, kernel_name='python3')
+        elif ep is None and in_process:
+            ep = ShellExecutePreprocessor(timeout=None, kernel_name='python3')
+        elif ep is None and async_snapshots:
+            ep = SnapshotExecutePreprocessor(timeout=None, kernel_name='python3')
+        elif ep is None:
+            ep = CachedExecutePreprocessor(timeout=None, kernel_name='python3')
+        else:
+            ep.reset()
+
+        self.ep = ep
         ep.disable_cache = disable_cache
         ep.ignore_cache = ignore_cache
         ep.uid = uid
+        ep.cell_callback = cell_callback
+        ep.cell_range = cell_range
+        ep.stream_outputs = stream_outputs
+        ep.max_output_size = max_output_size
+        ep.spill_dir = spill_dir
+        ep.dedup_sessions = dedup_sessions
+        ep.profile_cells = profile_cells
+        ep.profile_top = profile_top
+        ep.profile_prefix = profile_prefix
+        ep.fetch = fetch
+        ep.fetched = {}
+        ep.local_modules = LocalModules(cwd=cwd)
+
+        if ep.cache_dir != cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            ep.cache_dir = cache_dir
+            ep.store = OutputStore(os.path.join(cache_dir, 'pynb-cache-blobs'))
+            ep.sessions = ChunkStore(os.path.join(cache_dir, 'pynb-cache-chunks'))
 
         # Execute the notebook
 
         if not no_exec:
-            with warnings.catch_warnings():
-                # On MacOS, annoying warning "RuntimeWarning: Failed to set sticky bit on"
-                # Let's suppress it.
-                warnings.simplefilter("ignore")
-                ep.preprocess(self.nb, {'metadata': {'path': '.'}})
-
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                # cached values are read while the kernel is starting
+                ep.prefetch(self.nb, executor)
+                try:
+                    ep.preprocess(self.nb, {'metadata': {'path': cwd}}, km=km)
+                finally:
+                    # failed executions are recorded too
+                    self.record_metrics(uid, ep.metrics, disable_cache, cache_dir, metrics_file)
+
+        self.cell_results = ep.cell_results
+        self.fetched = ep.fetched
         self.exec_time = time.perf_counter() - self.exec_begin
 
         if add_footer:
@@ -372,72 +1352,165 @@ class Notebook:
 
         return self
 
-    def export_ipynb(self, pathname):
+    def record_metrics(self, uid, metrics, disable_cache, cache_dir, metrics_file):
         """
-        Export notebook to .ipynb file
-        :param pathname: output filename
+        Log cache metrics of the execution, record them in the stats database of the cache directory and
+        write them to metrics_file
+        :param uid: unique id of the notebook
+        :param metrics: CacheMetrics instance
+        :param disable_cache: True if the cache has been disabled
+        :param cache_dir: directory of execution cache
+        :param metrics_file: pathname of metrics file (optional)
         :return:
         """
 
-        if pathname == '-':
-            nbf.write(self.nb, sys.__stdout__)
+        metrics.exec_time = time.perf_counter() - self.exec_begin
+
+        if not disable_cache:
+            logging.info('Cache: {} hits, {} misses, {:.2f}s saved, {} bytes read, {} bytes written'.format(
+                metrics.hits, metrics.misses, metrics.seconds_saved, metrics.bytes_read, metrics.bytes_written))
+            record_run(cache_dir, uid, metrics)
+
+        if metrics_file:
+            metrics.write(metrics_file, uid)
+
+    @classmethod
+    def execute(cls, cells_func, params=None, fetch=(), **kwargs):
+        """
+        Execute notebook defined by cells_func and fetch variables from the kernel, e.g. to use the results
+        of a notebook from Python without parsing its outputs
+        :param cells_func: function defining the notebook cells
+        :param params: dict of notebook parameters, merged with the default values of cells_func (optional)
+        :param fetch: names of variables fetched from the kernel after the last cell (optional)
+        :param kwargs: options passed to Notebook.process
+        :return: dict of fetched variables
+        """
+
+        nb = cls()
+        uid = nb.add_func(cells_func, params or {})
+        nb.process(uid=uid, fetch=list(fetch), **kwargs)
+
+        return nb.fetched
+
+    @classmethod
+    async def execute_async(cls, cells_func, params=None, executor=None, **kwargs):
+        """
+        Execute notebook defined by cells_func without blocking the event loop.
+        The kernel is driven from a worker thread of executor, so that a single process
+        can run many notebooks concurrently.
+        :param cells_func: function defining the notebook cells
+        :param params: dict of notebook parameters, merged with the default values of cells_func (optional)
+        :param executor: concurrent.futures executor running the notebook (optional, default executor if None)
+        :param kwargs: options passed to Notebook.process
+        :return: tuple (executed notebook node, list of per-cell results)
+        """
+
+        nb = cls()
+        uid = nb.add_func(cells_func, params or {})
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(executor, partial(nb.process, uid=uid, **kwargs))
+
+        return nb.nb, nb.cell_results
+
+    @classmethod
+    async def execute_many_async(cls, jobs, concurrency=4, **kwargs):
+        """
+        Execute several notebooks concurrently, running at most concurrency kernels at the same time.
+        :param jobs: list of (cells_func, params) tuples
+        :param concurrency: maximum number of notebooks executing concurrently
+        :param kwargs: options passed to Notebook.process
+        :return: list of (executed notebook node, list of per-cell results) tuples, in the order of jobs
+        """
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return await asyncio.gather(*[cls.execute_async(cells_func, params, executor=executor, **kwargs)
+                                          for cells_func, params in jobs])
+
+    def add_func(self, func, params, cells=None):
+        """
+        Add cells of function func, using default values of func for missing parameters
+        :param func: function defining the notebook cells
+        :param params: dict of notebook parameters
+        :param cells: cells of func parsed with add_cells, copied instead of parsing func again (optional)
+        :return: unique id of the notebook, used to compute cell hashes
+        """
+
+        arg_spec = inspect.getargspec(func)
+
+        kwargs = {}
+        if arg_spec.defaults:
+            kwargs.update(dict(zip(arg_spec.args[-len(arg_spec.defaults):], arg_spec.defaults)))
+        kwargs.update(params)
+
+        self.cells_name = '{}:{}'.format(inspect.getfile(func), func.__name__)
+
+        if cells is None:
+            self.add(func, **kwargs)
         else:
-            with codecs.open(pathname, 'w', encoding='utf-8') as f:
-                ret = nbf.write(self.nb, f)
-                pass
+            self.check_params(func, kwargs)
+            self.nb['cells'].extend(copy.deepcopy(cells))
+            self.inject_params(kwargs)
 
-        logging.info("Jupyter notebook exported to '{}'".format(pathname))
+        return '{}:{}'.format(os.path.abspath(inspect.getfile(func)), func.__name__)
 
-    def export_html(self, pathname):
+    def export_ipynb(self, pathname):
         """
-        Export notebook to .html file
+        Export notebook to .ipynb file
         :param pathname: output filename
         :return:
         """
 
-        html_exporter = HTMLExporter()
+        NotebookExporter().export(self.nb, ipynb=pathname)
 
-        (body, resources) = html_exporter.from_notebook_node(self.nb)
+    def export_ipynb_str(self):
+        """
+        Export notebook to .ipynb format
+        :return: notebook as JSON string
+        """
 
-        if pathname == '-':
-            sys.__stdout__.write(body)
-        else:
-            with open(pathname, 'w') as f:
-                f.write(body)
+        return NotebookExporter().dumps_ipynb(self.nb)
 
-        logging.info("HTML notebook exported to '{}'".format(pathname))
+    def export_html_str(self, assets_pathname=None, cache=False):
+        """
+        Export notebook to .html format
+        :param assets_pathname: write images to directory of HTML file assets_pathname, instead of inlining them (optional)
+        :param cache: render each cell separately, reusing cached renderings of unchanged cells (optional)
+        :return: notebook as HTML string
+        """
 
-    def export_pynb_str(self):
+        return NotebookExporter(cache_dir=self.get_cache_dir()).dumps_html(self.nb, assets_pathname, cache)
 
-        s = 'def cells():\n'
+    def export_html(self, pathname, assets=False, cache=False):
+        """
+        Export notebook to .html file
+        :param pathname: output filename
+        :param assets: write images to directory PATHNAME_files named after their content hash, instead of inlining them (optional)
+        :param cache: render each cell separately, reusing cached renderings of unchanged cells (optional)
+        :return:
+        """
 
-        for cell in self.nb['cells']:
-            if cell.cell_type == 'markdown':
-                s += "    '''\n"
-                for line in cell.source.splitlines():
-                    s += '    {}\n'.format(line)
-                s += "    '''\n"
-            elif cell.cell_type == 'code':
-                for line in cell.source.splitlines():
-                    s += '    {}\n'.format(line)
-            else:
-                raise Exception('Unknown cell type: {}'.format(cell.cell_type))
+        if assets and pathname == '-':
+            fatal('HTML assets require an output file')
 
-            s += "\n    '''\n    '''\n\n"
+        NotebookExporter(cache_dir=self.get_cache_dir()).export(self.nb, html=pathname, html_assets=assets,
+                                                                html_cache=cache)
 
-        return s
+    def get_cache_dir(self):
+        """
+        Get cache directory of the last execution
+        :return: cache directory, /tmp if the notebook has not been executed
+        """
 
-    def export_pynb(self, pathname):
+        return self.ep.cache_dir if self.ep is not None else '/tmp'
+
+    def export_pynb_str(self):
 
-        s = self.export_pynb_str()
+        return dumps_pynb(self.nb)
 
-        if pathname == '-':
-            sys.__stdout__.write(s)
-        else:
-            with open(pathname, 'w') as f:
-                f.write(s)
+    def export_pynb(self, pathname):
 
-        logging.info("Python notebook exported to '{}'".format(pathname))
+        NotebookExporter().export(self.nb, pynb=pathname)
 
     def add_argument(self, *args, **kwargs):
         """
@@ -487,13 +1560,53 @@ class Notebook:
         self.parser.add_argument('--param', action='append', help='notebook parameter. Format: NAME=VALUE')
         self.add_argument('--import-ipynb', help='import from Jupyter notebook')
         self.add_argument('--export-html', help='export to HTML format')
+        self.add_argument('--html-assets', action="store_true", default=False,
+                          help='write images of HTML export to directory PATHNAME_files')
+        self.add_argument('--html-cache', action="store_true", default=False,
+                          help='render HTML export cell by cell, reusing cached renderings of unchanged cells')
         self.add_argument('--export-ipynb', help='export to Jupyter notebook')
         self.add_argument('--export-pynb', help='export to Python notebook')
+        self.add_argument('--no-validate', action="store_true", default=False,
+                          help='do not validate notebook when exporting to Jupyter notebook')
+        self.add_argument('--compact-ipynb', action="store_true", default=False,
+                          help='export to Jupyter notebook without indentation')
         self.add_argument('--kernel', default=None, help='set kernel')
         self.add_argument('--log-level', help='set log level')
-        self.add_argument('--check-syntax', action="store_true", default=False, help='check Python syntax')
+        self.add_argument('--check-syntax', action="store_true", default=False, help='check syntax and undefined names of cells, without executing them')
         self.add_argument('--disable-footer', action="store_true", default=False,
                           help='do not append Markdown footer to Jupyter notebook')
+        self.add_argument('--until', dest='until_cell',
+                          help='execute cells until cell index or Markdown heading (inclusive)')
+        self.add_argument('--from', dest='from_cell',
+                          help='execute cells from cell index or Markdown heading, restoring state from cache')
+        self.add_argument('--cells', dest='cells_range',
+                          help='execute range of cells. Format: [FROM]:[UNTIL]')
+        self.add_argument('--stream', action="store_true", default=False,
+                          help='print cell outputs to stderr while executing and update exported Jupyter notebook after each cell')
+        self.add_argument('--max-output-size', type=int, default=None,
+                          help='maximum size of stream outputs in characters, larger outputs are spilled to files')
+        self.add_argument('--spill-dir', default='pynb-outputs', help='directory of spilled outputs')
+        self.add_argument('--cache-dir', default='/tmp', help='directory of execution cache')
+        self.add_argument('--metrics-file',
+                          help='write cache metrics to file, in Prometheus textfile format if ending with .prom, in JSON otherwise')
+        self.add_argument('--dedup-sessions', action="store_true", default=False,
+                          help='store sessions split into content-defined chunks, storing once the chunks shared by sessions')
+        self.add_argument('--profile-cells', action="store_true", default=False,
+                          help='profile executed cells with cProfile')
+        self.add_argument('--profile-threshold', default=0.0, type=float, metavar='SECONDS',
+                          help='save the profiles of cells running for at least SECONDS, with --profile-cells')
+        self.add_argument('--profile-top', default=10, type=int, help='number of functions recorded in cell metadata by profiling')
+        self.add_argument('--async-snapshots', action="store_true", default=False,
+                          help='execute cells in an iPython shell, dumping sessions in the background (Linux only)')
+        self.add_argument('--fork-checkpoints', action="store_true", default=False,
+                          help='execute cells in an iPython shell, checkpointing its state in memory with fork (Linux only)')
+        self.add_argument('--in-process', action="store_true", default=False,
+                          help='execute cells in an iPython shell running in the pynb process, without starting a kernel')
+        self.add_argument('--max-forks', default=8, type=int, help='maximum number of fork checkpoints')
+        self.add_argument('--watch', action="store_true", default=False,
+                          help='execute notebook again each time its source file is modified')
+        self.add_argument('--watch-interval', default=0.5, type=float,
+                          help='seconds between checks for modifications in watch mode')
 
         if len(sys.argv) == 1 and self.__class__ == Notebook:
             # no parameters and Notebook class not extended:
@@ -589,6 +1702,92 @@ class Notebook:
             logging.getLogger().setLevel(logging.getLevelName(self.args.log_level))
             logging.debug('Enabled {} logging level'.format(self.args.log_level))
 
+        if self.args.export_pynb and not self.args.no_exec:
+            fatal('--export-pynb requires --no-exec')
+
+        if self.args.html_cache and not html_cache_supported():
+            fatal('--html-cache requires nbconvert < 6')
+
+        if self.args.fork_checkpoints and not sys.platform.startswith('linux'):
+            fatal('--fork-checkpoints requires Linux')
+
+        if self.args.async_snapshots and not sys.platform.startswith('linux'):
+            fatal('--async-snapshots requires Linux')
+
+        selected = ['--{}'.format(name.replace('_', '-')) for name in EXECUTORS if getattr(self.args, name)]
+        if len(selected) > 1:
+            fatal('{} are mutually exclusive'.format(', '.join(selected)))
+
+        if self.args.watch:
+            self.watch()
+            return
+
+        if self.args.check_syntax:
+            self.check_syntax()
+            return
+
+        # Start the kernel right away: it boots while the notebook is loaded and the cache is read ahead
+        km = None
+        if not self.args.no_exec and not self.args.fork_checkpoints and not self.args.in_process and \
+                not self.args.async_snapshots:
+            km = KernelManager(kernel_name=self.args.kernel or 'python3')
+            km.start_kernel(cwd=os.getcwd(), env=kernel_env(self.args.cache_dir))
+
+        try:
+            uid = self.load_notebook()
+
+            self.process(uid=uid,
+                         add_footer=not self.args.disable_footer,
+                         no_exec=self.args.no_exec,
+                         disable_cache=self.args.disable_cache,
+                         ignore_cache=self.args.ignore_cache,
+                         km=km,
+                         cell_range=self.get_cell_range(),
+                         stream_outputs=self.args.stream,
+                         cell_callback=self.get_stream_callback(),
+                         max_output_size=self.args.max_output_size,
+                         spill_dir=self.args.spill_dir,
+                         cache_dir=self.args.cache_dir,
+                         fork_checkpoints=self.args.fork_checkpoints,
+                         max_forks=self.args.max_forks,
+                         async_snapshots=self.args.async_snapshots,
+                         metrics_file=self.args.metrics_file,
+                         in_process=self.args.in_process,
+                         dedup_sessions=self.args.dedup_sessions,
+                         profile_cells=self.args.profile_threshold if self.args.profile_cells else None,
+                         profile_top=self.args.profile_top,
+                         profile_prefix=self.get_profile_prefix())
+        finally:
+            if km is not None:
+                km.shutdown_kernel()
+
+        self.export_notebook()
+
+    def check_syntax(self):
+        """
+        Check cells of notebook without executing them, exit with status 1 if any problem is found
+        :return:
+        """
+
+        from pynb.check import check_cells
+
+        self.load_notebook()
+        problems = check_cells(self.nb.cells)
+
+        for cell_index, lineno, msg in problems:
+            logging.error('Cell {}, line {}: {}'.format(cell_index, lineno, msg))
+
+        if problems:
+            fatal('Found {} problems'.format(len(problems)))
+
+        logging.info('No problems found')
+
+    def load_notebook(self):
+        """
+        Load notebook from Jupyter notebook or cells function, as specified by command line arguments
+        :return: unique id of the notebook
+        """
+
         if self.args.import_ipynb:
             check_isfile(self.args.import_ipynb)
             logging.info('Loading Jupyter notebook {}'.format(self.args.import_ipynb))
@@ -601,26 +1800,200 @@ class Notebook:
         logging.info('Disable cache: {}'.format(self.args.disable_cache))
         logging.info('Ignore cache: {}'.format(self.args.ignore_cache))
 
-        if self.args.export_pynb and not self.args.no_exec:
-            fatal('--export-pynb requires --no-exec')
-
         if self.args.kernel:
             self.set_kernel(self.args.kernel)
 
-        self.process(uid=uid,
-                     add_footer=not self.args.disable_footer,
-                     no_exec=self.args.no_exec,
-                     disable_cache=self.args.disable_cache,
-                     ignore_cache=self.args.ignore_cache)
+        return uid
+
+    def find_cell(self, spec):
+        """
+        Find cell by index or by Markdown heading
+        :param spec: cell index, or text of a Markdown heading (leading '#' characters are optional)
+        :return: cell index
+        """
+
+        try:
+            index = int(spec)
+        except ValueError:
+            pass
+        else:
+            if not -len(self.nb['cells']) <= index < len(self.nb['cells']):
+                fatal('Cell index {} out of range, notebook has {} cells'.format(index, len(self.nb['cells'])))
+            return index % len(self.nb['cells'])
+
+        heading = spec.lstrip('#').strip().lower()
+
+        for index, cell in enumerate(self.nb['cells']):
+            if cell.cell_type == 'markdown':
+                for line in cell.source.splitlines():
+                    if line.strip().startswith('#') and line.strip().lstrip('#').strip().lower() == heading:
+                        return index
+
+        fatal('Markdown heading "{}" not found'.format(spec))
+
+    def get_cell_range(self):
+        """
+        Get range of cells to execute, as specified by command line arguments
+        :return: (first, last) cell indices, inclusive, None if unbounded
+        """
+
+        first, last = self.args.from_cell, self.args.until_cell
+
+        if self.args.cells_range:
+            if ':' not in self.args.cells_range:
+                fatal('Invalid cells range {}, format: [FROM]:[UNTIL]'.format(self.args.cells_range))
+            first, last = [x or None for x in self.args.cells_range.split(':', 1)]
+
+        first = self.find_cell(first) if first is not None else None
+        last = self.find_cell(last) if last is not None else None
+
+        if first is not None or last is not None:
+            logging.info('Executing cells from {} until {}'.format(first, last))
+
+        return first, last
+
+    def get_stream_callback(self):
+        """
+        Get cell callback updating the exported Jupyter notebook after each cell, if --stream is set
+        :return: cell callback or None
+        """
+
+        if not self.args.stream or not self.args.export_ipynb or self.args.export_ipynb == '-':
+            return None
+
+        writer = IncrementalNotebookWriter(self.nb, self.args.export_ipynb)
+
+        def cell_callback(result):
+            cell = self.nb.cells[result['cell_index']].copy()
+            cell.outputs = result['outputs']
+            writer.update(result['cell_index'], cell)
+
+        return cell_callback
 
-        if self.args.export_html:
-            self.export_html(self.args.export_html)
+    def get_profile_prefix(self):
+        """
+        Get prefix of the pathnames of .pstats files written by --profile-cells: profiles are saved next
+        to the exported notebook, or in the working directory if the notebook is not exported to a file
+        :return: prefix
+        """
+
+        for pathname in [self.args.export_ipynb, self.args.export_html]:
+            if pathname and pathname != '-':
+                return os.path.splitext(pathname)[0]
+
+        if self.args.import_ipynb:
+            pathname = self.args.import_ipynb
+        elif self.args.cells:
+            pathname = self.args.cells.split(':')[0]
+        else:
+            pathname = inspect.getfile(self.__class__)
+
+        return os.path.splitext(os.path.basename(pathname))[0]
+
+    def export_notebook(self):
+        """
+        Export notebook to the formats specified by command line arguments
+        :return:
+        """
+
+        if self.args.html_assets and self.args.export_html == '-':
+            fatal('HTML assets require an output file')
+
+        exporter = NotebookExporter(validate=not self.args.no_validate, compact=self.args.compact_ipynb,
+                                    cache_dir=self.args.cache_dir)
+        exporter.export(self.nb,
+                        html=self.args.export_html,
+                        ipynb=self.args.export_ipynb,
+                        pynb=self.args.export_pynb,
+                        html_assets=self.args.html_assets,
+                        html_cache=self.args.html_cache)
+
+    def watch(self):
+        """
+        Execute notebook every time its source file is modified. The kernel is kept alive across executions:
+        unchanged cells are loaded from cache, and execution resumes from the first modified cell,
+        reusing the kernel state if it matches the state required by that cell.
+        :return:
+        """
+
+        if self.args.import_ipynb:
+            pathname = self.args.import_ipynb
+        elif self.args.cells:
+            pathname = self.args.cells.split(':')[0]
+        else:
+            fatal('--watch requires the cells parameter or --import-ipynb')
+
+        check_isfile(pathname)
+
+        km = None
+        if not self.args.fork_checkpoints and not self.args.in_process and not self.args.async_snapshots:
+            km = KernelManager(kernel_name=self.args.kernel or 'python3')
+            km.start_kernel(cwd=os.getcwd(), env=kernel_env(self.args.cache_dir))
+
+        logging.info('Watching {} for changes, press Ctrl-C to stop'.format(pathname))
 
-        if self.args.export_ipynb:
-            self.export_ipynb(self.args.export_ipynb)
+        ep = None
+        mtime = None
+        ignore_cache = self.args.ignore_cache
 
-        if self.args.export_pynb:
-            self.export_pynb(self.args.export_pynb)
+        try:
+            while True:
+                if os.path.isfile(pathname) and os.path.getmtime(pathname) != mtime:
+                    mtime = os.path.getmtime(pathname)
+
+                    # Without cache, there is no way to resume execution: restart from a clean kernel.
+                    if ep is not None and ep.disable_cache:
+                        if km is not None:
+                            km.restart_kernel(now=True)
+                        ep.shutdown()
+                        ep = None
+
+                    self.nb = nbf.v4.new_notebook()
+                    self.nb['cells'] = []
+
+                    try:
+                        uid = self.load_notebook()
+                        self.process(uid=uid,
+                                     add_footer=not self.args.disable_footer,
+                                     disable_cache=self.args.disable_cache,
+                                     ignore_cache=ignore_cache,
+                                     km=km,
+                                     ep=ep,
+                                     cell_range=self.get_cell_range(),
+                                     stream_outputs=self.args.stream,
+                                     cell_callback=self.get_stream_callback(),
+                                     max_output_size=self.args.max_output_size,
+                                     spill_dir=self.args.spill_dir,
+                                     cache_dir=self.args.cache_dir,
+                                     fork_checkpoints=self.args.fork_checkpoints,
+                                     max_forks=self.args.max_forks,
+                                     async_snapshots=self.args.async_snapshots,
+                                     metrics_file=self.args.metrics_file,
+                                     in_process=self.args.in_process,
+                                     dedup_sessions=self.args.dedup_sessions,
+                                     profile_cells=self.args.profile_threshold if self.args.profile_cells else None,
+                                     profile_top=self.args.profile_top,
+                                     profile_prefix=self.get_profile_prefix())
+                        self.export_notebook()
+                    except CellExecutionError as e:
+                        logging.error('Execution failed: {}'.format(e))
+                    except SystemExit:
+                        # pynb.utils.fatal has been called, e.g. syntax error: wait for the next change.
+                        pass
+
+                    # The cache is ignored only by the first execution
+                    ignore_cache = False
+                    ep = self.ep
+                    logging.info('Waiting for changes to {}'.format(pathname))
+
+                time.sleep(self.args.watch_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if ep is not None:
+                ep.shutdown()
+            if km is not None:
+                km.shutdown_kernel(now=True)
 
 
 def main():
@@ -629,6 +2002,36 @@ def main():
     :return:
     """
 
+    if sys.argv[1:2] == ['serve']:
+        from pynb.server import serve
+        serve(sys.argv[2:])
+        return
+
+    if sys.argv[1:2] == ['convert']:
+        from pynb.convert import convert
+        sys.exit(convert(sys.argv[2:]))
+
+    if sys.argv[1:2] == ['project']:
+        from pynb.project import run_project
+        sys.exit(run_project(sys.argv[2:]))
+
+    if sys.argv[1:2] == ['cache']:
+        from pynb.metrics import cache
+        sys.exit(cache(sys.argv[2:]))
+
+    if sys.argv[1:2] == ['check']:
+        from pynb.check import check
+        sys.exit(check(sys.argv[2:]))
+
+    if sys.argv[1:2] == ['coordinator']:
+        from pynb.distributed import coordinator
+        sys.exit(coordinator(sys.argv[2:]))
+
+    if sys.argv[1:2] == ['worker']:
+        from pynb.distributed import worker
+        worker(sys.argv[2:])
+        return
+
     nb = Notebook()
     nb.run()
 
@@ -0,0 +1,89 @@
+"""
+Profiling of cells with cProfile inside the shell executing them, without changes to their source
+"""
+
+import cProfile
+import os
+import pstats
+
+import IPython
+
+# Profiler of the cell being profiled
+profiler = None
+
+# Functions defined in these directories are not reported, e.g. the iPython machinery running the cell
+EXCLUDED_DIRS = (os.path.dirname(IPython.__file__), os.path.dirname(__file__))
+
+# Built-in functions not reported: exec running the cell and the profiler itself
+EXCLUDED_FUNCTIONS = {'<built-in method builtins.exec>', "<method 'disable' of '_lsprof.Profiler' objects>"}
+
+
+def start():
+    """
+    Profile the next cell executed by the iPython shell. The profiler is enabled by the pre_run_cell event
+    and disabled by the post_run_cell event of the cell, so that only its execution is measured.
+    :return:
+    """
+
+    global profiler
+
+    shell = IPython.get_ipython()
+    profiler = cProfile.Profile()
+
+    def post_run_cell(*args):
+        profiler.disable()
+        shell.events.unregister('post_run_cell', post_run_cell)
+
+    def pre_run_cell(*args):
+        # registered here, not to be triggered by the cell calling start
+        shell.events.unregister('pre_run_cell', pre_run_cell)
+        shell.events.register('post_run_cell', post_run_cell)
+        profiler.enable()
+
+    shell.events.register('pre_run_cell', pre_run_cell)
+
+
+def stop(pathname=None, top=10):
+    """
+    Collect the statistics of the profiled cell
+    :param pathname: write full statistics to this .pstats file, readable with pstats and snakeviz (optional)
+    :param top: number of functions reported
+    :return: dict with total time and the top functions by cumulative time
+    """
+
+    global profiler
+
+    stats = pstats.Stats(profiler)
+    profiler = None
+
+    if pathname:
+        stats.dump_stats(pathname)
+
+    return summary(stats, top)
+
+
+def summary(stats, top=10):
+    """
+    Summarize profiling statistics
+    :param stats: pstats.Stats instance
+    :param top: number of functions reported
+    :return: dict with total time and the top functions by cumulative time
+    """
+
+    functions = []
+
+    for func in stats.sort_stats('cumulative').fcn_list or []:
+        if len(functions) == top:
+            break
+
+        filename, _, name = func
+        if filename.startswith(EXCLUDED_DIRS) or name in EXCLUDED_FUNCTIONS:
+            continue
+
+        cc, nc, tt, ct, callers = stats.stats[func]
+        functions.append({'function': pstats.func_std_string(func),
+                          'ncalls': nc,
+                          'tottime': round(tt, 6),
+                          'cumtime': round(ct, 6)})
+
+    return {'total_time': round(stats.total_tt, 6), 'functions': functions}
@@ -0,0 +1,294 @@
+"""
+Project-level runner executing a DAG of notebooks
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from pynb.deps import LocalModules
+from pynb.notebook import Notebook
+from pynb.utils import fatal
+
+
+def file_hash(pathname):
+    """
+    Compute hash of file content
+    :param pathname: pathname
+    :return: hash string, None if the file does not exist
+    """
+
+    if not os.path.isfile(pathname):
+        return None
+
+    h = hashlib.sha256()
+    with open(pathname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+class Project:
+    """
+    Execute the notebooks declared in a project manifest, a JSON file with format:
+
+    {
+      "notebooks": {
+        "NAME": {
+          "cells": "PATHNAME.PY[:FUNCTION_NAME]",
+          "params": {"NAME": VALUE, ...},
+          "inputs": ["PATHNAME", ...],
+          "outputs": ["PATHNAME", ...],
+          "export_html": "PATHNAME",
+          "export_ipynb": "PATHNAME"
+        },
+        ...
+      }
+    }
+
+    Pathnames are relative to the directory of the manifest, which is also the working directory of the
+    kernels. A notebook depends on the notebooks producing its inputs. A notebook is executed only if its
+    source, the project-local modules it imports, its parameters or inputs changed since its last successful
+    execution, or if any of its outputs is missing. Notebooks whose dependencies
+    completed are executed in parallel.
+    """
+
+    def __init__(self, pathname):
+        """
+        Load project manifest and state of previous executions
+        :param pathname: pathname of manifest
+        """
+
+        with open(pathname, encoding='utf-8') as f:
+            self.notebooks = json.load(f)['notebooks']
+
+        self.path = os.path.dirname(os.path.abspath(pathname))
+        self.state_pathname = os.path.join(self.path, '.pynb-project-state.json')
+        self.lock = threading.Lock()
+        self.local_modules = LocalModules(cwd=self.path)
+
+        if os.path.isfile(self.state_pathname):
+            with open(self.state_pathname, encoding='utf-8') as f:
+                self.state = json.load(f)
+        else:
+            self.state = {}
+
+        self.deps = self.get_dependencies()
+
+    def get_dependencies(self):
+        """
+        Compute dependencies between notebooks from their inputs and outputs
+        :return: dict mapping notebook names to sets of notebook names they depend on
+        """
+
+        producers = {}
+        for name, notebook in self.notebooks.items():
+            for output in notebook.get('outputs', []):
+                if output in producers:
+                    fatal("Output '{}' produced by both {} and {}".format(output, producers[output], name))
+                producers[output] = name
+
+        deps = {name: {producers[i] for i in notebook.get('inputs', []) if i in producers}
+                for name, notebook in self.notebooks.items()}
+
+        # check that the dependency graph is acyclic
+        visited, visiting = set(), set()
+
+        def visit(name):
+            if name in visiting:
+                fatal('Dependency cycle involving notebook {}'.format(name))
+            if name not in visited:
+                visiting.add(name)
+                for dep in deps[name]:
+                    visit(dep)
+                visiting.remove(name)
+                visited.add(name)
+
+        for name in deps:
+            visit(name)
+
+        return deps
+
+    def pathname(self, pathname):
+        """
+        Get pathname relative to the directory of the manifest
+        :param pathname: pathname
+        :return: pathname
+        """
+
+        return os.path.join(self.path, pathname)
+
+    def fingerprint(self, name):
+        """
+        Compute fingerprint of notebook, covering its source, the project-local modules it imports, its
+        parameters and inputs
+        :param name: notebook name
+        :return: fingerprint string
+        """
+
+        notebook = self.notebooks[name]
+        pathname = self.pathname(notebook['cells'].split(':')[0])
+
+        modules = None
+        if os.path.isfile(pathname):
+            with open(pathname, encoding='utf-8') as f, self.lock:
+                modules = self.local_modules.digest(f.read())
+
+        s = json.dumps({'source': file_hash(pathname),
+                        'modules': modules,
+                        'params': notebook.get('params', {}),
+                        'inputs': {i: file_hash(self.pathname(i)) for i in notebook.get('inputs', [])}},
+                       sort_keys=True)
+
+        return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+    def is_outdated(self, name, fingerprint):
+        """
+        Check if notebook must be executed
+        :param name: notebook name
+        :param fingerprint: current fingerprint of notebook
+        :return: True if the notebook must be executed
+        """
+
+        notebook = self.notebooks[name]
+
+        if self.state.get(name) != fingerprint:
+            return True
+
+        return not all(os.path.exists(self.pathname(o)) for o in notebook.get('outputs', []))
+
+    def save_state(self, name, fingerprint):
+        """
+        Record successful execution of notebook
+        :param name: notebook name
+        :param fingerprint: fingerprint of notebook at execution time
+        :return:
+        """
+
+        with self.lock:
+            self.state[name] = fingerprint
+            tmp_pathname = '{}.tmp'.format(self.state_pathname)
+            with open(tmp_pathname, 'w', encoding='utf-8') as f:
+                json.dump(self.state, f, indent=1, sort_keys=True)
+            os.replace(tmp_pathname, self.state_pathname)
+
+    def run_notebook(self, name, force=False, disable_cache=False):
+        """
+        Execute notebook if outdated. Executed by worker threads.
+        :param name: notebook name
+        :param force: execute notebook even if not outdated
+        :param disable_cache: disable execution cache
+        :return: 'executed' or 'skipped'
+        """
+
+        notebook = self.notebooks[name]
+        fingerprint = self.fingerprint(name)
+
+        if not force and not self.is_outdated(name, fingerprint):
+            logging.info('Notebook {}: up to date'.format(name))
+            return 'skipped'
+
+        logging.info('Notebook {}: executing'.format(name))
+
+        nb = Notebook()
+        nb.set_cells(self.pathname(notebook['cells']))
+        uid = nb.add_func(nb.cells, notebook.get('params', {}))
+        nb.process(uid=uid, add_footer=True, disable_cache=disable_cache, cwd=self.path)
+
+        if notebook.get('export_html'):
+            nb.export_html(self.pathname(notebook['export_html']))
+
+        if notebook.get('export_ipynb'):
+            nb.export_ipynb(self.pathname(notebook['export_ipynb']))
+
+        for output in notebook.get('outputs', []):
+            if not os.path.exists(self.pathname(output)):
+                logging.warning("Notebook {}: output '{}' not produced".format(name, output))
+
+        self.save_state(name, fingerprint)
+
+        return 'executed'
+
+    def run(self, targets=None, jobs=4, force=False, disable_cache=False):
+        """
+        Execute notebooks
+        :param targets: names of notebooks to bring up to date, together with their dependencies (optional, all if None)
+        :param jobs: maximum number of notebooks executed in parallel
+        :param force: execute notebooks even if not outdated
+        :param disable_cache: disable execution cache
+        :return: dict mapping notebook names to 'executed', 'skipped', 'failed' or 'blocked'
+        """
+
+        # select targets and their dependencies
+        selected = set()
+        pending = list(targets or self.notebooks.keys())
+        while pending:
+            name = pending.pop()
+            if name not in self.notebooks:
+                fatal('Unknown notebook {}'.format(name))
+            if name not in selected:
+                selected.add(name)
+                pending.extend(self.deps[name])
+
+        status = {}
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            while len(status) < len(selected):
+                for name in sorted(selected):
+                    if name in status or name in running.values():
+                        continue
+                    if any(status.get(dep) in ['failed', 'blocked'] for dep in self.deps[name]):
+                        logging.error('Notebook {}: not executed, a dependency failed'.format(name))
+                        status[name] = 'blocked'
+                    elif all(status.get(dep) in ['executed', 'skipped'] for dep in self.deps[name]):
+                        running[executor.submit(self.run_notebook, name, force, disable_cache)] = name
+
+                if not running:
+                    continue
+
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        status[name] = future.result()
+                    except (Exception, SystemExit):
+                        # SystemExit is raised by pynb.utils.fatal
+                        logging.error('Notebook {}: failed\n{}'.format(name, traceback.format_exc(limit=1)))
+                        status[name] = 'failed'
+
+        return status
+
+
+def run_project(argv):
+    """
+    Entry point for the pynb project command
+    :param argv: command line arguments
+    :return: exit status, 1 if any notebook failed
+    """
+
+    parser = argparse.ArgumentParser(prog='pynb project', description='Execute the notebooks of a project')
+    parser.add_argument('manifest', nargs='?', default='pynb.json', help='project manifest (default: pynb.json)')
+    parser.add_argument('--target', action='append', help='notebook to bring up to date, with its dependencies')
+    parser.add_argument('--jobs', type=int, default=4, help='maximum number of notebooks executed in parallel')
+    parser.add_argument('--force', action="store_true", default=False, help='execute also up to date notebooks')
+    parser.add_argument('--disable-cache', action="store_true", default=False, help='disable execution cache')
+    parser.add_argument('--log-level', help='set log level')
+    args = parser.parse_args(argv)
+
+    if args.log_level:
+        logging.getLogger().setLevel(logging.getLevelName(args.log_level))
+
+    status = Project(args.manifest).run(targets=args.target, jobs=args.jobs, force=args.force,
+                                        disable_cache=args.disable_cache)
+
+    for name in sorted(status):
+        logging.info('Notebook {}: {}'.format(name, status[name]))
+
+    return 1 if any(s in ['failed', 'blocked'] for s in status.values()) else 0
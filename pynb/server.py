@@ -0,0 +1,445 @@
+"""
+Long-running execution server with warm kernels and an HTTP/JSON API
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from jupyter_client import KernelManager
+
+from pynb.notebook import Notebook
+from pynb.utils import get_func
+from pynb.version import __version__
+
+
+class KernelPool:
+    """
+    Pool of started kernels. Kernels are never reused across executions: once released,
+    a kernel is shut down and replaced by a new one in background, so that every
+    notebook runs in a clean kernel without paying the kernel startup time.
+    """
+
+    def __init__(self, size, kernel_name='python3', retries=3, retry_delay=1):
+        """
+        Initialize pool and start kernels
+        :param size: number of warm kernels, this is also the maximum number of concurrent executions
+        :param kernel_name: name of kernel
+        :param retries: maximum number of retries of a failed start of a replacement kernel
+        :param retry_delay: seconds between retries, doubled at each retry
+        """
+
+        self.kernel_name = kernel_name
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.kernels = queue.Queue()
+
+        for i in range(size):
+            self.start_kernel()
+
+    def start_kernel(self):
+        """
+        Start a new kernel and add it to the pool
+        :return:
+        """
+
+        km = KernelManager(kernel_name=self.kernel_name)
+        km.start_kernel(cwd=os.getcwd())
+        self.kernels.put(km)
+
+    def acquire(self, timeout=None):
+        """
+        Get a started kernel, waiting for one to be available
+        :param timeout: maximum number of seconds to wait, None to wait forever (optional)
+        :return: kernel manager
+        :raises queue.Empty: if no kernel is available within timeout seconds
+        """
+
+        return self.kernels.get(timeout=timeout)
+
+    def release(self, km):
+        """
+        Shut down kernel and start a replacement in background
+        :param km: kernel manager returned by acquire
+        :return:
+        """
+
+        threading.Thread(target=self.replace, args=(km,), daemon=True).start()
+
+    def replace(self, km):
+        """
+        Shut down kernel and start a replacement, retrying failed starts. If all of them fail,
+        the pool has one kernel less.
+        :param km: kernel manager returned by acquire
+        :return:
+        """
+
+        try:
+            km.shutdown_kernel(now=True)
+        except Exception as e:
+            logging.warning('Cannot shut down kernel: {}'.format(repr(e)))
+
+        delay = self.retry_delay
+
+        for attempt in range(self.retries + 1):
+            try:
+                self.start_kernel()
+                return
+            except Exception as e:
+                logging.error('Cannot start kernel (attempt {} of {}): {}'.format(attempt + 1, self.retries + 1,
+                                                                                  repr(e)))
+                logging.debug(traceback.format_exc())
+
+            if attempt < self.retries:
+                time.sleep(delay)
+                delay *= 2
+
+        logging.error('Kernel not replaced, {} kernels left in pool'.format(self.kernels.qsize()))
+
+    def shutdown(self):
+        """
+        Shut down all kernels in the pool
+        :return:
+        """
+
+        while not self.kernels.empty():
+            self.kernels.get().shutdown_kernel(now=True)
+
+
+class LatencyMetrics:
+    """
+    Track request counters and latency percentiles over the most recent requests
+    """
+
+    def __init__(self, window=1000):
+        """
+        Initialize metrics
+        :param window: number of most recent requests considered to compute percentiles
+        """
+
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.queue_times = collections.deque(maxlen=window)
+        self.counters = collections.Counter()
+
+    def add(self, status, latency=None, queue_time=None):
+        """
+        Record a request
+        :param status: request outcome, e.g. 'ok', 'error', 'rejected'
+        :param latency: total request latency in seconds (optional)
+        :param queue_time: time spent waiting for a kernel in seconds (optional)
+        :return:
+        """
+
+        with self.lock:
+            self.counters[status] += 1
+            if latency is not None:
+                self.latencies.append(latency)
+            if queue_time is not None:
+                self.queue_times.append(queue_time)
+
+    @staticmethod
+    def percentile(values, p):
+        """
+        Compute percentile with nearest-rank method
+        :param values: list of values
+        :param p: percentile in [0, 100]
+        :return: percentile value, None if values is empty
+        """
+
+        if not values:
+            return None
+
+        values = sorted(values)
+        return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+    def to_dict(self):
+        """
+        Summarize metrics
+        :return: dict of counters and percentiles
+        """
+
+        with self.lock:
+            latencies = list(self.latencies)
+            queue_times = list(self.queue_times)
+            counters = dict(self.counters)
+
+        return {'requests': counters,
+                'latency_p50': self.percentile(latencies, 50),
+                'latency_p99': self.percentile(latencies, 99),
+                'queue_time_p50': self.percentile(queue_times, 50),
+                'queue_time_p99': self.percentile(queue_times, 99)}
+
+
+class NotebookServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server executing pynb notebooks on warm kernels
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, kernels=2, max_queue=100, kernel_name='python3', queue_timeout=300, root='.'):
+        """
+        Initialize server
+        :param address: (host, port) tuple
+        :param kernels: number of warm kernels, i.e. maximum number of concurrent executions
+        :param max_queue: maximum number of requests waiting for a kernel, additional requests are rejected
+        :param kernel_name: name of kernel
+        :param queue_timeout: seconds after which requests waiting for a kernel are rejected, None to wait forever
+        :param root: directory of the notebooks that can be executed, relative pathnames are relative to it
+        """
+
+        super().__init__(address, NotebookRequestHandler)
+
+        self.pool = KernelPool(kernels, kernel_name)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.metrics = LatencyMetrics()
+        self.queued = 0
+        self.running = 0
+        self.lock = threading.Lock()
+        self.funcs = {}
+        self.root = os.path.realpath(root)
+
+    def get_func(self, pathname, func_name):
+        """
+        Get cells function and its parsed cells, importing its module and parsing the cells only if never
+        imported or modified since last import
+        :param pathname: pathname of module, inside the root directory
+        :param func_name: name of cells function
+        :return: (cells function, cells) tuple, cells to be copied by Notebook.add_func
+        """
+
+        pathname = os.path.realpath(os.path.join(self.root, pathname))
+        if os.path.commonpath([self.root, pathname]) != self.root:
+            raise ValueError('Notebook {} outside of root directory {}'.format(pathname, self.root))
+
+        mtime = os.path.getmtime(pathname)
+
+        with self.lock:
+            cached = self.funcs.get((pathname, func_name))
+
+        if cached and cached[0] == mtime:
+            return cached[1:]
+
+        func = get_func(func_name, pathname)
+        nb = Notebook()
+        nb.add_cells(func)
+
+        with self.lock:
+            self.funcs[(pathname, func_name)] = (mtime, func, nb.nb.cells)
+
+        return func, nb.nb.cells
+
+    def acquire_kernel(self):
+        """
+        Wait for a warm kernel
+        :return: kernel manager
+        :raises RuntimeError: if the queue is full or no kernel is available within queue_timeout seconds
+        """
+
+        with self.lock:
+            if self.queued >= self.max_queue:
+                raise RuntimeError('Queue full')
+            self.queued += 1
+
+        try:
+            km = self.pool.acquire(self.queue_timeout)
+        except queue.Empty:
+            raise RuntimeError('No kernel available after {}s'.format(self.queue_timeout))
+        finally:
+            with self.lock:
+                self.queued -= 1
+
+        with self.lock:
+            self.running += 1
+
+        return km
+
+    def release_kernel(self, km):
+        """
+        Release kernel acquired with acquire_kernel
+        :param km: kernel manager
+        :return:
+        """
+
+        with self.lock:
+            self.running -= 1
+
+        self.pool.release(km)
+
+    def status(self):
+        """
+        Server status
+        :return: dict with queue, execution and latency metrics
+        """
+
+        status = self.metrics.to_dict()
+        with self.lock:
+            status.update({'queued': self.queued, 'running': self.running})
+
+        return status
+
+
+class NotebookRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handle requests:
+
+    * GET /metrics: return server metrics
+    * POST /run: run notebook. JSON body with keys 'notebook' (pathname inside the root directory of the
+      server), 'function' (default 'cells'),
+      'params' (dict), 'format' ('ipynb', 'html' or 'stream', default 'ipynb'), 'disable_cache' and
+      'ignore_cache' (default false). Format 'stream' returns one JSON line for each executed cell,
+      followed by a last line containing the executed notebook.
+    """
+
+    server_version = 'pynb/{}'.format(__version__)
+
+    def log_message(self, format, *args):
+        logging.info('{} - {}'.format(self.address_string(), format % args))
+
+    def send_json(self, code, obj):
+        """
+        Send JSON response
+        :param code: HTTP status code
+        :param obj: object to serialize as JSON
+        :return:
+        """
+
+        self.send_body(code, 'application/json', json.dumps(obj))
+
+    def send_body(self, code, content_type, body):
+        """
+        Send response
+        :param code: HTTP status code
+        :param content_type: content type
+        :param body: response body
+        :return:
+        """
+
+        body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_json(200, self.server.status())
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path != '/run':
+            self.send_json(404, {'error': 'Not found'})
+            return
+
+        begin = time.perf_counter()
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            fmt = request.get('format', 'ipynb')
+            if fmt not in ['ipynb', 'html', 'stream']:
+                raise ValueError('Unknown format {}'.format(fmt))
+            func, cells = self.server.get_func(request['notebook'], request.get('function', 'cells'))
+            nb = Notebook()
+            uid = nb.add_func(func, request.get('params', {}), cells)
+        except (Exception, SystemExit) as e:
+            # SystemExit is raised by pynb.utils.fatal, e.g. if parameters are not matching.
+            logging.info('Invalid request: {}'.format(repr(e)))
+            self.server.metrics.add('invalid')
+            self.send_json(400, {'error': 'Invalid request: {}'.format(repr(e))})
+            return
+
+        queue_begin = time.perf_counter()
+
+        try:
+            km = self.server.acquire_kernel()
+        except RuntimeError as e:
+            self.server.metrics.add('rejected')
+            self.send_json(503, {'error': str(e)})
+            return
+
+        queue_time = time.perf_counter() - queue_begin
+
+        try:
+            if fmt == 'stream':
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.end_headers()
+
+                def cell_callback(result):
+                    self.wfile.write((json.dumps(result) + '\n').encode('utf-8'))
+                    self.wfile.flush()
+
+                nb.process(uid=uid, km=km, cell_callback=cell_callback,
+                           disable_cache=request.get('disable_cache', False),
+                           ignore_cache=request.get('ignore_cache', False))
+                self.wfile.write((nb.export_ipynb_str().replace('\n', '') + '\n').encode('utf-8'))
+            else:
+                nb.process(uid=uid, km=km,
+                           disable_cache=request.get('disable_cache', False),
+                           ignore_cache=request.get('ignore_cache', False))
+                if fmt == 'html':
+                    self.send_body(200, 'text/html', nb.export_html_str())
+                else:
+                    self.send_body(200, 'application/json', nb.export_ipynb_str())
+        except Exception as e:
+            logging.info('Execution failed: {}'.format(repr(e)))
+            logging.debug(traceback.format_exc())
+            self.server.metrics.add('error')
+            if fmt == 'stream':
+                self.wfile.write((json.dumps({'error': str(e)}) + '\n').encode('utf-8'))
+            else:
+                self.send_json(500, {'error': str(e)})
+            return
+        finally:
+            self.server.release_kernel(km)
+
+        self.server.metrics.add('ok', time.perf_counter() - begin, queue_time)
+
+
+def serve(argv):
+    """
+    Entry point for the pynb serve command
+    :param argv: command line arguments
+    :return:
+    """
+
+    parser = argparse.ArgumentParser(prog='pynb serve', description='Run pynb notebooks over HTTP with warm kernels')
+    parser.add_argument('--host', default='127.0.0.1', help='address to bind')
+    parser.add_argument('--port', default=8890, type=int, help='port to bind')
+    parser.add_argument('--kernels', default=2, type=int, help='number of warm kernels (maximum concurrency)')
+    parser.add_argument('--max-queue', default=100, type=int, help='maximum number of queued requests')
+    parser.add_argument('--queue-timeout', default=300, type=float,
+                        help='seconds after which requests waiting for a kernel are rejected')
+    parser.add_argument('--root', default='.',
+                        help='directory of the notebooks that can be executed (default: current directory)')
+    parser.add_argument('--kernel', default='python3', help='set kernel')
+    parser.add_argument('--log-level', help='set log level')
+    args = parser.parse_args(argv)
+
+    if args.log_level:
+        logging.getLogger().setLevel(logging.getLevelName(args.log_level))
+
+    server = NotebookServer((args.host, args.port), kernels=args.kernels, max_queue=args.max_queue,
+                            kernel_name=args.kernel, queue_timeout=args.queue_timeout, root=args.root)
+
+    logging.info('Serving on http://{}:{} with {} kernels'.format(args.host, args.port, args.kernels))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.shutdown()
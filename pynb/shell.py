@@ -0,0 +1,188 @@
+"""
+Execution of cells with an iPython shell, capturing outputs as Jupyter notebook outputs
+"""
+
+import contextlib
+import sys
+import threading
+
+import nbformat as nbf
+from IPython.core.displayhook import DisplayHook
+from IPython.core.displaypub import DisplayPublisher
+from IPython.core.interactiveshell import InteractiveShell
+from traitlets.config import Config
+
+
+class OutputDisplayHook(DisplayHook):
+    """
+    Record results of cells as execute_result outputs
+    """
+
+    def write_output_prompt(self):
+        pass
+
+    def write_format_data(self, format_dict, md_dict=None):
+        self.shell.outputs.append(nbf.v4.new_output('execute_result', data=format_dict, metadata=md_dict or {},
+                                                    execution_count=self.prompt_count))
+
+    def finish_displayhook(self):
+        pass
+
+
+class OutputDisplayPublisher(DisplayPublisher):
+    """
+    Record displayed objects as display_data outputs
+    """
+
+    def publish(self, data, metadata=None, source=None, transient=None, update=False, **kwargs):
+        self.shell.outputs.append(nbf.v4.new_output('display_data', data=data, metadata=metadata or {}))
+
+    def clear_output(self, wait=False):
+        del self.shell.outputs[:]
+
+
+class OutputStream:
+    """
+    File-like object recording writes as stream outputs, merging consecutive writes
+    """
+
+    def __init__(self, shell, name):
+        self.shell = shell
+        self.name = name
+
+    def write(self, text):
+        outputs = self.shell.outputs
+        if outputs and outputs[-1].output_type == 'stream' and outputs[-1].name == self.name:
+            outputs[-1].text += text
+        else:
+            outputs.append(nbf.v4.new_output('stream', name=self.name, text=text))
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class OutputShell(InteractiveShell):
+    """
+    iPython shell recording the outputs of the current cell in self.outputs
+    """
+
+    displayhook_class = OutputDisplayHook
+    display_pub_class = OutputDisplayPublisher
+
+    def __init__(self, **kwargs):
+        self.outputs = []
+        super().__init__(**kwargs)
+
+    def _showtraceback(self, etype, evalue, stb):
+        self.outputs.append(nbf.v4.new_output('error', ename=etype.__name__, evalue=str(evalue), traceback=stb))
+
+    def enable_gui(self, gui=None):
+        pass
+
+
+class ShellExecutor:
+    """
+    Execute cells with an iPython shell running in the current process. The shell is a singleton:
+    executors sharing it must hold ShellExecutor.lock while executing, and track with ShellExecutor.owner
+    which of them has set its state.
+    """
+
+    lock = threading.RLock()
+    owner = None
+
+    def __init__(self):
+        # history is kept in memory: no history database, no history saving thread
+        config = Config()
+        config.HistoryManager.enabled = False
+
+        # the shell installs its user module as __main__ module: keep the __main__ module of the process
+        main = sys.modules['__main__']
+        self.shell = OutputShell.instance(config=config)
+        self.shell.colors = 'Linux'
+        sys.modules['__main__'] = main
+
+        # as in Jupyter kernels, modules are imported also from the working directory
+        if '' not in sys.path:
+            sys.path.insert(0, '')
+
+    @contextlib.contextmanager
+    def user_main(self):
+        """
+        Context manager making the user module of the shell the __main__ module, as in Jupyter kernels,
+        so that objects defined by cells can be pickled
+        :return:
+        """
+
+        main = sys.modules['__main__']
+        sys.modules['__main__'] = self.shell.user_module
+        try:
+            yield
+        finally:
+            sys.modules['__main__'] = main
+
+    def reset(self, new_session=True):
+        """
+        Reset shell state, removing all variables
+        :param new_session: restart the execution count (optional)
+        :return:
+        """
+
+        self.shell.reset(new_session=new_session)
+
+    def dump_session(self, pathname):
+        """
+        Dump shell session with dill
+        :param pathname: pathname of session
+        :return:
+        """
+
+        import dill
+        with self.user_main():
+            dill.dump_session(filename=pathname, main=self.shell.user_module)
+
+    def load_session(self, pathname):
+        """
+        Load shell session dumped with dill
+        :param pathname: pathname of session
+        :return:
+        """
+
+        import dill
+        with self.user_main():
+            dill.load_session(filename=pathname, main=self.shell.user_module)
+
+    def execute(self, source, store_history=True):
+        """
+        Execute cell
+        :param source: cell source
+        :param store_history: store the cell in history and increment the execution count (optional)
+        :return: (reply, outputs) tuple, as returned by ExecutePreprocessor.run_cell
+        """
+
+        self.shell.outputs = []
+
+        with self.user_main(), contextlib.redirect_stdout(OutputStream(self.shell, 'stdout')), \
+                contextlib.redirect_stderr(OutputStream(self.shell, 'stderr')):
+            result = self.shell.run_cell(source, store_history=store_history)
+
+        content = {'status': 'ok' if result.success else 'error', 'execution_count': result.execution_count}
+
+        errors = [out for out in self.shell.outputs if out.output_type == 'error']
+        if errors:
+            content.update(ename=errors[0].ename, evalue=errors[0].evalue, traceback=errors[0].traceback)
+
+        return {'content': content}, self.shell.outputs
+
+
+# Language information of notebooks executed with ShellExecutor
+LANGUAGE_INFO = {'name': 'python',
+                 'version': '{}.{}.{}'.format(*sys.version_info[:3]),
+                 'mimetype': 'text/x-python',
+                 'file_extension': '.py',
+                 'codemirror_mode': {'name': 'ipython', 'version': 3},
+                 'pygments_lexer': 'ipython3',
+                 'nbconvert_exporter': 'python'}
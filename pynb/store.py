@@ -0,0 +1,249 @@
+"""
+Storage of cached cell values and cell outputs
+"""
+
+import collections
+import hashlib
+import json
+import os
+import threading
+
+import nbformat as nbf
+
+from pynb.utils import temp_pathname
+
+# Metadata key of the links to spilled outputs, recording the absolute pathname of the spilled output
+SPILLED_KEY = 'pynb_spilled'
+
+
+class OutputStore:
+    """
+    Store cached cell values, i.e. (reply, outputs) tuples, as nbformat JSON manifests.
+
+    Output payloads larger than a threshold (e.g., images and HTML tables) are stored
+    separately in a content-addressed blob store and replaced in the manifest by a reference
+    {"pynb_blob": sha256}. Identical payloads produced by different cells, hash variants or
+    parameter values are therefore stored once. Recently read blobs are kept in memory, up to cache_size bytes.
+    """
+
+    def __init__(self, path='/tmp/pynb-cache-blobs', threshold=4096, cache_size=64 << 20):
+        """
+        Initialize store
+        :param path: directory of blob store
+        :param threshold: payloads larger than threshold bytes, encoded as UTF-8, are stored as blobs
+        :param cache_size: maximum total size in bytes of blobs kept in memory
+        """
+
+        self.path = path
+        self.threshold = threshold
+        self.cache_size = cache_size
+        self.blobs = collections.OrderedDict()
+        self.blobs_size = 0
+        # blobs are read also by the threads prefetching cached values
+        self.lock = threading.Lock()
+
+    def blob_pathname(self, key):
+        """
+        Get pathname of blob
+        :param key: blob key
+        :return: pathname
+        """
+
+        return os.path.join(self.path, key[:2], key)
+
+    def put_blob(self, data):
+        """
+        Store blob, if not already stored
+        :param data: bytes
+        :return: blob key
+        """
+
+        key = hashlib.sha256(data).hexdigest()
+        pathname = self.blob_pathname(key)
+
+        if not os.path.isfile(pathname):
+            os.makedirs(os.path.dirname(pathname), exist_ok=True)
+            # write to temporary file and rename, so that concurrent readers never see partial blobs
+            tmp_pathname = temp_pathname(pathname)
+            with open(tmp_pathname, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_pathname, pathname)
+
+        return key
+
+    def get_blob(self, key):
+        """
+        Get blob, from memory if recently read. The least recently used blobs are evicted from memory
+        when their total size exceeds cache_size.
+        :param key: blob key
+        :return: bytes
+        """
+
+        with self.lock:
+            data = self.blobs.get(key)
+            if data is not None:
+                self.blobs.move_to_end(key)
+                return data
+
+        with open(self.blob_pathname(key), 'rb') as f:
+            data = f.read()
+
+        if len(data) <= self.cache_size:
+            with self.lock:
+                if key not in self.blobs:
+                    self.blobs[key] = data
+                    self.blobs_size += len(data)
+
+                while self.blobs_size > self.cache_size:
+                    _, evicted = self.blobs.popitem(last=False)
+                    self.blobs_size -= len(evicted)
+
+        return data
+
+    def split_payload(self, payload):
+        """
+        Replace large payload with blob reference
+        :param payload: string or list of strings
+        :return: payload or blob reference
+        """
+
+        if isinstance(payload, list) and all(isinstance(x, str) for x in payload):
+            payload = ''.join(payload)
+
+        # UTF-8 characters take at most 4 bytes: shorter payloads are not encoded
+        if isinstance(payload, str) and 4 * len(payload) > self.threshold:
+            data = payload.encode('utf-8')
+            if len(data) > self.threshold:
+                return {'pynb_blob': self.put_blob(data)}
+
+        return payload
+
+    def join_payload(self, payload):
+        """
+        Replace blob reference with payload
+        :param payload: payload or blob reference
+        :return: payload
+        """
+
+        if isinstance(payload, dict) and 'pynb_blob' in payload:
+            return self.get_blob(payload['pynb_blob']).decode('utf-8')
+
+        return payload
+
+    def map_payloads(self, outputs, func):
+        """
+        Apply func to payloads of outputs
+        :param outputs: list of outputs as dicts
+        :param func: function applied to payloads
+        :return: list of outputs
+        """
+
+        outputs = [dict(out) for out in outputs]
+
+        for out in outputs:
+            if 'data' in out:
+                out['data'] = {mime: func(payload) for mime, payload in out['data'].items()}
+            if out.get('output_type') == 'stream':
+                out['text'] = func(out['text'])
+
+        return outputs
+
+    def dump(self, value, pathname, metadata=None):
+        """
+        Store cell value
+        :param value: (reply, outputs) tuple
+        :param pathname: pathname of manifest
+        :param metadata: metadata of cache entry as dict, e.g. execution time of the cell (optional)
+        :return: size of manifest in bytes
+        """
+
+        reply, outputs = value
+
+        manifest = {'reply': {'content': reply['content']} if reply else None,
+                    'outputs': self.map_payloads(outputs, self.split_payload),
+                    'metadata': metadata or {}}
+
+        # write to temporary file and rename, so that readers never see partial manifests,
+        # e.g. while manifests are written in the background
+        tmp_pathname = temp_pathname(pathname)
+        with open(tmp_pathname, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, default=str)
+        os.replace(tmp_pathname, pathname)
+
+        return os.path.getsize(pathname)
+
+    def load(self, pathname):
+        """
+        Load cell value. The manifest is read first, blobs are read only if not in memory.
+        :param pathname: pathname of manifest
+        :return: (reply, outputs) tuple
+        """
+
+        return self.load_entry(pathname)[0]
+
+    def load_entry(self, pathname):
+        """
+        Load cell value and metadata of cache entry
+        :param pathname: pathname of manifest
+        :return: ((reply, outputs), metadata) tuple
+        """
+
+        with open(pathname, encoding='utf-8') as f:
+            manifest = json.load(f)
+
+        outputs = nbf.from_dict(self.map_payloads(manifest['outputs'], self.join_payload))
+
+        return (manifest['reply'], outputs), manifest.get('metadata', {})
+
+
+def spill_outputs(outputs, max_size, path):
+    """
+    Limit size of stream outputs. Consecutive stream outputs with the same name are merged and, if larger than
+    max_size characters, only their head and tail are kept. The full stream is written to a file in directory
+    path, named after the hash of its content, and a link to it is added to the outputs. The absolute pathname
+    of the file is recorded in the metadata of the link (key SPILLED_KEY), so that exporters can link the file
+    relatively to the exported notebook.
+    :param outputs: list of cell outputs
+    :param max_size: maximum size of a stream output in characters
+    :param path: directory of spilled outputs
+    :return: list of cell outputs
+    """
+
+    merged = []
+    for out in outputs:
+        if out.output_type == 'stream' and merged and merged[-1].output_type == 'stream' and \
+                merged[-1].name == out.name:
+            merged[-1] = nbf.v4.new_output('stream', name=out.name, text=merged[-1].text + out.text)
+        else:
+            merged.append(out)
+
+    limited = []
+    for out in merged:
+        if out.output_type != 'stream' or len(out.text) <= max_size:
+            limited.append(out)
+            continue
+
+        text = out.text
+        key = hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+        pathname = os.path.abspath(os.path.join(path, '{}.txt'.format(key)))
+
+        if not os.path.isfile(pathname):
+            os.makedirs(path, exist_ok=True)
+            with open(pathname, 'w', encoding='utf-8') as f:
+                f.write(text)
+
+        # keep whole lines of head and tail, if possible
+        head = text[:max_size // 2]
+        head = head[:head.rfind('\n') + 1] or head
+        tail = text[-(max_size - len(head)):] if max_size > len(head) else ''
+        tail = tail[tail.find('\n') + 1:] if '\n' in tail[:-1] else tail
+
+        truncated = '[... {} characters truncated, full output linked below ...]\n'.format(
+            len(text) - len(head) - len(tail))
+        limited.append(nbf.v4.new_output('stream', name=out.name, text=head + truncated + tail))
+        limited.append(nbf.v4.new_output('display_data', data={
+            'text/plain': 'Full output: {}'.format(pathname),
+            'text/html': '<a href="{}">Full output ({} characters)</a>'.format(pathname, len(text))},
+            metadata={SPILLED_KEY: pathname}))
+
+    return limited
@@ -5,6 +5,7 @@ Utility functions
 import logging
 import os
 import sys
+import uuid
 
 
 def get_func(func_name, module_pathname):
@@ -49,3 +50,50 @@ def check_isfile(pathname):
 def print_console(m):
     with open('/dev/stdout', 'w') as f:
         f.write('{}\n'.format(m))
+
+
+def print_output(out):
+    """
+    Print cell output to stderr
+    :param out: cell output
+    :return:
+    """
+
+    if out.output_type == 'stream':
+        text = out.text
+    elif out.output_type == 'error':
+        text = '\n'.join(out.traceback) + '\n'
+    elif 'text/plain' in out.get('data', {}):
+        text = out.data['text/plain'] + '\n'
+    else:
+        text = '<{}>\n'.format(', '.join(out.get('data', {}).keys()))
+
+    sys.stderr.write(text)
+    sys.stderr.flush()
+
+
+def temp_pathname(pathname):
+    """
+    Get pathname of a temporary file renamed to pathname when complete, unique across the processes and hosts
+    sharing its directory
+    :param pathname: pathname
+    :return: temporary pathname
+    """
+
+    return '{}.{}.tmp'.format(pathname, uuid.uuid4().hex)
+
+
+def read_ahead(pathname, chunk_size=1 << 20):
+    """
+    Read file and discard its content, so that it is served from the page cache when read again
+    :param pathname: pathname
+    :param chunk_size: size of read chunks in bytes (optional)
+    :return: number of bytes read
+    """
+
+    size = 0
+    with open(pathname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            size += len(chunk)
+
+    return size
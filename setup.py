@@ -16,7 +16,7 @@ setup(
     license='MIT',
     description='Manage Jupyter notebooks as Python code with embedded Markdown text.',
     long_description=long_description,
-    python_requires=">=3.4",
+    python_requires=">=3.8",
     install_requires=[
         "jupyter",
         "nbconvert",
@@ -1,5 +1,10 @@
+import json
 import os
+import signal
 import subprocess
+import time
+
+import pytest
 
 
 def local(args):
@@ -37,6 +42,21 @@ def markdown():
     '''
 
 
+def ranges():
+    x = 10000
+
+    '''
+    # Middle
+    '''
+
+    x + 1
+
+    '''
+    '''
+
+    x + 2
+
+
 def test_pynb_cells_default_params():
     cmd = 'pynb {}:cells_default_params --disable-cache --export-ipynb -'
     output = local(cmd.format(os.path.realpath(__file__)))
@@ -73,6 +93,15 @@ def test_pynb_sum():
     assert b'54321' in output
 
 
+def test_pynb_sum_cached_params(tmpdir):
+    # cells depend on the injected parameters: the cache is shared by the executions of a parameter sweep
+    cmd = 'pynb {}:sum --param a={} --param b=10 --cache-dir {} --export-ipynb -'
+    for a in [1, 2, 1]:
+        output = local(cmd.format(os.path.realpath(__file__), a, tmpdir))
+        assert '"{}"'.format(a + 10).encode() in output
+    assert b'Running:' not in output
+
+
 def test_pynb_export_ipynb(tmpdir):
     cmd = 'pynb {} --disable-cache --export-ipynb {}/test.ipynb'
     local(cmd.format(os.path.realpath(__file__), tmpdir))
@@ -110,3 +139,387 @@ def test_pynb_set_kernel(tmpdir):
     cmd = 'jupyter nbconvert --stdout --to notebook {}/test.ipynb'
     output = local(cmd.format(tmpdir))
     assert b'python3' in output
+
+
+def test_pynb_watch(tmpdir):
+    pathname = '{}/watch.py'.format(tmpdir)
+    out = '{}/watch.ipynb'.format(tmpdir)
+
+    with open(pathname, 'w') as f:
+        f.write('def cells():\n    10000 + 1111\n')
+
+    p = subprocess.Popen(['pynb', pathname, '--watch', '--watch-interval', '0.1', '--export-ipynb', out])
+
+    try:
+        for expected, source in [('11111', '10000 + 2222'), ('12222', None)]:
+            for i in range(100):
+                if os.path.isfile(out) and expected in open(out).read():
+                    break
+                time.sleep(0.2)
+            assert expected in open(out).read()
+
+            if source:
+                with open(pathname, 'w') as f:
+                    f.write('def cells():\n    {}\n'.format(source))
+    finally:
+        p.send_signal(signal.SIGINT)
+        p.wait()
+
+
+def test_pynb_watch_fork_checkpoints(tmpdir):
+    pathname = '{}/watch.py'.format(tmpdir)
+    out = '{}/watch.ipynb'.format(tmpdir)
+
+    source = "def cells():\n    g = iter(range(10))\n\n    '''\n    '''\n\n    next(g) + {}\n"
+
+    with open(pathname, 'w') as f:
+        f.write(source.format(10000))
+
+    p = subprocess.Popen(['pynb', pathname, '--watch', '--watch-interval', '0.1', '--fork-checkpoints',
+                          '--export-ipynb', out])
+
+    try:
+        # the second execution restores the checkpoint of the first cell: next(g) is 0 again
+        for expected, value in [('10000', 20000), ('20000', None)]:
+            for i in range(100):
+                if os.path.isfile(out) and expected in open(out).read():
+                    break
+                time.sleep(0.2)
+            assert expected in open(out).read()
+
+            if value:
+                with open(pathname, 'w') as f:
+                    f.write(source.format(value))
+    finally:
+        p.send_signal(signal.SIGINT)
+        p.wait()
+
+
+def test_pynb_cell_range():
+    cmd = 'pynb {}:ranges --disable-cache --until Middle --export-ipynb -'
+    output = local(cmd.format(os.path.realpath(__file__)))
+    assert b'10001' not in output and b'10002' not in output
+
+    cmd = 'pynb {}:ranges --ignore-cache --cells :2 --export-ipynb -'
+    output = local(cmd.format(os.path.realpath(__file__)))
+    assert b'10001' in output and b'10002' not in output
+
+    # cells 0 and 2 are loaded from cache, cell 3 is executed restoring the session of cell 2
+    cmd = 'pynb {}:ranges --ignore-cache --from 3 --export-ipynb -'
+    output = local(cmd.format(os.path.realpath(__file__)))
+    assert b'10001' in output and b'10002' in output
+
+
+def snapshots():
+    x = 10000
+
+    '''
+    '''
+
+    g = (i for i in range(10))
+
+    '''
+    '''
+
+    x + next(g) + 5
+
+
+def test_pynb_async_snapshots(tmpdir):
+    cmd = 'pynb {}:snapshots --async-snapshots --cache-dir {} --export-ipynb -'.format(
+        os.path.realpath(__file__), tmpdir)
+
+    output = local(cmd)
+    assert b'10005' in output
+    assert b'serialization failed' in output
+
+    # the session of the first cell has been dumped in the background, the iterator cannot be serialized
+    output = local(cmd)
+    assert b'10005' in output
+    assert b'Loading: "x = 10000' in output
+    assert b'Running: "g = (i for i in range(10))' in output
+    assert not [f for f in os.listdir(str(tmpdir)) if f.endswith('.tmp') or f.endswith('.err')]
+
+    # the in-process shell cannot take background snapshots
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        local(cmd + ' --in-process')
+    assert b'--in-process, --async-snapshots are mutually exclusive' in e.value.output
+
+
+def test_pynb_async_snapshots_execution_counts(tmpdir):
+    cmd = 'pynb {}:ranges --cache-dir {}/{} --export-ipynb {}/{}.ipynb {}'
+
+    # execution counts are identical to those of synchronous dumps, also when sessions are loaded
+    counts = []
+    for name, option in [('sync', ''), ('async', '--async-snapshots')]:
+        local(cmd.format(os.path.realpath(__file__), tmpdir, name, tmpdir, name, option))
+        local(cmd.format(os.path.realpath(__file__), tmpdir, name, tmpdir, name, option + ' --ignore-cache --from 2'))
+        nb = json.load(open('{}/{}.ipynb'.format(tmpdir, name)))
+        counts.append([cell.get('execution_count') for cell in nb['cells']])
+
+    assert counts[0] == counts[1]
+
+
+def test_pynb_cache_stats(tmpdir):
+    cmd = 'pynb {}:ranges --cache-dir {} --metrics-file {}/metrics.json'.format(
+        os.path.realpath(__file__), tmpdir, tmpdir)
+
+    local(cmd)
+    output = local(cmd)
+    assert b'Cache: 3 hits, 0 misses' in output
+    assert json.load(open('{}/metrics.json'.format(tmpdir)))['hits'] == 3
+
+    output = json.loads(local('pynb cache stats --json --notebook ranges --cache-dir {}'.format(tmpdir)))
+    assert output['notebooks'][0]['runs'] == 2
+    assert output['notebooks'][0]['hits'] == 3 and output['notebooks'][0]['misses'] == 3
+
+    output = local('pynb cache stats --cache-dir {}'.format(tmpdir))
+    assert b'50.0%' in output and b'Cache disk usage' in output
+
+
+def test_pynb_dedup_sessions(tmpdir):
+    cmd = 'pynb {}:ranges --dedup-sessions --cache-dir {} --export-ipynb -'.format(os.path.realpath(__file__), tmpdir)
+
+    local(cmd)
+    assert not [f for f in os.listdir(str(tmpdir)) if f.endswith('.dill')]
+    assert [f for f in os.listdir(str(tmpdir)) if f.endswith('.chunks')]
+
+    # sessions rebuilt from chunks to execute the last cell
+    output = local(cmd + ' --ignore-cache --from 3')
+    assert b'Running: "x + 2' in output and b'10002' in output
+
+    output = json.loads(local('pynb cache stats --json --cache-dir {}'.format(tmpdir)))
+    assert output['chunks']['count'] > 0
+
+    for f in os.listdir(str(tmpdir)):
+        if f.endswith('.chunks'):
+            os.remove(os.path.join(str(tmpdir), f))
+
+    assert b'Freed' in local('pynb cache gc --cache-dir {}'.format(tmpdir))
+    output = json.loads(local('pynb cache stats --json --cache-dir {}'.format(tmpdir)))
+    assert output['chunks']['count'] == 0
+
+
+def profiled():
+    import time
+
+    x = 10000
+
+    '''
+    '''
+
+    def slow():
+        time.sleep(0.5)
+        return x + 3
+
+    slow()
+
+
+def test_pynb_profile_cells(tmpdir):
+    # the notebook is not taken as the value of --profile-cells
+    cmd = 'pynb --profile-cells {}:profiled --profile-threshold 0.3 --cache-dir {} --export-ipynb {}/profiled.ipynb'
+    local(cmd.format(os.path.realpath(__file__), tmpdir, tmpdir))
+
+    # only the slow cell is profiled, the source of cells is unchanged
+    nb = json.load(open('{}/profiled.ipynb'.format(tmpdir)))
+    assert 'pynb' not in nb['cells'][0]['metadata']
+    profile = nb['cells'][1]['metadata']['pynb']['profile']
+    assert any(f['function'].endswith('(slow)') for f in profile['functions'])
+    assert profile['total_time'] >= 0.5
+    assert profile['pstats'] == '{}/profiled-cell1.pstats'.format(tmpdir)
+    assert os.path.isfile(profile['pstats'])
+    assert ''.join(nb['cells'][1]['source']).endswith('slow()')
+    assert '10003' in json.dumps(nb['cells'][1]['outputs'])
+
+
+def memoized(n):
+    from pynb.memoize import memoize
+
+    @memoize
+    def query(n):
+        print('querying')
+        return int(n) + 10000
+
+    query(n)
+
+
+def test_pynb_memoize(tmpdir):
+    cmd = 'pynb {}:memoized --param n={{}} --disable-cache --cache-dir {} --export-ipynb -'.format(
+        os.path.realpath(__file__), tmpdir)
+
+    # stream output of the call, not the source of the cell
+    output = local(cmd.format(7))
+    assert b'"querying\\n"' in output and b'10007' in output
+    assert len(os.listdir('{}/pynb-cache-memo'.format(tmpdir))) == 1
+
+    # results reused across executions, also in process
+    output = local(cmd.format(7) + ' --in-process')
+    assert b'"querying\\n"' not in output and b'10007' in output
+
+    output = local(cmd.format(8))
+    assert b'"querying\\n"' in output and b'10008' in output
+
+
+def test_pynb_in_process(tmpdir):
+    cmd = 'pynb {}:ranges --in-process --cache-dir {} --export-ipynb -'.format(os.path.realpath(__file__), tmpdir)
+
+    output = local(cmd)
+    assert b'10001' in output and b'10002' in output
+    assert b'"execution_count": 5' in output
+
+    # the session of the cell before the last cell is restored from cache to execute the last cell
+    output = local(cmd + ' --ignore-cache --from 3')
+    assert b'Skipping, loading from cache: "x + 1' in output
+    assert b'Running: "x + 2' in output
+    assert b'10001' in output and b'10002' in output
+
+    # options selecting how cells are executed are mutually exclusive
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        local(cmd + ' --fork-checkpoints')
+    assert b'--fork-checkpoints, --in-process are mutually exclusive' in e.value.output
+
+
+def spill():
+    for i in range(10000):
+        print('line {}'.format(i))
+
+
+def test_pynb_max_output_size(tmpdir):
+    cmd = 'pynb {}:spill --disable-cache --max-output-size 1000 --spill-dir {} --export-ipynb -'
+    output = local(cmd.format(os.path.realpath(__file__), tmpdir))
+    assert b'line 10' in output and b'line 9999' in output and b'line 5000' not in output
+    assert b'characters truncated' in output
+
+    spilled = [f for f in os.listdir(str(tmpdir)) if f.endswith('.txt')]
+    assert len(spilled) == 1
+    assert open('{}/{}'.format(tmpdir, spilled[0])).read().count('line') == 10000
+
+    # spilled outputs are linked relatively to the exported notebooks, also when loaded from cache
+    cmd = 'cd {} && pynb {}:spill --cache-dir {} --max-output-size 1000 --spill-dir outputs --export-ipynb {}/nb.ipynb'
+    cmd += ' --export-html {}/nb.html'
+    export = tmpdir.mkdir('export')
+    for i in range(2):
+        local(cmd.format(tmpdir, os.path.realpath(__file__), tmpdir, export, export))
+        assert 'Full output: ../outputs/{}'.format(spilled[0]) in open('{}/export/nb.ipynb'.format(tmpdir)).read()
+        assert 'href="../outputs/{}"'.format(spilled[0]) in open('{}/export/nb.html'.format(tmpdir)).read()
+
+
+def streamed():
+    for i in range(3):
+        print('streamed {}'.format(i))
+
+
+def test_pynb_stream(tmpdir):
+    pathname = '{}/nb.ipynb'.format(tmpdir)
+    cmd = ['pynb', '{}:streamed'.format(os.path.realpath(__file__)), '--disable-cache', '--export-ipynb', pathname]
+
+    # cell outputs are printed to stderr only with --stream
+    p = subprocess.run(cmd + ['--stream'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    assert b'streamed 0\nstreamed 1\nstreamed 2\n' in p.stderr
+    assert 'streamed 2' in json.dumps(json.load(open(pathname))['cells'][0]['outputs'])
+
+    os.remove(pathname)
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    assert b'streamed 0' not in p.stderr
+    assert 'streamed 2' in json.dumps(json.load(open(pathname))['cells'][0]['outputs'])
+
+
+def test_pynb_convert(tmpdir):
+    notebooks = os.path.dirname(os.path.realpath(__file__)) + '/../notebooks'
+
+    cmd = 'pynb convert {} --to ipynb --output-dir {}/ipynb --jobs 2'
+    output = local(cmd.format(notebooks, tmpdir))
+    assert b'Converted: 5, skipped: 0, failed: 0' in output
+
+    cmd = 'pynb convert "{}/ipynb/*.ipynb" --to pynb --output-dir {}/pynb --jobs 2'
+    output = local(cmd.format(tmpdir, tmpdir))
+    assert b'Converted: 5, skipped: 0, failed: 0' in output
+    assert 'a + b' in open('{}/pynb/sum.py'.format(tmpdir)).read()
+
+    # outputs newer than sources are skipped
+    cmd = 'pynb convert {} --to ipynb --output-dir {}/ipynb'
+    output = local(cmd.format(notebooks, tmpdir))
+    assert b'Converted: 0, skipped: 5, failed: 0' in output
+
+
+def test_pynb_project(tmpdir):
+    with open('{}/a.py'.format(tmpdir), 'w') as f:
+        f.write("def cells(n=3):\n    open('a.txt', 'w').write(str(int(n) * 2))\n")
+
+    with open('{}/b.py'.format(tmpdir), 'w') as f:
+        f.write("def cells(k=1):\n    from helper import inc\n    open('b.txt', 'w').write(str(inc(int(open('a.txt').read()), int(k))))\n")
+
+    with open('{}/helper.py'.format(tmpdir), 'w') as f:
+        f.write('def inc(x, k):\n    return x + k\n')
+
+    manifest = {'notebooks': {
+        'a': {'cells': 'a.py', 'params': {'n': 5}, 'outputs': ['a.txt']},
+        'b': {'cells': 'b.py', 'inputs': ['a.txt'], 'outputs': ['b.txt'], 'export_ipynb': 'b.ipynb'}}}
+
+    with open('{}/pynb.json'.format(tmpdir), 'w') as f:
+        json.dump(manifest, f)
+
+    cmd = 'pynb project {}/pynb.json --log-level INFO --disable-cache'
+    output = local(cmd.format(tmpdir))
+    assert b'Notebook a: executed' in output
+    assert b'Notebook b: executed' in output
+    assert open('{}/b.txt'.format(tmpdir)).read() == '11'
+    assert os.path.isfile('{}/b.ipynb'.format(tmpdir))
+
+    # nothing changed: both notebooks are skipped
+    output = local(cmd.format(tmpdir))
+    assert b'Notebook a: skipped' in output
+    assert b'Notebook b: skipped' in output
+
+    # changed params of b: a is skipped, b is executed
+    manifest['notebooks']['b']['params'] = {'k': 2}
+    with open('{}/pynb.json'.format(tmpdir), 'w') as f:
+        json.dump(manifest, f)
+
+    output = local(cmd.format(tmpdir))
+    assert b'Notebook a: skipped' in output
+    assert b'Notebook b: executed' in output
+    assert open('{}/b.txt'.format(tmpdir)).read() == '12'
+
+    # changed project-local module imported by b: b is executed
+    with open('{}/helper.py'.format(tmpdir), 'w') as f:
+        f.write('def inc(x, k):\n    return x + 2 * k\n')
+
+    output = local(cmd.format(tmpdir))
+    assert b'Notebook a: skipped' in output
+    assert b'Notebook b: executed' in output
+    assert open('{}/b.txt'.format(tmpdir)).read() == '14'
+
+
+def test_pynb_check(tmpdir):
+    notebooks = os.path.dirname(os.path.realpath(__file__)) + '/../notebooks'
+
+    output = local('pynb check {} --jobs 2'.format(notebooks))
+    assert b'Checked 5 files' in output
+
+    with open('{}/typo.py'.format(tmpdir), 'w') as f:
+        f.write("def cells(a):\n    total = int(a)\n    print(totl)\n")
+
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        local('pynb {}/typo.py --check-syntax --param a=1'.format(tmpdir))
+    assert b"Cell 1, line 2: undefined name 'totl'" in e.value.output
+
+
+def test_pynb_local_modules(tmpdir):
+    with open('{}/helper.py'.format(tmpdir), 'w') as f:
+        f.write('def inc(x):\n    return x + 1\n')
+
+    with open('{}/nb.py'.format(tmpdir), 'w') as f:
+        f.write("def cells():\n    x = 100\n\n    '''\n    '''\n\n    from helper import inc\n    inc(x)\n")
+
+    cmd = 'cd {} && pynb nb.py --export-ipynb nb.ipynb'.format(tmpdir)
+    local(cmd)
+    assert '"101"' in open('{}/nb.ipynb'.format(tmpdir)).read()
+
+    # the cell importing the modified module is executed again, the first cell is loaded from cache
+    with open('{}/helper.py'.format(tmpdir), 'w') as f:
+        f.write('def inc(x):\n    return x + 2\n')
+
+    output = local(cmd)
+    assert '"102"' in open('{}/nb.ipynb'.format(tmpdir)).read()
+    assert b'Loading: "x = 100' in output
+    assert b'Running: "from helper import inc' in output
@@ -0,0 +1,40 @@
+import nbformat as nbf
+
+from pynb.check import check_cells, check_file
+
+
+def test_check_cells():
+    cells = [nbf.v4.new_markdown_cell('# Title'),
+             nbf.v4.new_code_cell('%matplotlib inline\nimport math\n\ndef f(y):\n    return math.sqrt(y) + z'),
+             nbf.v4.new_code_cell('z = 3\nprint(f(z), w)'),
+             nbf.v4.new_code_cell('class C:\n    k = undefined_global\nw = 1'),
+             nbf.v4.new_code_cell('for i in range(:\n    pass')]
+
+    assert check_cells(cells) == [(1, 5, "undefined name 'z'"),
+                                  (2, 2, "undefined name 'w'"),
+                                  (3, 2, "undefined name 'undefined_global'"),
+                                  (4, 1, 'syntax error: invalid syntax')]
+
+
+def test_check_cells_order():
+    cells = [nbf.v4.new_code_cell('x = x + 1\ny += 1\nz = [k for k in range(3) if k < n]'),
+             nbf.v4.new_code_cell('def f():\n    return later\n\nsquares = [i * i for i in range(later)]'),
+             nbf.v4.new_code_cell('later = 3\nfor j in range(later):\n    total = j if j == 0 else total + j'),
+             nbf.v4.new_code_cell('def g():\n    return f() + h() + total\n\ndef h():\n    return 0')]
+
+    assert check_cells(cells) == [(0, 1, "undefined name 'x'"),
+                                  (0, 2, "undefined name 'y'"),
+                                  (0, 3, "undefined name 'n'"),
+                                  (1, 4, "undefined name 'later'"),
+                                  (2, 3, "undefined name 'total'")]
+
+
+def test_check_file(tmpdir):
+    pathname = '{}/nb.py'.format(tmpdir)
+    with open(pathname, 'w') as f:
+        f.write("def cells(a, b=2):\n    '''\n    # Title\n    '''\n\n    print(a + b + c)\n")
+
+    assert check_file(pathname, params=['b', 'd']) == [
+        '{}: unknown parameter d'.format(pathname),
+        '{}: missing parameter a'.format(pathname),
+        "{}: cell 2, line 1: undefined name 'c'".format(pathname)]
@@ -0,0 +1,58 @@
+import os
+import random
+
+from pynb.chunks import ChunkStore, chunk_boundaries
+
+
+def random_pickle(rng, size):
+    # random bytes with frequent MEMOIZE opcodes, as in pickles
+    return bytes(rng.choice(b'\x94abcdefgh') for _ in range(size))
+
+
+def test_chunk_boundaries():
+    rng = random.Random(0)
+    data = random_pickle(rng, 2000000)
+    boundaries = chunk_boundaries(data)
+
+    assert boundaries[-1] == len(data)
+    sizes = [end - start for start, end in zip([0] + boundaries, boundaries)]
+    assert all(4 * 1024 <= size <= 256 * 1024 for size in sizes[:-1])
+
+    # boundaries are found again after an insertion
+    shifted = chunk_boundaries(random_pickle(rng, 1000) + data)
+    assert len(set(end - 1000 for end in shifted) & set(boundaries)) >= len(boundaries) - 1
+
+
+def test_chunk_store(tmpdir):
+    store = ChunkStore('{}/chunks'.format(tmpdir))
+    rng = random.Random(0)
+    data = random_pickle(rng, 1000000)
+
+    fname_a, fname_b = '{}/a.dill'.format(tmpdir), '{}/b.dill'.format(tmpdir)
+    for fname, content in [(fname_a, data), (fname_b, data + random_pickle(rng, 1000))]:
+        with open(fname, 'wb') as f:
+            f.write(content)
+
+    written_a = store.put(fname_a)
+    written_b = store.put(fname_b)
+
+    # dill files replaced by recipes, second session stored mostly as references to the first
+    assert not os.path.isfile(fname_a) and store.exists(fname_a)
+    assert written_b < written_a / 10
+    assert store.size(fname_b) == len(data) + 1000
+
+    with store.open_session(fname_a) as pathname:
+        assert open(pathname, 'rb').read() == data
+    assert not os.path.isfile(pathname)
+
+    count, stored, referenced = store.stats()
+    assert stored < len(data) * 1.1 and referenced == 2 * len(data) + 1000
+
+    # chunks freed when no longer referred to
+    store.remove(fname_a)
+    count, _, referenced = store.stats()
+    assert not store.exists(fname_a) and referenced == len(data) + 1000
+
+    os.remove(store.recipe_pathname(fname_b))
+    assert store.gc(str(tmpdir))[0] == count
+    assert store.stats() == (0, 0, 0)
@@ -1,7 +1,13 @@
+import asyncio
 import os
 
 import subprocess
-from pynb.notebook import Notebook
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from pynb.notebook import CachedExecutePreprocessor, Notebook
+from pynb.store import OutputStore
 
 
 def local(args):
@@ -27,6 +33,140 @@ def test_custom_nbapp():
     assert b'50005000' in output
 
 
+def cells_sum(a, b=1):
+    a + b
+
+
+def test_execute_many_async():
+    jobs = [(cells_sum, {'a': 10000}), (cells_sum, {'a': 20000, 'b': 2}), (cells_sum, {'a': 30000})]
+    results = asyncio.run(Notebook.execute_many_async(jobs, concurrency=2, disable_cache=True))
+
+    for (nb, cell_results), expected in zip(results, ['10001', '20002', '30001']):
+        assert expected in nb.cells[-1].outputs[0]['data']['text/plain']
+        assert [r['status'] for r in cell_results] == ['ok', 'ok']
+        assert not any(r['cached'] for r in cell_results)
+
+
+def test_execute_many_in_process():
+    jobs = [(cells_sum, {'a': 10000}), (cells_sum, {'a': 20000, 'b': 2})]
+    results = asyncio.run(Notebook.execute_many_async(jobs, concurrency=2, disable_cache=True, in_process=True))
+
+    # notebooks share the in-process shell, executing one at a time from a clean state
+    for (nb, cell_results), expected in zip(results, ['10001', '20002']):
+        assert expected in nb.cells[-1].outputs[0]['data']['text/plain']
+        assert [cell.execution_count for cell in nb.cells] == [1, 2]
+
+    with pytest.raises(ValueError):
+        Notebook.execute(cells_sum, {'a': 1}, disable_cache=True, in_process=True, fork_checkpoints=True)
+
+
+def test_prefetch(tmpdir):
+    nb = Notebook()
+    uid = nb.add_func(cells_sum, {'a': 40000})
+    nb.process(uid=uid, cache_dir=str(tmpdir))
+
+    # both cells are cached: their values are read ahead, and then loaded from memory
+    nb = Notebook()
+    nb.add_func(cells_sum, {'a': 40000})
+    ep = CachedExecutePreprocessor()
+    ep.uid, ep.cache_dir, ep.store = uid, str(tmpdir), OutputStore('{}/pynb-cache-blobs'.format(tmpdir))
+
+    with ThreadPoolExecutor() as executor:
+        ep.prefetch(nb.nb, executor)
+
+    assert len(ep.prefetched) == 2
+    nb.process(uid=uid, cache_dir=str(tmpdir), ep=ep)
+    assert not ep.prefetched
+    assert all(r['cached'] for r in nb.cell_results)
+    assert '40001' in nb.nb.cells[-1].outputs[0]['data']['text/plain']
+
+
+def cells_memoized(n):
+    from pynb.memoize import memoize
+
+    @memoize
+    def double(n):
+        return 2 * int(n)
+
+    double(n)
+
+
+def test_execute_cache_dir(tmpdir):
+    from jupyter_client import KernelManager
+
+    # memoized functions use the cache directory of each execution, also in kernels started by the caller
+    km = KernelManager(kernel_name='python3')
+    km.start_kernel()
+    try:
+        for name in ['a', 'b']:
+            nb = Notebook()
+            uid = nb.add_func(cells_memoized, {'n': 3})
+            nb.process(uid=uid, km=km, disable_cache=True, cache_dir='{}/{}'.format(tmpdir, name))
+    finally:
+        km.shutdown_kernel(now=True)
+
+    Notebook.execute(cells_memoized, {'n': 3}, disable_cache=True, cache_dir='{}/c'.format(tmpdir))
+    Notebook.execute(cells_memoized, {'n': 3}, disable_cache=True, cache_dir='{}/d'.format(tmpdir), in_process=True)
+
+    for name in ['a', 'b', 'c', 'd']:
+        assert len(os.listdir('{}/{}/pynb-cache-memo'.format(tmpdir, name))) == 1
+    assert 'PYNB_CACHE_DIR' not in os.environ
+
+
+def cells_fetch(n=3):
+    class Table:
+        def __init__(self, rows):
+            self.rows = rows
+
+    data = bytearray(int(n))
+
+    '''
+    '''
+
+    table = Table(list(range(int(n))))
+
+
+def test_execute_fetch(tmpdir):
+    # the second execution loads the cells from cache, restoring the session of the last cell
+    for i in range(2):
+        values = Notebook.execute(cells_fetch, {'n': 1000}, fetch=['table', 'data'], cache_dir=str(tmpdir))
+        assert values['table'].rows == list(range(1000))
+        assert values['data'] == bytearray(1000)
+
+    values = Notebook.execute(cells_fetch, fetch=['table'], disable_cache=True, in_process=True)
+    assert values['table'].rows == [0, 1, 2]
+
+    with pytest.raises(RuntimeError):
+        Notebook.execute(cells_fetch, fetch=['missing'], disable_cache=True)
+
+
+def cells_failing(n=3):
+    data = bytearray(int(n))
+
+    '''
+    '''
+
+    1 / 0
+
+
+def test_execute_failing_metadata(tmpdir):
+    from nbconvert.preprocessors.execute import CellExecutionError
+    from pynb.metrics import StatsDB, stats_pathname
+
+    for name, kwargs in [('sync', {}), ('async', {'async_snapshots': True})]:
+        cache_dir = '{}/{}'.format(tmpdir, name)
+        with pytest.raises(CellExecutionError):
+            Notebook.execute(cells_failing, {'n': 1000}, cache_dir=cache_dir, **kwargs)
+
+        # cache entries record the size of the session dumped after the cell
+        store = OutputStore('{}/pynb-cache-blobs'.format(cache_dir))
+        entries = [store.load_entry(os.path.join(cache_dir, f))[1] for f in os.listdir(cache_dir) if f.endswith('-value.json')]
+        assert entries and all(e['session_size'] > 1000 and 'exec_time' in e for e in entries)
+
+        # failed executions are recorded in the stats database
+        assert StatsDB(stats_pathname(cache_dir)).query()[0]['runs'] == 1
+
+
 #############################################################################
 if __name__ == "__main__":
     main()
@@ -0,0 +1,17 @@
+import os
+
+from pynb.convert import find_sources
+
+
+def test_find_sources(tmpdir, monkeypatch):
+    for name in ['a', 'b']:
+        os.makedirs('{}/src/{}'.format(tmpdir, name))
+        open('{}/src/{}/x.ipynb'.format(tmpdir, name), 'w').close()
+
+    # directory structure preserved below the components of glob patterns without wildcards
+    sources = find_sources(['{}/src/**/*.ipynb'.format(tmpdir)], 'pynb')
+    assert sources == [('{}/src/a/x.ipynb'.format(tmpdir), 'a/x.ipynb'), ('{}/src/b/x.ipynb'.format(tmpdir), 'b/x.ipynb')]
+
+    monkeypatch.chdir(str(tmpdir))
+    assert [relpath for _, relpath in find_sources(['src/*/x.ipynb', 'src'], 'pynb')] == ['a/x.ipynb', 'b/x.ipynb'] * 2
+    assert find_sources(['{}/src/a/x.ipynb'.format(tmpdir)], 'pynb')[0][1] == 'x.ipynb'
@@ -0,0 +1,33 @@
+import os
+
+from pynb.deps import LocalModules, get_imports
+
+
+def test_get_imports():
+    assert get_imports('import os.path\nfrom a.b import c') == {'os', 'os.path', 'a', 'a.b', 'a.b.c'}
+    assert get_imports('from .. import x', 'p.q.r') == {'p', 'p.q', 'p.q.x'}
+    assert get_imports('%matplotlib inline') == set()
+
+
+def test_local_modules(tmpdir):
+    os.makedirs('{}/pkg'.format(tmpdir))
+    with open('{}/pkg/__init__.py'.format(tmpdir), 'w') as f:
+        f.write('from .util import twice\n')
+    with open('{}/pkg/util.py'.format(tmpdir), 'w') as f:
+        f.write('import os\n\n\ndef twice(x):\n    return 2 * x\n')
+
+    modules = LocalModules([str(tmpdir)])
+
+    assert modules.digest('import os\nimport nbformat') is None
+    assert modules.dependencies('from pkg import twice') == {'{}/pkg/__init__.py'.format(tmpdir),
+                                                             '{}/pkg/util.py'.format(tmpdir)}
+
+    digest = modules.digest('from pkg import twice')
+    with open('{}/pkg/util.py'.format(tmpdir), 'a') as f:
+        f.write('\n# modified\n')
+    assert modules.digest('from pkg import twice') != digest
+
+    # packages installed by the system or by pip are not project-local
+    assert not modules.is_local('/usr/lib/python3/dist-packages/yaml/__init__.py')
+    assert not modules.is_local('{}/venv/lib/python3.11/site-packages/pkg/util.py'.format(tmpdir))
+    assert modules.is_local('{}/pkg/util.py'.format(tmpdir))
@@ -0,0 +1,105 @@
+import json
+import os
+import signal
+import socket
+import subprocess
+import time
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_coordinator_workers(tmpdir):
+    with open('{}/slow.py'.format(tmpdir), 'w') as f:
+        f.write("def cells(a, b, delay=0):\n    import time\n    time.sleep(float(delay))\n    int(a) + int(b)\n")
+
+    jobs = [{'notebook': '{}/slow.py'.format(tmpdir), 'params': {'a': a, 'b': 1, 'delay': 3}, 'name': 'sum{}'.format(a)}
+            for a in range(4)]
+    with open('{}/jobs.json'.format(tmpdir), 'w') as f:
+        json.dump(jobs, f)
+
+    address = 'tcp://127.0.0.1:{}'.format(free_port())
+    coordinator = subprocess.Popen(['pynb', 'coordinator', '{}/jobs.json'.format(tmpdir), '--bind', address,
+                                    '--output-dir', '{}/results'.format(tmpdir), '--heartbeat-timeout', '3',
+                                    '--disable-cache'])
+
+    # the first worker crashes while executing its job
+    worker = subprocess.Popen(['pynb', 'worker', address, '--heartbeat-interval', '1'], stderr=subprocess.PIPE)
+    for line in worker.stderr:
+        if b'executing' in line:
+            break
+    time.sleep(1)
+    worker.send_signal(signal.SIGKILL)
+    worker.wait()
+
+    workers = [subprocess.Popen(['pynb', 'worker', address, '--heartbeat-interval', '1']) for i in range(2)]
+
+    assert coordinator.wait(timeout=120) == 0
+    for worker in workers:
+        assert worker.wait(timeout=30) == 0
+
+    results = json.load(open('{}/results/results.json'.format(tmpdir)))
+    assert [r['status'] for r in results] == ['ok'] * 4
+    assert results[0]['attempts'] == 2
+    assert len({r['worker'] for r in results}) == 2
+    assert all(len(r['cells']) == 2 and 'exec_time' in r['cells'][0] for r in results)
+
+    nb = json.load(open('{}/results/sum2.ipynb'.format(tmpdir)))
+    assert nb['cells'][-2]['outputs'][0]['data']['text/plain'] == ['3']
+
+
+def test_stop_lost_worker(tmpdir):
+    import threading
+    import zmq
+    from pynb.distributed import Coordinator
+
+    address = 'tcp://127.0.0.1:{}'.format(free_port())
+    coordinator = Coordinator([{'notebook': '{}/nb.py'.format(tmpdir)}], address=address, heartbeat_timeout=1)
+    thread = threading.Thread(target=coordinator.run)
+    thread.start()
+
+    def connect(identity):
+        sock = zmq.Context.instance().socket(zmq.DEALER)
+        sock.setsockopt(zmq.IDENTITY, identity)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(address)
+        sock.send_json({'type': 'ready'})
+        assert sock.poll(5000)
+        return sock, sock.recv_json()
+
+    # first worker silent while executing its job, considered lost
+    lost, job = connect(b'lost')
+    assert job['type'] == 'job'
+    time.sleep(2)
+
+    # job assigned again and completed by second worker, which is stopped
+    worker, job = connect(b'worker')
+    worker.send_json({'type': 'heartbeat'})
+    assert worker.recv_json() == {'type': 'ack'}
+    worker.send_json({'type': 'result', 'id': job['id'], 'status': 'ok', 'exec_time': 0})
+    assert worker.recv_json() == {'type': 'stop'}
+
+    # lost worker stopped when heard of again
+    lost.send_json({'type': 'heartbeat'})
+    assert lost.poll(5000) and lost.recv_json() == {'type': 'stop'}
+
+    thread.join(timeout=10)
+    assert not thread.is_alive() and coordinator.results[0]['worker'] == 'worker'
+
+
+def test_timeouts(tmpdir):
+    address = 'tcp://127.0.0.1:{}'.format(free_port())
+
+    # worker exits if the coordinator is not responding
+    worker = subprocess.Popen(['pynb', 'worker', address, '--heartbeat-interval', '0.5', '--coordinator-timeout', '2'])
+    assert worker.wait(timeout=30) == 1
+
+    # coordinator fails if no workers connect
+    with open('{}/jobs.json'.format(tmpdir), 'w') as f:
+        json.dump([{'notebook': '{}/nb.py'.format(tmpdir)}], f)
+    coordinator = subprocess.Popen(['pynb', 'coordinator', '{}/jobs.json'.format(tmpdir), '--bind', address,
+                                    '--output-dir', '{}/results'.format(tmpdir), '--no-workers-timeout', '2'])
+    assert coordinator.wait(timeout=30) == 1
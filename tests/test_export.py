@@ -0,0 +1,93 @@
+import os
+
+import nbformat as nbf
+
+from pynb.export import IncrementalNotebookWriter, CachedHTMLExporter, NotebookExporter, extract_assets, dumps_notebook
+
+PNG = 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=='
+
+
+def test_incremental_notebook_writer(tmpdir):
+    pathname = '{}/test.ipynb'.format(tmpdir)
+
+    nb = nbf.v4.new_notebook()
+    nb.cells = [nbf.v4.new_markdown_cell('# Title'),
+                nbf.v4.new_code_cell('print("a\\nb")'),
+                nbf.v4.new_code_cell('x = 1'),
+                nbf.v4.new_code_cell('x')]
+
+    writer = IncrementalNotebookWriter(nb, pathname)
+    assert nbf.read(pathname, as_version=4) == nb
+
+    nb.cells[1].outputs = [nbf.v4.new_output('stream', text='a\nb\n')]
+    writer.update(1, nb.cells[1])
+    assert nbf.read(pathname, as_version=4) == nb
+
+    nb.cells[3].outputs = [nbf.v4.new_output('execute_result', data={'text/plain': '1' * 1000}, execution_count=2)]
+    writer.update(3, nb.cells[3])
+    assert nbf.read(pathname, as_version=4) == nb
+
+    nb.cells[3].outputs = []
+    writer.update(3, nb.cells[3])
+    nbf.validate(nbf.read(pathname, as_version=4))
+    assert nbf.read(pathname, as_version=4) == nb
+
+
+def test_cached_html_exporter(tmpdir):
+    nb = nbf.v4.new_notebook()
+    nb.cells = [nbf.v4.new_markdown_cell('# Title'), nbf.v4.new_code_cell('1 + 1')]
+    nb.cells[1].outputs = [nbf.v4.new_output('display_data', data={'image/png': PNG})]
+
+    extracted = extract_assets(nb, '{}/test.html'.format(tmpdir))
+    assert os.listdir('{}/test_files'.format(tmpdir)) == ['6b7fa434f92a8b80.png']
+
+    # notebook not modified, cells without images shared
+    assert nb.cells[1].outputs[0].data['image/png'] == PNG and 'filenames' not in nb.cells[1].outputs[0].metadata
+    assert extracted.cells[0] is nb.cells[0]
+    nb = extracted
+
+    exporter = CachedHTMLExporter(path='{}/cache'.format(tmpdir))
+    body, resources = exporter.from_notebook_node(nb)
+    assert '>Title<' in body and 'src="test_files/6b7fa434f92a8b80.png"' in body
+
+    # only the modified cell is rendered again
+    rendered = []
+    exporter.render_cell = lambda shell, cell: rendered.append(cell) or 'modified'
+    nb.cells[0].source = '# Modified'
+    assert 'modified' in exporter.from_notebook_node(nb)[0]
+    assert rendered == [nb.cells[0]]
+
+    # rendered cells cached in the cache directory
+    NotebookExporter(cache_dir=str(tmpdir)).dumps_html(nb, cache=True)
+    assert os.listdir('{}/pynb-cache-html'.format(tmpdir))
+
+    # least recently used renderings evicted
+    exporter = CachedHTMLExporter(path='{}/cache'.format(tmpdir), max_size=0)
+    exporter.from_notebook_node(nb)
+    assert not os.listdir('{}/cache'.format(tmpdir))
+
+
+def test_notebook_exporter(tmpdir):
+    nb = nbf.v4.new_notebook()
+    nb.cells = [nbf.v4.new_markdown_cell('# Title\n\nText'), nbf.v4.new_code_cell('print("a")\n1 + 1')]
+    nb.cells[1].outputs = [nbf.v4.new_output('stream', text='a\n'),
+                           nbf.v4.new_output('execute_result', data={'text/plain': '2'}, execution_count=1)]
+
+    assert dumps_notebook(nb) == nbf.writes(nb) + '\n'
+
+    # multi-line strings split as nbformat does, without modifying the notebook
+    nb.cells[1].metadata['trusted'] = True
+    nb.cells[1].outputs.append(nbf.v4.new_output('display_data', data={'text/html': '<b>\n</b>',
+                                                                       'image/svg+xml': '<svg>\n</svg>'}))
+    original = nbf.from_dict(nb)
+    assert dumps_notebook(nb) == nbf.writes(nb) + '\n'
+    assert nb == original
+    del nb.cells[1].metadata['trusted']
+    assert nbf.reads(dumps_notebook(nb, compact=True), as_version=4) == nb
+
+    pathnames = {fmt: '{}/test.{}'.format(tmpdir, fmt) for fmt in ['html', 'ipynb', 'pynb']}
+    NotebookExporter(validate=False, compact=True).export(nb, **pathnames)
+
+    assert nbf.read(pathnames['ipynb'], as_version=4) == nb
+    assert '>Title<' in open(pathnames['html']).read()
+    assert "    '''\n    # Title\n" in open(pathnames['pynb']).read()
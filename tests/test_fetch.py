@@ -0,0 +1,19 @@
+import pickle
+
+import pytest
+
+from pynb.fetch import collect, dumps, loads
+
+
+def test_dumps_loads():
+    values = collect({'data': pickle.PickleBuffer(bytearray(b'x' * 100000)), 'n': 3, 'other': 4}, ['data', 'n'])
+
+    # large buffers kept out of band
+    data, buffers = dumps(values)
+    assert len(data) < 1000 and [buffer.nbytes for buffer in buffers] == [100000]
+
+    values = loads(data, [bytearray(buffer) for buffer in buffers])
+    assert bytes(values['data']) == b'x' * 100000 and values['n'] == 3 and 'other' not in values
+
+    with pytest.raises(NameError):
+        collect({}, ['data'])
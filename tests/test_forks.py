@@ -0,0 +1,54 @@
+import ctypes
+import os
+import time
+
+from pynb.forks import ForkCheckpoints
+
+# prctl option getting the subreaper attribute of the calling process
+PR_GET_CHILD_SUBREAPER = 37
+
+
+def exited(pid, timeout=5):
+    # killed processes are reaped by the helper process
+    deadline = time.time() + timeout
+    while os.path.exists('/proc/{}'.format(pid)) and time.time() < deadline:
+        time.sleep(0.05)
+    return not os.path.exists('/proc/{}'.format(pid))
+
+
+def test_fork_checkpoints():
+    forks = ForkCheckpoints(max_forks=2)
+
+    # only the helper process reaps orphaned descendants, not the calling process
+    subreaper = ctypes.c_int()
+    ctypes.CDLL(None).prctl(PR_GET_CHILD_SUBREAPER, ctypes.byref(subreaper), 0, 0, 0)
+    assert subreaper.value == 0
+
+    try:
+        # generators cannot be serialized, but can be checkpointed
+        forks.execute('g = (i for i in range(10))')
+        forks.checkpoint('a')
+        assert forks.execute('next(g)')[1][0].data['text/plain'] == '0'
+
+        forks.restore('a')
+        assert forks.execute('next(g)')[1][0].data['text/plain'] == '0'
+
+        # the same checkpoint can be restored many times
+        forks.restore('a')
+        assert forks.execute('next(g)')[1][0].data['text/plain'] == '0'
+
+        # the least recently used checkpoint is evicted
+        pid = forks.forks['a']
+        forks.checkpoint('b')
+        forks.checkpoint('c')
+        assert list(forks.forks) == ['b', 'c']
+        assert exited(pid)
+
+        forks.reset()
+        reply, outputs = forks.execute('g')
+        assert reply['content']['status'] == 'error' and outputs[0].ename == 'NameError'
+    finally:
+        pids = [forks.process.pid, forks.pid, forks.start_pid] + list(forks.forks.values())
+        forks.shutdown()
+
+    assert all(exited(pid) for pid in pids)
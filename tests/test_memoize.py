@@ -0,0 +1,50 @@
+import os
+import pickle
+import threading
+
+from pynb.memoize import MemoStore, memoize
+
+
+def test_memoize(tmpdir):
+    calls = []
+
+    @memoize(cache_dir=str(tmpdir))
+    def query(a, b=1):
+        calls.append((a, b))
+        return {'sum': a + b, 'rows': list(range(a))}
+
+    assert query(3) == {'sum': 4, 'rows': [0, 1, 2]}
+    assert query(3) == query(3, b=1) == {'sum': 4, 'rows': [0, 1, 2]}
+    assert query(3, b=2)['sum'] == 5
+    assert calls == [(3, 1), (3, 1), (3, 2)]
+
+    # results persist across decorations of the same function, e.g. in another execution
+    def query(a, b=1):
+        calls.append((a, b))
+        return {'sum': a + b, 'rows': list(range(a))}
+
+    assert memoize(query, cache_dir=str(tmpdir))(3, b=2)['sum'] == 5
+    assert len(calls) == 3
+
+    # arguments that cannot be serialized disable memoization
+    lock = threading.Lock()
+    assert memoize(lambda x: 42, cache_dir=str(tmpdir))(lock) == 42
+
+
+def test_memo_store(tmpdir):
+    store = MemoStore(str(tmpdir), max_size=2500000)
+
+    # large buffers are stored out of band and loaded as views of the file content
+    store.dump('a', {'data': pickle.PickleBuffer(bytearray(b'a' * 1000000))})
+    found, value = store.load('a')
+    assert found and bytes(value['data']) == b'a' * 1000000
+    assert os.path.getsize(store.pathname('a')) < 1001000
+
+    assert store.load('b') == (False, None)
+
+    # least recently used results evicted
+    os.utime(store.pathname('a'), (0, 0))
+    store.dump('b', bytes(1000000))
+    store.load('a')
+    store.dump('c', bytes(1000000))
+    assert store.load('a')[0] and not store.load('b')[0] and store.load('c')[0]
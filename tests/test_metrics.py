@@ -0,0 +1,29 @@
+import json
+
+from pynb.metrics import CacheMetrics, StatsDB
+
+
+def test_cache_metrics(tmpdir):
+    metrics = CacheMetrics()
+    metrics.hit({'exec_time': 2.0}, 0.5, 100)
+    metrics.hit({}, 0.1, 50)
+    metrics.misses += 1
+
+    assert metrics.hits == 2 and metrics.bytes_read == 150
+    assert metrics.seconds_saved == 1.5
+
+    metrics.write('{}/metrics.prom'.format(tmpdir), 'nb.py:cells')
+    assert 'pynb_cache_hits{notebook="nb.py:cells"} 2\n' in open('{}/metrics.prom'.format(tmpdir)).read()
+
+    metrics.write('{}/metrics.json'.format(tmpdir), 'nb.py:cells')
+    assert json.load(open('{}/metrics.json'.format(tmpdir)))['misses'] == 1
+
+    db = StatsDB('{}/stats.db'.format(tmpdir))
+    db.record('nb.py:cells', metrics)
+    db.record('nb.py:cells', metrics)
+    db.record('other.py:cells', CacheMetrics())
+
+    rows = db.query('nb.py')
+    assert len(rows) == 1
+    assert rows[0]['runs'] == 2 and rows[0]['hits'] == 4 and rows[0]['seconds_saved'] == 3.0
+    assert len(db.query()) == 2
@@ -0,0 +1,26 @@
+import cProfile
+import pstats
+import time
+
+from pynb.profiling import summary
+
+
+def slow():
+    time.sleep(0.1)
+
+
+def test_summary():
+    profiler = cProfile.Profile()
+    profiler.enable()
+    for i in range(3):
+        slow()
+    profiler.disable()
+
+    profile = summary(pstats.Stats(profiler), top=2)
+
+    assert len(profile['functions']) == 2
+    assert profile['functions'][0]['function'].endswith('(slow)')
+    assert profile['functions'][0]['ncalls'] == 3
+    assert profile['functions'][0]['cumtime'] >= 0.3
+    assert profile['functions'][1]['function'] == '{built-in method time.sleep}'
+    assert profile['total_time'] >= profile['functions'][0]['cumtime']
@@ -0,0 +1,117 @@
+import json
+import os
+import socket
+import subprocess
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def request(url, data=None):
+    if data is not None:
+        data = json.dumps(data).encode('utf-8')
+    with urllib.request.urlopen(url, data=data) as f:
+        return f.read().decode('utf-8')
+
+
+@pytest.fixture
+def server():
+    port = free_port()
+    root = os.path.dirname(os.path.realpath(__file__)) + '/..'
+    p = subprocess.Popen(['pynb', 'serve', '--port', str(port), '--kernels', '1', '--root', root])
+    url = 'http://127.0.0.1:{}'.format(port)
+
+    for i in range(60):
+        try:
+            request(url + '/metrics')
+            break
+        except OSError:
+            time.sleep(0.5)
+
+    yield url
+
+    p.terminate()
+    p.wait()
+
+
+def test_serve_run(server):
+    notebook = os.path.dirname(os.path.realpath(__file__)) + '/../notebooks/sum.py'
+
+    for a in [40000, 50000]:
+        params = {'a': a, 'b': 4321}
+        nb = json.loads(request(server + '/run', {'notebook': notebook, 'params': params, 'disable_cache': True}))
+        assert str(a + 4321) in nb['cells'][-1]['outputs'][0]['data']['text/plain']
+
+    # notebooks outside of the root directory are rejected, relative pathnames are relative to it
+    with pytest.raises(urllib.error.HTTPError) as e:
+        request(server + '/run', {'notebook': '../etc/passwd', 'disable_cache': True})
+    assert e.value.code == 400 and 'outside of root directory' in e.value.read().decode('utf-8')
+
+    nb = json.loads(request(server + '/run', {'notebook': 'notebooks/sum.py', 'params': {'a': 1, 'b': 2},
+                                              'disable_cache': True}))
+    assert '3' in nb['cells'][-1]['outputs'][0]['data']['text/plain']
+
+    lines = request(server + '/run', {'notebook': notebook, 'params': {'a': 1, 'b': 2}, 'format': 'stream',
+                                      'disable_cache': True}).splitlines()
+    assert [json.loads(line)['status'] for line in lines[:-1]] == ['ok', 'ok', 'ok']
+    assert 'nbformat' in json.loads(lines[-1])
+
+    metrics = json.loads(request(server + '/metrics'))
+    assert metrics['requests']['ok'] == 4
+    assert metrics['latency_p99'] >= metrics['latency_p50'] > 0
+
+
+def test_kernel_pool_replacement_failure():
+    import queue
+    from pynb.server import KernelPool
+
+    class FailingKernelPool(KernelPool):
+        attempts = 0
+
+        def start_kernel(self):
+            self.attempts += 1
+            raise RuntimeError('Cannot start kernel')
+
+    class KernelManager:
+        def shutdown_kernel(self, now=False):
+            pass
+
+    # failed starts are retried, then the pool has one kernel less and acquire times out
+    pool = FailingKernelPool(0, retries=2, retry_delay=0)
+    pool.replace(KernelManager())
+    assert pool.attempts == 3
+
+    with pytest.raises(queue.Empty):
+        pool.acquire(timeout=0.1)
+
+
+def test_server_cells_cache():
+    from pynb.notebook import Notebook
+    from pynb.server import NotebookServer
+
+    notebook = os.path.dirname(os.path.realpath(__file__)) + '/../notebooks/sum.py'
+    server = NotebookServer(('127.0.0.1', 0), kernels=0, queue_timeout=0.1, root=os.path.dirname(notebook))
+
+    # cells parsed once and copied by each notebook
+    func, cells = server.get_func(notebook, 'cells')
+    assert server.get_func(notebook, 'cells')[1] is cells
+
+    nbs = [Notebook() for i in range(2)]
+    for nb in nbs:
+        nb.add_func(func, {'a': 1, 'b': 2}, cells)
+    assert [c.source for c in nbs[0].nb.cells] == [c.source for c in nbs[1].nb.cells]
+    assert len(nbs[0].nb.cells) == len(cells) + 1 and nbs[0].nb.cells[2] is not nbs[1].nb.cells[2]
+
+    with pytest.raises(RuntimeError):
+        server.acquire_kernel()
+    assert server.status()['queued'] == 0
+
+    server.server_close()
@@ -0,0 +1,15 @@
+from pynb.shell import ShellExecutor
+
+
+def test_shell_executor():
+    executor = ShellExecutor()
+
+    reply, outputs = executor.execute('import sys\nprint(1)\nprint(2)\nprint(3, file=sys.stderr)\n10 + 1')
+    assert reply['content']['status'] == 'ok'
+    assert [out.output_type for out in outputs] == ['stream', 'stream', 'execute_result']
+    assert outputs[0].text == '1\n2\n' and outputs[1].name == 'stderr'
+    assert outputs[2].data['text/plain'] == '11'
+
+    reply, outputs = executor.execute('from IPython.display import HTML\ndisplay(HTML("<b>x</b>"))\n1 / 0')
+    assert reply['content']['ename'] == 'ZeroDivisionError'
+    assert outputs[0].data['text/html'] == '<b>x</b>' and outputs[1].output_type == 'error'
@@ -0,0 +1,42 @@
+import json
+import os
+
+import nbformat as nbf
+
+from pynb.store import OutputStore
+
+
+def test_output_store(tmpdir):
+    store = OutputStore(path='{}/blobs'.format(tmpdir), threshold=100)
+
+    image = 'iVBORw0KGgo' * 100
+    outputs = [nbf.v4.new_output('display_data', data={'image/png': image, 'text/plain': '<Figure>'}),
+               nbf.v4.new_output('stream', text='done\n')]
+    reply = {'content': {'status': 'ok', 'execution_count': 1}}
+
+    for i in range(2):
+        store.dump((reply, outputs), '{}/value-{}.json'.format(tmpdir, i))
+
+    # large payload stored once, replaced by reference in the readable manifest
+    blobs = [f for _, _, files in os.walk('{}/blobs'.format(tmpdir)) for f in files]
+    assert len(blobs) == 1
+    with open('{}/value-0.json'.format(tmpdir)) as f:
+        assert json.load(f)['outputs'][0]['data']['image/png'] == {'pynb_blob': blobs[0]}
+
+    assert OutputStore(path='{}/blobs'.format(tmpdir)).load('{}/value-1.json'.format(tmpdir)) == (reply, outputs)
+
+    # the threshold is in bytes of UTF-8 encoded payloads, not in characters
+    store.dump((reply, [nbf.v4.new_output('stream', text='\u00e9' * 60)]), '{}/value-2.json'.format(tmpdir))
+    with open('{}/value-2.json'.format(tmpdir)) as f:
+        assert 'pynb_blob' in json.load(f)['outputs'][0]['text']
+
+
+def test_output_store_blob_cache(tmpdir):
+    store = OutputStore(path='{}/blobs'.format(tmpdir), threshold=100, cache_size=2500)
+    keys = [store.put_blob(bytes([i]) * 1000) for i in range(3)]
+
+    # least recently used blobs evicted from memory
+    for key in keys[:2] + keys[:1] + keys[2:]:
+        store.get_blob(key)
+    assert list(store.blobs) == [keys[0], keys[2]] and store.blobs_size == 2000
+    assert store.get_blob(keys[1]) == bytes([1]) * 1000